@@ -0,0 +1,201 @@
+"""
+Checks that the hand-written parser (the "fast" parser mode) conforms to the Lark parser: on the examples, the synthetic
+workloads, a list of edge cases, and random mutations of them, it must accept the same sources, and produce the same
+IMF AST, with the same positions.
+
+The reference is the Earley parser, except for the span of the Feature node, which the Earley parser ends at the last
+statement and the LALR parser (and the fast parser) at the last newline.
+
+    $ python -m benchmarks.conformance
+    $ python -m benchmarks.conformance --mutations 5000 --seed 2
+"""
+import argparse
+import dataclasses
+import glob
+import os
+import random
+import sys
+from typing import Any, List, Optional, Tuple
+
+import lark
+
+import gfslang
+from gfslang import imf_ast
+from gfslang.errors import GFSLError
+from . import synthetic
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+# sources whose tokenization is easy to get subtly wrong; invalid sources must be rejected by both parsers
+CASES = [
+    "",
+    "\n\n",
+    "# comment\n",
+    "  \t\n  # indented comment\n0: a = 1",
+    "0: a = 1  # trailing comment\n",
+    "0:a=1\n1 :  b  ++  a",
+    "-1.5: a = -1\n+2: b = +2\n.5: c = .5\n1e3: d = 1e3",
+    "0: x = 1e-5 + 1E+05 + 1. + 1.e5 + 007 + 1.5e2",
+    "0: x = 10.5.x + 1abc + 5e + 0x10 + 1e5x + 1e-5x",
+    "0: x = $x.${a}b + attributes.${statName}.value",
+    "0: 5 = 1",
+    "0: x = import",
+    "0: x = a-1 + a -1 + a - -1 + a--1 + a+-1 + 2*-1",
+    "0: x = a * b / c // d - e + f * (g - h) // (i)",
+    "0: x = ((((a))))",
+    "0: x = min() + max(a,) + max(a, b, c) + floor ( a ) + my_func(a)",
+    "0: x = !a + ! b + !c(1) + !d ( 1, 2, ) + !e()",
+    "x := 1\ny:=x\nz := (a + 1)",
+    "f() := 1\ng(!a) := !a\nh(!a, !b,) := !a * !b",
+    "f(!a) := !a ? 1 : 2",
+    "f(!a) := !a ? 1 : !a ? 2 : 3",
+    "f(!a) := !a ? !a ? 1 : 2 : 3",
+    "f(!a) := (!a ? 1 : 2)",
+    "f(!a) := ((!a ? 1 : 2))",
+    "f(!a) := (!a ? 1 : 2) ? 3 : 4",
+    "f(!a) := (!a + 1) ? (1) : (2 ? 3 : 4)",
+    "f(!a) := !a + (1)",
+    "0: x = a == b + a != b + (a < b) * (a <= b) - (a > b) // (a >= b)",
+    "0: x = a+1<=b*2\n0: y = !a==-1\n0: z = min(a < b, a>b)",
+    "f(!a) := !a < 1 ? 1 : !a >= 2 ? (!a == 3 ? 4 : 5) : 6",
+    "f(!a) := (!a ? 1 : 2) ? 3 : 4 < 5",
+    'import "a.gfs"',
+    'import"a.gfs"  # comment',
+    'import "a \\" b.gfs"',
+    # invalid
+    "0: x = a.min(1)",
+    "0: x = 2*-a",
+    "0: x = 1_000",
+    '0: x = "a"',
+    "0: x = (1 ? 2 : 3)",
+    "f(!a) := (1 ? 2 : 3) + 1",
+    "f(!a) := 1 + (1 ? 2 : 3)",
+    "f(!a) := min((1 ? 2 : 3))",
+    "0: x ++ ++1",
+    "1 ++ 1",
+    'import "a" "b"',
+    "0: x = min(,)",
+    "0: x = 1 +",
+    "0: x = a < b < c",
+    "0: x = a = b",
+    "0: x = a =< b",
+    "0: x = a ! = b",
+    "0: x = a <",
+    "0: x == 1",
+    "f(!a) := (!a ? 1 : 2) < 3",
+    "f(!a) := 1 < (!a ? 1 : 2)",
+    "0: x = (1",
+    "0: x = 1)",
+    "0 := 1",
+    "x :=",
+    "f(a) := 1",
+    "f(!a !b) := 1",
+    "1abc: x = 1",
+    "1.5.x: x = 1",
+    "0: x = 1\r\n",
+    "0: x = 1 0: y = 2",
+    "x := 1 ? 2 : 3",
+    "0: x = !",
+    "0: x = a ? b : c",
+]
+
+
+def dump(node: Any, feature_span: bool = True) -> Any:
+    """Returns a comparable representation of an IMF node: its type, position, and attributes."""
+    if isinstance(node, (list, tuple)):
+        return [dump(child) for child in node]
+    if not isinstance(node, imf_ast.Node):
+        return node
+    position = None
+    if feature_span or not isinstance(node, imf_ast.Feature):
+        position = (node.line, node.column, node.end_line, node.end_column)
+    attributes = {name: dump(value) for name, value in node.fields()}
+    return type(node).__name__, position, attributes
+
+
+def try_parse(source: str, mode: str) -> Tuple[Optional[imf_ast.Feature], Optional[Exception]]:
+    try:
+        return gfslang.parse(source, mode=mode), None
+    except (lark.exceptions.UnexpectedInput, GFSLError) as e:
+        return None, e
+
+
+def check(source: str) -> Optional[str]:
+    """Returns a description of how the fast parser disagrees with the Lark parsers on the source, if it does."""
+    fast, fast_error = try_parse(source, "fast")
+    try:
+        expected, expected_error = try_parse(source, "earley")
+    except lark.exceptions.VisitError:
+        # the Lark parsers crash on sources without any tokens (e.g. only a comment), instead of returning an empty
+        # feature
+        if fast is None or fast.statements:
+            return f"the Lark parser has no tokens, but the fast parser parsed {fast_error or fast}"
+        return None
+    if (fast is None) != (expected is None):
+        if fast is None:
+            return f"fast parser rejected a valid source: {fast_error}"
+        return f"fast parser accepted an invalid source, which the Lark parser rejects with:\n{expected_error}"
+    if fast is None:
+        return None
+    if dump(fast, feature_span=False) != dump(expected, feature_span=False):
+        return f"ASTs differ:\nfast:     {dump(fast)}\nexpected: {dump(expected)}"
+    lalr, _ = try_parse(source, "lalr")
+    if lalr is not None and dump(fast) != dump(lalr):
+        return f"feature spans differ:\nfast:     {dump(fast)}\nexpected: {dump(lalr)}"
+    return None
+
+
+def mutate(line: str, rng: random.Random) -> str:
+    """Randomly inserts, deletes, or replaces a character of the line."""
+    alphabet = "0123456789aeE.+-*/()!?:=,$ {}\t#_\"'"
+    pos = rng.randrange(len(line) + 1)
+    kind = rng.choice(("insert", "delete", "replace"))
+    if kind == "insert" or not line:
+        return line[:pos] + rng.choice(alphabet) + line[pos:]
+    pos = min(pos, len(line) - 1)
+    if kind == "delete":
+        return line[:pos] + line[pos + 1 :]
+    return line[:pos] + rng.choice(alphabet) + line[pos + 1 :]
+
+
+def sources(mutations: int, seed: int) -> List[Tuple[str, str]]:
+    """Returns the named sources to check."""
+    named = []
+    for filename in sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.gfs"))):
+        with open(filename) as f:
+            named.append((os.path.relpath(filename), f.read()))
+    for name, workload in synthetic.PRESETS.items():
+        # the Earley parser is slow on large sources
+        small = dataclasses.replace(workload, statements=min(workload.statements, 100), seed=seed)
+        named.append((f"preset {name}", synthetic.generate(small)))
+    named.extend((f"case {i}", case) for i, case in enumerate(CASES))
+
+    rng = random.Random(seed)
+    lines = [line for _, source in named for line in source.split("\n") if line.strip()]
+    for i in range(mutations):
+        line = rng.choice(lines)
+        for _ in range(rng.randint(1, 3)):
+            line = mutate(line, rng)
+        named.append((f"mutation {i}", line))
+    return named
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Check that the fast parser conforms to the Lark parser.")
+    argparser.add_argument("--mutations", type=int, default=1000, help="Random mutations to check (default 1000).")
+    argparser.add_argument("--seed", type=int, default=0, help="The random seed (default 0).")
+    args = argparser.parse_args()
+
+    failures = 0
+    checked = sources(args.mutations, args.seed)
+    for name, source in checked:
+        failure = check(source)
+        if failure is not None:
+            failures += 1
+            print(f"{name}: {source!r}\n{failure}\n", file=sys.stderr)
+    print(f"{len(checked) - failures}/{len(checked)} sources conform.", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
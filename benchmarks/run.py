@@ -0,0 +1,200 @@
+"""
+Benchmarks each stage of the GFSLang pipeline separately: parse, compile, optimize, and render (per output format).
+
+For each stage, reports the best and median wall time over the repeats, throughput in statements/sec (top-level
+statements of the source, including macro definitions) and bytes/sec (of the source for parse/compile/optimize, of the
+output for render), and the peak memory allocated while running the stage once (measured with tracemalloc, in a
+separate run so it does not slow down the timed runs).
+
+Results are written as JSON, so that they can be compared across releases:
+
+    $ python -m benchmarks.run -o results.json
+    $ python -m benchmarks.run --baseline results.json  # reports stages that got slower
+"""
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import lark
+
+import gfslang
+from gfslang.cache import compiler_version
+from . import synthetic
+
+
+def measure(stage: Callable[[], Any], repeat: int) -> Tuple[List[float], int]:
+    """Returns the wall times of *repeat* runs of the stage, and the peak memory allocated by one more run."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def stage_result(times: List[float], peak: int, statements: int, nbytes: int) -> Dict[str, Any]:
+    best = min(times)
+    return {
+        "best_seconds": best,
+        "median_seconds": statistics.median(times),
+        "statements_per_second": statements / best if best else None,
+        "bytes_per_second": nbytes / best if best else None,
+        "bytes": nbytes,
+        "peak_memory_bytes": peak,
+    }
+
+
+def benchmark(
+    source: str, repeat: int = 5, parser_mode: str = gfslang.parser.DEFAULT_PARSER_MODE, optimize: int = 1
+) -> Dict[str, Any]:
+    """Benchmarks every stage of compiling the given source."""
+    source_bytes = len(source.encode())
+    # build the parser before timing anything, since that is a one-time cost
+    gfslang.parser.prepare(parser_mode)
+
+    stages = {}
+    ast = gfslang.parse(source, mode=parser_mode)
+    statements = len(ast.statements)
+    times, peak = measure(lambda: gfslang.parse(source, mode=parser_mode), repeat)
+    stages["parse"] = stage_result(times, peak, statements, source_bytes)
+
+    # compiled expressions are interned while they are alive, so the timed compiles must not keep their results
+    times, peak = measure(lambda: gfslang.compile(ast), repeat)
+    stages["compile"] = stage_result(times, peak, statements, source_bytes)
+
+    compiled = gfslang.compile(ast)
+    times, peak = measure(lambda: gfslang.optimize(compiled, optimize), repeat)
+    stages["optimize"] = stage_result(times, peak, statements, source_bytes)
+
+    optimized = gfslang.optimize(compiled, optimize)
+    for name, renderer_cls in gfslang.renderer.formats.items():
+        rendered = renderer_cls().render(optimized)
+        output_bytes = len(rendered if renderer_cls.binary else rendered.encode())
+        times, peak = measure(lambda: renderer_cls().render(optimized), repeat)
+        stages[f"render_{name}"] = stage_result(times, peak, statements, output_bytes)
+
+    return {
+        "source_bytes": source_bytes,
+        "statements": statements,
+        "compiled_statements": len(compiled),
+        "stages": stages,
+    }
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "compiler_version": compiler_version(),
+        "lark_version": lark.__version__,
+        "python_version": platform.python_version(),
+        "python_implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Returns a description of every stage that is more than *threshold* (a fraction) slower than in the baseline."""
+    regressions = []
+    baseline_workloads = {workload["name"]: workload for workload in baseline["workloads"]}
+    for workload in results["workloads"]:
+        old_workload = baseline_workloads.get(workload["name"])
+        if old_workload is None:
+            continue
+        for stage, result in workload["stages"].items():
+            old = old_workload["stages"].get(stage)
+            if old is None:
+                continue
+            ratio = result["best_seconds"] / old["best_seconds"]
+            if ratio > 1 + threshold:
+                regressions.append(
+                    f"{workload['name']} {stage}: {old['best_seconds'] * 1000:.3f}ms -> "
+                    f"{result['best_seconds'] * 1000:.3f}ms ({ratio - 1:+.0%})"
+                )
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark the stages of the GFSLang pipeline.")
+    argparser.add_argument(
+        "inputs",
+        nargs="*",
+        help="GFSL files to benchmark (default: the synthetic preset workloads).",
+        metavar="input",
+    )
+    argparser.add_argument(
+        "--preset",
+        action="append",
+        choices=synthetic.PRESETS,
+        help="A synthetic workload to benchmark (can be given more than once).",
+    )
+    argparser.add_argument("-n", "--repeat", type=int, default=5, help="Timed runs per stage (default %(default)s).")
+    argparser.add_argument(
+        "--parser",
+        choices=gfslang.parser.PARSER_MODES,
+        default=gfslang.parser.DEFAULT_PARSER_MODE,
+        help="The parsing algorithm to use (default %(default)s).",
+    )
+    argparser.add_argument(
+        "-O",
+        help="The optimization level (default %(default)s).",
+        dest="optimize",
+        type=int,
+        choices=gfslang.optimizer.LEVELS,
+        default=gfslang.optimizer.DEFAULT_LEVEL,
+    )
+    argparser.add_argument("-o", help="The file to write the JSON results to (default: stdout).", metavar="output_file")
+    argparser.add_argument("--baseline", help="Earlier JSON results to report regressions against.")
+    argparser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="How much slower a stage has to be than the baseline to be reported (default %(default)s).",
+    )
+    args = argparser.parse_args()
+
+    workloads: List[Tuple[str, str]] = []
+    for filename in args.inputs:
+        with open(filename) as f:
+            workloads.append((filename, f.read()))
+    presets = args.preset or ([] if args.inputs else list(synthetic.PRESETS))
+    for preset in presets:
+        workload = synthetic.PRESETS[preset]
+        workloads.append((f"{preset}:{workload.name}", synthetic.generate(workload)))
+
+    results = {"environment": environment(), "parser": args.parser, "optimize": args.optimize, "workloads": []}
+    for name, source in workloads:
+        print(f"benchmarking {name}...", file=sys.stderr)
+        results["workloads"].append({"name": name, **benchmark(source, args.repeat, args.parser, args.optimize)})
+
+    output = json.dumps(results, indent=2)
+    if args.o:
+        with open(args.o, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Generates synthetic GFSL features for benchmarking. Workloads are deterministic for a given seed, and scale along:
+
+- statements: the number of rule statements
+- depth: how deeply each statement's expression is nested
+- macros: the number of static macros defined, and fanout: how many of them each statement references
+- recursion: the depth of a recursive functional macro that each statement calls (0 to not use one)
+"""
+import argparse
+import dataclasses
+import random
+import sys
+from typing import List
+
+
+@dataclasses.dataclass
+class Workload:
+    statements: int = 100
+    depth: int = 3
+    macros: int = 10
+    fanout: int = 2
+    recursion: int = 0
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return (
+            f"s{self.statements}-d{self.depth}-m{self.macros}-f{self.fanout}-r{self.recursion}"
+            + (f"-seed{self.seed}" if self.seed else "")
+        )
+
+
+# the workloads that are benchmarked if none are given
+PRESETS = {
+    "small": Workload(statements=10),
+    "medium": Workload(statements=1_000),
+    "large": Workload(statements=10_000),
+    "deep": Workload(statements=100, depth=50),
+    "fanout": Workload(statements=1_000, macros=100, fanout=20),
+    "recursive": Workload(statements=100, recursion=50),
+}
+
+
+class Generator:
+    def __init__(self, workload: Workload):
+        self.workload = workload
+        self.rng = random.Random(workload.seed)
+
+    def generate(self) -> str:
+        lines = [f"# synthetic workload {self.workload.name}"]
+        lines.extend(self.macro_defs())
+        if self.workload.recursion:
+            lines.append("accumulate(!n, !x) := !n ? !x + !accumulate(!n - 1, !x) : 0")
+        for i in range(self.workload.statements):
+            lines.append(self.statement(i))
+        return "\n".join(lines) + "\n"
+
+    def macro_defs(self) -> List[str]:
+        lines = ["abilityMod(!stat) := (!stat - 10) // 2"]
+        for i in range(self.workload.macros):
+            # macros can reference the macros defined before them
+            lines.append(f"m{i} := {self.expression(2, macros=i)}")
+        return lines
+
+    def statement(self, i: int) -> str:
+        terms = [self.expression(self.workload.depth, macros=self.workload.macros)]
+        if self.workload.macros:
+            terms.extend(f"!m{self.rng.randrange(self.workload.macros)}" for _ in range(self.workload.fanout))
+        if self.workload.recursion:
+            terms.append(f"!accumulate({self.workload.recursion}, {self.target()})")
+        precedence = self.rng.choice((0, 0.5, 1, 2, 10))
+        op = self.rng.choice(("=", "=", "=", "++"))
+        return f"{precedence}: stats.s{i}.value {op} {' + '.join(terms)}"
+
+    def expression(self, depth: int, macros: int) -> str:
+        """Returns an expression nested *depth* deep. Only one side of each operation is nested, so size is linear."""
+        if depth <= 0:
+            return self.leaf(macros)
+        inner = self.expression(depth - 1, macros)
+        kind = self.rng.random()
+        if kind < 0.5:
+            op = self.rng.choice(("+", "-", "*"))
+            if self.rng.random() < 0.5:
+                return f"({inner} {op} {self.leaf(macros)})"
+            return f"({self.leaf(macros)} {op} {inner})"
+        elif kind < 0.7:
+            return f"({inner} {self.rng.choice(('/', '//'))} {self.rng.randint(2, 5)})"
+        elif kind < 0.85:
+            return f"{self.rng.choice(('min', 'max'))}({inner}, {self.leaf(macros)})"
+        elif kind < 0.95:
+            return f"floor({inner})"
+        return f"!abilityMod({inner})"
+
+    def leaf(self, macros: int) -> str:
+        kind = self.rng.random()
+        if kind < 0.3:
+            return str(self.rng.choice((self.rng.randint(1, 20), round(self.rng.uniform(0, 2), 2))))
+        elif kind < 0.4 and macros:
+            return f"!m{self.rng.randrange(macros)}"
+        return self.target()
+
+    def target(self) -> str:
+        return self.rng.choice(
+            (
+                f"attributes.{self.rng.choice(('strength', 'dexterity', 'constitution'))}.value",
+                "attributes.${statName}.value",
+                f"stats.s{self.rng.randrange(max(self.workload.statements, 1))}.value",
+                "proficiencyBonus",
+            )
+        )
+
+
+def generate(workload: Workload) -> str:
+    return Generator(workload).generate()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Generate a synthetic GFSL feature for benchmarking.")
+    for field in dataclasses.fields(Workload):
+        argparser.add_argument(f"--{field.name}", type=int, default=field.default)
+    argparser.add_argument("-o", help="The file to write (default: stdout).", metavar="output_file")
+    args = argparser.parse_args()
+    source = generate(Workload(**{field.name: getattr(args, field.name) for field in dataclasses.fields(Workload)}))
+    if args.o:
+        with open(args.o, "w") as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,124 @@
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import json
 import os
 import sys
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import lark
 
 import gfslang
+import gfslang.watch
+from gfslang import instrumentation
+from gfslang.cache import CompileCache, atomic_open, atomic_write
+
+
+def binding_argument(binding: str) -> Tuple[str, Tuple[str, ...]]:
+    """Parses a --bind argument."""
+    try:
+        name, values = gfslang.templates.parse_binding(binding)
+        gfslang.TemplateExpander({name: values})
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return name, values
+
 
-argparser = argparse.ArgumentParser(description="Compile a GFSLang file to a typescript object.")
-argparser.add_argument("input_file")
-argparser.add_argument("-o", help="The filename of the output file to write.", metavar="output_file")
+argparser = argparse.ArgumentParser(description="Compile a GFSLang file to a typescript object, JSON, or MessagePack.")
+argparser.add_argument(
+    "inputs",
+    nargs="+",
+    help="A GFSL file to compile. Multiple files, directories (compiled recursively), or glob patterns compile every "
+    "matching .gfs file in parallel.",
+    metavar="input",
+)
+argparser.add_argument(
+    "-o", help="The filename of the output file to write (single input file only).", metavar="output_file"
+)
+argparser.add_argument(
+    "-j",
+    "--jobs",
+    help="The number of worker processes to use for batch compiles (default: number of CPUs).",
+    type=int,
+)
+argparser.add_argument(
+    "--parser",
+    help="The parsing algorithm to use (default %(default)s).",
+    choices=gfslang.parser.PARSER_MODES,
+    default=gfslang.parser.DEFAULT_PARSER_MODE,
+)
+argparser.add_argument(
+    "--format",
+    help="The output format (default %(default)s).",
+    choices=gfslang.renderer.formats,
+    default="ts",
+)
+argparser.add_argument(
+    "--engine",
+    help="The GFS engine to compile for (default %(default)s): the base engine only has ADD/MULTIPLY/MIN/MAX/FLOOR, "
+    "and the extended engine also has native subtraction, division, ceil/round/abs, comparisons, and conditionals.",
+    choices=gfslang.gfs_ast.ENGINES,
+    default=gfslang.gfs_ast.DEFAULT_ENGINE,
+)
+argparser.add_argument(
+    "-O",
+    help="The optimization level (default %(default)s): 0 disables the optimizer, 2 also rewrites sums.",
+    dest="optimize",
+    type=int,
+    choices=gfslang.optimizer.LEVELS,
+    default=gfslang.optimizer.DEFAULT_LEVEL,
+)
+argparser.add_argument(
+    "--check", help="Warn about dependency cycles and precedence conflicts between statements.", action="store_true"
+)
+argparser.add_argument(
+    "--profile",
+    help="Write a report of the time spent in each compilation stage and of the compiler's counters (e.g. macro "
+    "expansions) to this JSON file.",
+    metavar="report_file",
+)
+argparser.add_argument(
+    "--no-cache", help="Always recompile, without reading or writing the compile cache.", action="store_true"
+)
+argparser.add_argument(
+    "--bind",
+    help="Expand templated targets at compile time: emit one statement for each value of the ${name} placeholder, "
+    "e.g. --bind statName=strength,dexterity (can be given more than once).",
+    action="append",
+    type=binding_argument,
+    metavar="name=value,...",
+)
+argparser.add_argument(
+    "--source-map",
+    help="Also write a source map (output file name + .map) from the output back to the GFSL source. Compiles "
+    "without the cache. Not supported for msgpack.",
+    action="store_true",
+)
+argparser.add_argument(
+    "--link",
+    help="Link the compiled inputs into one bundle, written to this file instead of an output per input: statements "
+    "repeated across inputs are merged, and targets set to different values at the same precedence are reported.",
+    metavar="bundle_file",
+)
+argparser.add_argument(
+    "--watch",
+    help="Compile the inputs, then keep recompiling each input when it (or a library it imports) changes.",
+    action="store_true",
+)
 
 
 def debug():
     """random zhu code to debug, ignore me"""
     from gfslang import compile
-    from gfslang.parser import parser, transformer
+    from gfslang.parser import get_parser, transformer
     from gfslang.renderer import TSRenderer
 
     with open(sys.argv[-1]) as f:
         expr = f.read()
-    result = parser.parse(expr)
+    result = get_parser().parse(expr)
     print(result.pretty())
     expr = transformer.transform(result)
     print(repr(expr))
@@ -28,21 +129,581 @@ def debug():
 
 def main():
     args = argparser.parse_args()
+    renderer = gfslang.renderer.formats[args.format]()
+    bindings = dict(args.bind) if args.bind else None
+    batch = len(args.inputs) > 1 or os.path.isdir(args.inputs[0]) or glob.has_magic(args.inputs[0])
+    if args.source_map and not renderer.source_maps:
+        argparser.error(f"source maps are not supported for the {args.format} format")
+
+    if args.link:
+        if args.o or args.watch or args.source_map:
+            argparser.error("--link cannot be used with -o, --watch, or --source-map")
+        input_filenames = find_inputs(args.inputs)
+        errors = link_batch(
+            input_filenames,
+            args.link,
+            renderer,
+            args.parser,
+            optimize=args.optimize,
+            use_cache=not args.no_cache,
+            check=args.check,
+            jobs=args.jobs,
+            bindings=bindings,
+            engine=args.engine,
+        )
+        for input_filename, error in errors:
+            print(error, file=sys.stderr)
+        sys.exit(1 if errors else 0)
+
+    if args.watch:
+        if args.o and batch:
+            argparser.error("-o can only be used with a single input file")
+        try:
+            watch(
+                args.inputs,
+                args.format,
+                args.parser,
+                optimize=args.optimize,
+                use_cache=not args.no_cache,
+                check=args.check,
+                bindings=bindings,
+                output_filename=args.o,
+                source_map=args.source_map,
+                engine=args.engine,
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # batch mode
+    if batch:
+        if args.o:
+            argparser.error("-o can only be used with a single input file")
+        input_filenames = find_inputs(args.inputs)
+        profiles = {} if args.profile else None
+        errors = compile_batch(
+            input_filenames,
+            args.format,
+            args.parser,
+            optimize=args.optimize,
+            use_cache=not args.no_cache,
+            check=args.check,
+            jobs=args.jobs,
+            profiles=profiles,
+            bindings=bindings,
+            source_map=args.source_map,
+            engine=args.engine,
+        )
+        for input_filename, error in errors:
+            print(error, file=sys.stderr)
+        print(f"Compiled {len(input_filenames) - len(errors)}/{len(input_filenames)} files.", file=sys.stderr)
+        if args.profile:
+            write_profile(args.profile, profiles)
+        sys.exit(1 if errors else 0)
+
+    input_filename = args.inputs[0]
     if args.o:
         output_filename = args.o
     else:
-        base_filename, _ = os.path.splitext(args.input_file)
-        output_filename = f"{base_filename}.ts"
+        output_filename = default_output_filename(input_filename, renderer)
 
-    with open(args.input_file) as f:
-        expr = f.read()
+    cache = None if args.no_cache else CompileCache()
+    with instrumentation.profile() if args.profile else contextlib.nullcontext() as stats:
+        try:
+            with instrumentation.stage("total"):
+                compile_file(
+                    input_filename,
+                    output_filename,
+                    renderer,
+                    parser_mode=args.parser,
+                    optimize=args.optimize,
+                    cache=cache,
+                    check=args.check,
+                    bindings=bindings,
+                    source_map=args.source_map,
+                    engine=args.engine,
+                )
+        except (lark.exceptions.UnexpectedInput, gfslang.errors.GFSLError) as e:
+            print(report_errors(input_filename, args.parser, e, args.engine), file=sys.stderr)
+            sys.exit(1)
+    if args.profile:
+        write_profile(args.profile, {input_filename: stats})
+
+
+def default_output_filename(input_filename: str, renderer: gfslang.renderer.Renderer) -> str:
+    base_filename, _ = os.path.splitext(input_filename)
+    return f"{base_filename}{renderer.file_extension}"
+
+
+def compile_file(
+    input_filename: str,
+    output_filename: str,
+    renderer: gfslang.renderer.Renderer,
+    parser_mode: str = gfslang.parser.DEFAULT_PARSER_MODE,
+    optimize: int = gfslang.optimizer.DEFAULT_LEVEL,
+    cache: CompileCache = None,
+    check: bool = False,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    source_map: bool = False,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+):
+    """
+    Compiles one GFSL file. If a cache is given, unchanged files are not recompiled, and statements whose macros did
+    not change are reused from the last compile of this file. If *check* is set, warns about dependency cycles and
+    precedence conflicts between the statements. Otherwise, without a cache, the file is compiled as a stream (see
+    gfslang.compile_stream). If *bindings* are given, templated targets are expanded for each binding. If
+    *source_map* is set, a source map is written next to the output (without using the cache). The output only uses
+    the operators of the GFS *engine*.
+    """
+    sourcemap = None
+    if source_map:
+        # cached statements and outputs do not know where they came from
+        cache = None
+        output_dir = os.path.dirname(os.path.abspath(output_filename))
+        sourcemap = gfslang.SourceMap(
+            os.path.basename(output_filename),
+            os.path.relpath(input_filename, output_dir).replace(os.sep, "/"),
+            base_dir=output_dir,
+        )
+
+    if cache is None and not check:
+        # nothing needs the whole feature, so compile it statement by statement, straight from the file to the output
+        with open(input_filename) as f, atomic_open(output_filename, "wb" if renderer.binary else "w") as out:
+            gfslang.compile_stream(
+                f,
+                out,
+                renderer,
+                mode=parser_mode,
+                level=optimize,
+                base_dir=os.path.dirname(input_filename),
+                bindings=bindings,
+                source_map=sourcemap,
+                engine=engine,
+            )
+            instrumentation.count("output_bytes", out.tell())
+        if sourcemap is not None:
+            atomic_write(f"{output_filename}.map", sourcemap.dumps())
+        return
+
+    with open(input_filename) as f:
+        source = f.read()
+
+    if cache is None:
+        ast = gfslang.parse(source, mode=parser_mode)
+        compiler = gfslang.Compiler(base_dir=os.path.dirname(input_filename), mode=parser_mode, engine=engine)
+        compiler.track_origins = sourcemap is not None
+        compiled = compiler.compile(ast)
+        if bindings:
+            compiled = gfslang.expand_templates(compiled, bindings)
+        expr = gfslang.optimize(compiled, optimize)
+        if check:
+            check_dependencies(input_filename, expr)
+        with atomic_open(output_filename, "wb" if renderer.binary else "w") as f:
+            with instrumentation.stage("render"):
+                renderer.write(expr, f, sourcemap)
+            instrumentation.count("output_bytes", f.tell())
+        if sourcemap is not None:
+            atomic_write(f"{output_filename}.map", sourcemap.dumps())
+        return
+
+    options = (type(renderer).__name__, parser_mode, optimize, engine)
+    if bindings:
+        options += (repr(bindings),)
+    base_dir = os.path.dirname(input_filename)
+    result = cache.get_output(source, *options, base_dir=base_dir)
+    imported = {}
+    if result is None or check:
+        # even if the output is cached, checking needs the compiled statements (which are cached as well)
+        compiled = cache.compile(input_filename, source, mode=parser_mode, imported=imported, engine=engine)
+        if bindings:
+            compiled = gfslang.expand_templates(compiled, bindings)
+        if check:
+            check_dependencies(input_filename, compiled)
+    if result is None:
+        expr = gfslang.optimize(compiled, optimize)
+        rendered = renderer.render(expr)
+        result = rendered if renderer.binary else rendered.encode()
+        cache.put_output(source, result, *options, base_dir=base_dir, imported=imported)
+
+    atomic_write(output_filename, result if renderer.binary else result.decode())
+
+
+def format_error(input_filename: str, e: Exception) -> str:
+    if isinstance(e, gfslang.errors.GFSLCompileError) and e.line is not None:
+        return f"{input_filename}:{e.line}:{e.column}: {e}"
+    elif isinstance(e, gfslang.errors.GFSLCompileError):
+        return f"{input_filename}: {e}"
+    elif isinstance(e, (lark.exceptions.UnexpectedInput, gfslang.errors.GFSLSyntaxError)):
+        return f"{input_filename}:{e.line}:{e.column}: syntax error\n{e}"
+    return f"{input_filename}: {type(e).__name__}: {e}"
+
+
+def report_errors(
+    input_filename: str, parser_mode: str, error: Exception, engine: str = gfslang.gfs_ast.DEFAULT_ENGINE
+) -> str:
+    """
+    Formats every error in a file that failed to compile with *error*. Compiles stop at the first error, so the file is
+    compiled again, recovering from errors, to find the rest.
+    """
+    try:
+        with open(input_filename) as f:
+            _, diagnostics = gfslang.diagnose(
+                f.read(), mode=parser_mode, base_dir=os.path.dirname(input_filename), engine=engine
+            )
+    except (OSError, UnicodeDecodeError):
+        # the file can no longer be read, so only the original error is reported
+        diagnostics = []
+    return "\n".join(format_error(input_filename, e) for e in diagnostics or [error])
+
+
+def report_worker_errors(
+    input_filename: str, parser_mode: str, error: Exception, engine: str = gfslang.gfs_ast.DEFAULT_ENGINE
+) -> str:
+    """
+    report_errors for a batch worker: if compiling the file again to find every error fails as well (e.g. on a macro
+    expansion budget), only *error* is reported, so that one file cannot abort the whole batch.
+    """
+    try:
+        return report_errors(input_filename, parser_mode, error, engine)
+    except Exception:
+        return format_error(input_filename, error)
+
+
+def check_dependencies(input_filename: str, feature: List[gfslang.gfs_ast.Statement]):
+    """Prints a warning for each dependency cycle and precedence conflict in the compiled feature."""
+    graph = gfslang.dependency_graph(feature)
+    for cycle in graph.cycles():
+        print(
+            f"{input_filename}: warning: targets depend on each other in a cycle: {', '.join(cycle)}", file=sys.stderr
+        )
+    for conflict in graph.conflicts():
+        print(f"{input_filename}: warning: {conflict}", file=sys.stderr)
+
+
+def write_profile(report_filename: str, profiles: Dict[str, instrumentation.Stats]):
+    """Writes the profile of each compiled file and their total as JSON, and prints the total."""
+    total = instrumentation.Stats()
+    for stats in profiles.values():
+        total.merge(stats)
+    report = {"total": total.report(), "files": {filename: stats.report() for filename, stats in profiles.items()}}
+    with open(report_filename, "w") as f:
+        json.dump(report, f, indent=2)
+    print(total.format(), file=sys.stderr)
+
+
+# ==== batch mode ====
+def find_inputs(patterns: List[str]) -> List[str]:
+    """
+    Expands the input arguments into a list of files: directories are searched recursively for .gfs files. Macro
+    libraries that another input imports are left out of the files found in directories or by glob patterns, since
+    compiling them on their own would only write empty outputs (they can still be named explicitly).
+    """
+    filenames = []
+    named = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, "**", "*.gfs"), recursive=True))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            filenames.append(pattern)
+            named.add(pattern)
+            continue
+        filenames.extend(matches)
+    # dedupe, preserving order
+    filenames = list(dict.fromkeys(filenames))
+    imported = set()
+    for filename in filenames:
+        try:
+            imported.update(gfslang.watch.imported_files(filename))
+        except (OSError, UnicodeDecodeError):
+            # reported when the file is compiled
+            pass
+    return [
+        filename
+        for filename in filenames
+        if filename in named or os.path.normpath(os.path.abspath(filename)) not in imported
+    ]
+
+
+_worker_cache: Optional[CompileCache] = None
+
+
+def _init_worker(parser_mode: str, use_cache: bool):
+    """Warms up a batch worker process: builds the parser once, and opens the compile cache."""
+    global _worker_cache
+    gfslang.parser.prepare(parser_mode)
+    _worker_cache = CompileCache() if use_cache else None
+
+
+def _compile_worker(
+    input_filename: str,
+    output_format: str,
+    parser_mode: str,
+    optimize: int,
+    check: bool,
+    profile: bool,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    output_filename: Optional[str] = None,
+    source_map: bool = False,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+) -> Tuple[Optional[str], Optional[instrumentation.Stats]]:
+    """Compiles one file of a batch. Returns an error message if it failed, and its profile if profiling."""
+    renderer = gfslang.renderer.formats[output_format]()
+    if output_filename is None:
+        output_filename = default_output_filename(input_filename, renderer)
+    with instrumentation.profile() if profile else contextlib.nullcontext() as stats:
+        try:
+            with instrumentation.stage("total"):
+                compile_file(
+                    input_filename,
+                    output_filename,
+                    renderer,
+                    parser_mode=parser_mode,
+                    optimize=optimize,
+                    cache=_worker_cache,
+                    check=check,
+                    bindings=bindings,
+                    source_map=source_map,
+                    engine=engine,
+                )
+        except (lark.exceptions.UnexpectedInput, gfslang.errors.GFSLError) as e:
+            return report_worker_errors(input_filename, parser_mode, e, engine), stats
+        except Exception as e:
+            return format_error(input_filename, e), stats
+    return None, stats
+
+
+def compile_batch(
+    input_filenames: List[str],
+    output_format: str,
+    parser_mode: str = gfslang.parser.DEFAULT_PARSER_MODE,
+    optimize: int = gfslang.optimizer.DEFAULT_LEVEL,
+    use_cache: bool = True,
+    check: bool = False,
+    jobs: int = None,
+    profiles: Optional[Dict[str, instrumentation.Stats]] = None,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    source_map: bool = False,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+) -> List[Tuple[str, str]]:
+    """
+    Compiles many files in parallel, writing each output next to its input. A failing file does not stop the batch;
+    returns a list of (input filename, error message) for the files that failed.
+    If *profiles* is given, the profile of each file is stored in it by filename.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    worker = functools.partial(
+        _compile_worker,
+        output_format=output_format,
+        parser_mode=parser_mode,
+        optimize=optimize,
+        check=check,
+        profile=profiles is not None,
+        bindings=bindings,
+        source_map=source_map,
+        engine=engine,
+    )
+    # hand out files in chunks so small files do not pay for a round trip to the pool each
+    chunksize = max(1, len(input_filenames) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(parser_mode, use_cache)
+    ) as pool:
+        errors = []
+        for filename, (error, stats) in zip(input_filenames, pool.map(worker, input_filenames, chunksize=chunksize)):
+            if error is not None:
+                errors.append((filename, error))
+            if profiles is not None:
+                profiles[filename] = stats
+        return errors
+
+
+# ==== link mode ====
+def _link_worker(
+    input_filename: str,
+    parser_mode: str,
+    optimize: int,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+) -> Tuple[Optional[List[gfslang.gfs_ast.Statement]], Optional[str]]:
+    """Compiles one file to link. Returns its optimized statements, or an error message if it failed."""
+    try:
+        with open(input_filename) as f:
+            source = f.read()
+        if _worker_cache is None:
+            ast = gfslang.parse(source, mode=parser_mode)
+            compiler = gfslang.Compiler(base_dir=os.path.dirname(input_filename), mode=parser_mode, engine=engine)
+            compiled = compiler.compile(ast)
+        else:
+            compiled = _worker_cache.compile(input_filename, source, mode=parser_mode, engine=engine)
+        if bindings:
+            compiled = gfslang.expand_templates(compiled, bindings)
+        return gfslang.optimize(compiled, optimize), None
+    except (lark.exceptions.UnexpectedInput, gfslang.errors.GFSLError) as e:
+        return None, report_worker_errors(input_filename, parser_mode, e, engine)
+    except Exception as e:
+        return None, format_error(input_filename, e)
+
+
+def link_batch(
+    input_filenames: List[str],
+    bundle_filename: str,
+    renderer: gfslang.renderer.Renderer,
+    parser_mode: str = gfslang.parser.DEFAULT_PARSER_MODE,
+    optimize: int = gfslang.optimizer.DEFAULT_LEVEL,
+    use_cache: bool = True,
+    check: bool = False,
+    jobs: int = None,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+) -> List[Tuple[str, str]]:
+    """
+    Compiles many files in parallel and links them into one bundle (see gfslang.linker), in the order of the inputs,
+    and prints a warning for each conflict between them. The bundle is only written if every file compiled; returns a
+    list of (input filename, error message) for the files that failed.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    worker = functools.partial(
+        _link_worker, parser_mode=parser_mode, optimize=optimize, bindings=bindings, engine=engine
+    )
+    chunksize = max(1, len(input_filenames) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(parser_mode, use_cache)
+    ) as pool:
+        results = list(pool.map(worker, input_filenames, chunksize=chunksize))
+    errors = [(filename, error) for filename, (_, error) in zip(input_filenames, results) if error is not None]
+    if errors:
+        return errors
+
+    bundle = gfslang.link(zip(input_filenames, (statements for statements, _ in results)))
+    for conflict in bundle.conflicts():
+        print(f"{bundle_filename}: warning: {conflict}", file=sys.stderr)
+    if check:
+        check_dependencies(bundle_filename, bundle.statements)
+    with atomic_open(bundle_filename, "wb" if renderer.binary else "w") as f:
+        renderer.write(bundle.statements, f)
+    print(
+        f"Linked {len(input_filenames)} files into {len(bundle.statements)} statements "
+        f"({bundle.duplicates} duplicates merged).",
+        file=sys.stderr,
+    )
+    return []
+
+
+# ==== watch mode ====
+def watch(
+    patterns: List[str],
+    output_format: str,
+    parser_mode: str = gfslang.parser.DEFAULT_PARSER_MODE,
+    optimize: int = gfslang.optimizer.DEFAULT_LEVEL,
+    use_cache: bool = True,
+    check: bool = False,
+    bindings: Optional[Dict[str, Tuple[str, ...]]] = None,
+    output_filename: Optional[str] = None,
+    source_map: bool = False,
+    engine: str = gfslang.gfs_ast.DEFAULT_ENGINE,
+    debounce: float = 0.01,
+):
+    """
+    Compiles the inputs, then recompiles each input when it changes, along with the inputs that (transitively) import
+    a changed library, until interrupted. Compiles run in this process, so the parser, the compile cache, and the
+    loaded libraries stay warm between them.
+    """
+    _init_worker(parser_mode, use_cache)
+    compile_one = functools.partial(
+        _compile_worker,
+        output_format=output_format,
+        parser_mode=parser_mode,
+        optimize=optimize,
+        check=check,
+        profile=False,
+        bindings=bindings,
+        output_filename=output_filename,
+        source_map=source_map,
+        engine=engine,
+    )
+
+    def rebuild(filenames: Iterable[str]):
+        for filename in filenames:
+            start = time.perf_counter()
+            error, _ = compile_one(filename)
+            if error is not None:
+                print(error, file=sys.stderr)
+            else:
+                print(f"{filename}: compiled in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+
+    # absolute path -> the input as given
+    inputs = {os.path.abspath(filename): filename for filename in find_inputs(patterns)}
+    # absolute path -> the libraries it imports, for the inputs and the libraries they (transitively) import
+    imports: Dict[str, Set[str]] = {}
+    with gfslang.watch.watcher() as watcher:
+
+        def scan(path: str):
+            if not os.path.exists(path):
+                imports.pop(path, None)
+                return
+            try:
+                imports[path] = gfslang.watch.imported_files(path)
+            except (OSError, UnicodeDecodeError):
+                imports[path] = set()
+            for library in imports[path]:
+                watcher.add(os.path.dirname(library), recursive=False)
+                if library not in imports:
+                    scan(library)
+
+        for directory, recursive in watch_roots(patterns):
+            watcher.add(directory, recursive)
+        for path in inputs:
+            scan(path)
+        rebuild(inputs.values())
+        print("Watching for changes...", file=sys.stderr)
+
+        for changed in watcher.changes(debounce):
+            if any(path not in inputs and path not in imports for path in changed):
+                # a file was created (or is not an input)
+                inputs = {os.path.abspath(filename): filename for filename in find_inputs(patterns)}
+            for path in changed:
+                if path in inputs or path in imports:
+                    scan(path)
+            affected = dependents(changed, imports)
+            rebuild(filename for path, filename in inputs.items() if path in affected and os.path.exists(path))
+
+
+def watch_roots(patterns: List[str]) -> List[Tuple[str, bool]]:
+    """The directories to watch for the input arguments, and whether to watch their subdirectories."""
+    roots = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            roots.append((pattern, True))
+        elif glob.has_magic(pattern):
+            # the longest directory without wildcards
+            parts = []
+            for part in os.path.dirname(pattern).split(os.sep):
+                if glob.has_magic(part):
+                    break
+                parts.append(part)
+            roots.append((os.sep.join(parts) or os.curdir, True))
+        else:
+            roots.append((os.path.dirname(pattern) or os.curdir, False))
+    return roots
 
-    ast = gfslang.parse(expr)
-    expr = gfslang.compile(ast)
-    result = gfslang.render_ts(expr)
 
-    with open(output_filename, "w") as f:
-        f.write(result)
+def dependents(changed: Set[str], imports: Dict[str, Set[str]]) -> Set[str]:
+    """The changed files, and the files that (transitively) import them."""
+    importers: Dict[str, Set[str]] = {}
+    for path, libraries in imports.items():
+        for library in libraries:
+            importers.setdefault(library, set()).add(path)
+    affected = set(changed)
+    queue = list(changed)
+    while queue:
+        for importer in importers.get(queue.pop(), ()):
+            if importer not in affected:
+                affected.add(importer)
+                queue.append(importer)
+    return affected
 
 
 if __name__ == "__main__":
@@ -1,7 +1,70 @@
-from .parser import parse
-from .compiler import compile
-from .renderer import TSRenderer
+from typing import IO, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from . import errors, gfs_ast
+from .parser import DEFAULT_PARSER_MODE, parse, parse_lines
+from .compiler import Compiler, compile
+from .optimizer import DEFAULT_LEVEL, Optimizer, optimize
+from .dependencies import DependencyGraph, dependency_graph
+from .evaluator import evaluate, evaluate_batch
+from .codegen import CompiledFeature, compile_feature
+from .instrumentation import profile
+from .linker import Bundle, link
+from .renderer import JSONRenderer, MsgPackRenderer, PythonRenderer, Renderer, TSRenderer
+from .sourcemap import SourceMap
+from .templates import TemplateExpander, expand_templates
 
 
 def render_ts(feature) -> str:
     return TSRenderer().render(feature)
+
+
+def render_json(feature) -> str:
+    return JSONRenderer().render(feature)
+
+
+def render_msgpack(feature) -> bytes:
+    return MsgPackRenderer().render(feature)
+
+
+def compile_stream(
+    lines: Iterable[str],
+    out: IO,
+    renderer: Renderer,
+    mode: str = DEFAULT_PARSER_MODE,
+    level: int = DEFAULT_LEVEL,
+    base_dir: Optional[str] = None,
+    bindings: Optional[Mapping[str, Sequence[str]]] = None,
+    source_map: Optional[SourceMap] = None,
+    engine: str = gfs_ast.DEFAULT_ENGINE,
+):
+    """
+    Parses, compiles, optimizes, and renders a feature one statement at a time, from its lines (e.g. an open file)
+    straight to *out*, so that memory use is bounded by the largest statement rather than the size of the feature.
+    If *bindings* are given, templated targets are expanded for each binding (see gfslang.templates). If a
+    *source_map* is given, the output is mapped back to the source in it (see gfslang.sourcemap). The output only uses
+    the operators that the GFS *engine* supports (see gfs_ast.ENGINES).
+    """
+    compiler = Compiler(base_dir=base_dir, mode=mode, engine=engine)
+    compiler.track_origins = source_map is not None
+    statements = compiler.compile_statements(parse_lines(lines, mode=mode))
+    if bindings:
+        statements = TemplateExpander(bindings).expand_statements(statements)
+    renderer.write_stream(Optimizer(level).optimize_statements(statements), out, source_map)
+
+
+def diagnose(
+    source: str,
+    mode: str = DEFAULT_PARSER_MODE,
+    base_dir: Optional[str] = None,
+    engine: str = gfs_ast.DEFAULT_ENGINE,
+) -> Tuple[List[gfs_ast.Statement], List[errors.GFSLError]]:
+    """
+    Parses and compiles as much of a feature as possible, recovering from errors statement by statement (e.g. to report
+    every error in a file at once). Returns the statements that compiled, and every syntax and compile error in source
+    order.
+    """
+    diagnostics = []
+    feature = parse(source, mode=mode, diagnostics=diagnostics)
+    compiled = Compiler(base_dir=base_dir, mode=mode, engine=engine).compile(feature, diagnostics)
+    diagnostics.sort(key=errors.source_order)
+    return compiled, diagnostics
@@ -0,0 +1,455 @@
+"""
+Incremental compilation: a persistent on-disk cache of compiled files and statements.
+
+Whole files are cached by the hash of their source (and of the macro libraries they import), so unchanged files are not
+recompiled at all. Within a changed file, the compiler works line by line, since every GFSL statement is exactly one
+line:
+
+- only lines whose text changed are parsed, and the rest are summarized by the macros they reference
+- each statement and static macro is fingerprinted by its text plus the fingerprints of every macro it transitively
+  references, so statements whose dependencies did not change are reused without parsing or compiling them again
+
+Everything is stored under a directory keyed by the compiler version (a hash of the gfslang sources, the grammar, and
+the Lark version), so changing the compiler invalidates the cache.
+"""
+import contextlib
+import functools
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, MutableMapping, Optional, Set, Tuple, Union
+
+import lark
+
+from . import errors, gfs_ast, imf_ast, instrumentation
+from .compiler import Compiler
+from .imf_ast import FeatureStatement, set_line
+from .parser import CACHE_DIR, DEFAULT_PARSER_MODE, parse
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """A hash of the gfslang sources, the grammar, and the Lark version."""
+    h = hashlib.sha256(lark.__version__.encode())
+    package_dir = os.path.dirname(__file__)
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith((".py", ".lark")):
+            with open(os.path.join(package_dir, filename), "rb") as f:
+                h.update(filename.encode())
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def digest(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def new_file_mode(filename: str) -> int:
+    """The permissions of an existing file, or else those that open() would create it with under the current umask."""
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except OSError:
+        # the umask can only be read by setting it
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+@contextlib.contextmanager
+def atomic_open(filename: str, mode: str = "w"):
+    """
+    Opens a file for writing by writing to a temporary file next to it and renaming it into place when done, so readers
+    never see a partially written file. The file keeps its permissions if it exists, and otherwise gets the ones open()
+    would give it (mkstemp creates the temporary file readable by its owner only).
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".gfslang-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_filename, new_file_mode(filename))
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_filename)
+        raise
+
+
+def atomic_write(filename: str, data: Union[str, bytes]):
+    with atomic_open(filename, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+
+
+# ==== pickling ====
+# pickle recurses once per level of nesting, and compiled expressions can be deeper than the recursion limit, so the
+# cache pickles gfs_ast expressions as indices into a table of their nodes in post-order instead
+class _ExpressionPickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        # (operator, operands) for each node, with the operands of inner nodes as indices into the table
+        self.table: List[Tuple[gfs_ast.ExpressionOperators, Any]] = []
+        self._indices: Dict[gfs_ast.Expression, int] = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, gfs_ast.Expression):
+            return None
+        stack = [obj]
+        while stack:
+            node = stack[-1]
+            if node in self._indices:
+                stack.pop()
+                continue
+            if isinstance(node.operands, tuple):
+                pending = [operand for operand in node.operands if operand not in self._indices]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                operands = tuple(self._indices[operand] for operand in node.operands)
+            else:
+                operands = node.operands
+            stack.pop()
+            self._indices[node] = len(self.table)
+            self.table.append((node.operator, operands))
+        return self._indices[obj]
+
+
+class _ExpressionUnpickler(pickle.Unpickler):
+    def __init__(self, file, nodes: List[gfs_ast.Expression]):
+        super().__init__(file)
+        self.nodes = nodes
+
+    def persistent_load(self, pid):
+        return self.nodes[pid]
+
+
+def pickle_dumps(obj) -> bytes:
+    """Pickles an object that may contain (arbitrarily deep) gfs_ast expressions."""
+    out = io.BytesIO()
+    pickler = _ExpressionPickler(out)
+    pickler.dump(obj)
+    return pickle.dumps((pickler.table, out.getvalue()), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_loads(data: bytes):
+    """Unpickles an object pickled by pickle_dumps, re-interning its expressions."""
+    table, data = pickle.loads(data)
+    nodes = []
+    for operator, operands in table:
+        if isinstance(operands, tuple):
+            operands = [nodes[i] for i in operands]
+        nodes.append(gfs_ast.Expression(operator, operands))
+    return _ExpressionUnpickler(io.BytesIO(data), nodes).load()
+
+
+def sources_current(sources: Dict[str, str]) -> bool:
+    """Whether every file in *sources* (path -> digest of its source) still has the same source."""
+    for path, source_digest in sources.items():
+        try:
+            with open(path) as f:
+                if digest(f.read()) != source_digest:
+                    return False
+        except OSError:
+            return False
+    return True
+
+
+# ==== line summaries ====
+def references(expr: imf_ast.Expression, bound: FrozenSet[str] = frozenset()) -> Tuple[Set[str], Set[str]]:
+    """
+    Returns the names of the static macros and functional macros that an expression references directly (i.e. not
+    through the body of a functional macro). Names in *bound* are functional macro arguments, not static macros.
+    """
+    macros = set()
+    func_macros = set()
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, imf_ast.Macro):
+            if node.name not in bound:
+                macros.add(node.name)
+        elif isinstance(node, imf_ast.MacroCall):
+            func_macros.add(node.name)
+            stack.extend(node.args)
+        elif isinstance(node, imf_ast.BinOp):
+            stack.append(node.left)
+            stack.append(node.right)
+        elif isinstance(node, imf_ast.Call):
+            stack.extend(node.args)
+        elif isinstance(node, imf_ast.Ternary):
+            stack.extend((node.condition, node.true, node.false))
+    return macros, func_macros
+
+
+class LineSummary:
+    """What the incremental compiler needs to know about a line of source without parsing it again."""
+
+    __slots__ = ("kind", "identifier", "macros", "func_macros")
+
+    STATEMENT = "statement"
+    MACRO = "macro"
+    FUNCTIONAL_MACRO = "fmacro"
+    IMPORT = "import"
+
+    def __init__(self, kind: str, identifier: Optional[str], macros: FrozenSet[str], func_macros: FrozenSet[str]):
+        self.kind = kind
+        self.identifier = identifier
+        self.macros = macros
+        self.func_macros = func_macros
+
+    @classmethod
+    def from_statement(cls, stmt: FeatureStatement):
+        if isinstance(stmt, imf_ast.Import):
+            return cls(cls.IMPORT, stmt.path, frozenset(), frozenset())
+        if isinstance(stmt, imf_ast.FunctionalMacroDef):
+            macros, func_macros = references(stmt.expression, bound=frozenset(stmt.args))
+            return cls(cls.FUNCTIONAL_MACRO, stmt.identifier, frozenset(macros), frozenset(func_macros))
+        macros, func_macros = references(stmt.expression)
+        if isinstance(stmt, imf_ast.MacroDef):
+            return cls(cls.MACRO, stmt.identifier, frozenset(macros), frozenset(func_macros))
+        return cls(cls.STATEMENT, None, frozenset(macros), frozenset(func_macros))
+
+
+# ==== statement-level reuse ====
+class CachingCompiler(Compiler):
+    """
+    A compiler that works on summarized source lines, and reuses the previously compiled statements and static macros
+    whose fingerprints are in *cache*. Lines are only parsed if they have to be compiled.
+    After compiling, *used* contains the fingerprints of everything in this feature, to persist for the next compile.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[MutableMapping[str, Any]] = None,
+        base_dir: Optional[str] = None,
+        mode: str = DEFAULT_PARSER_MODE,
+        engine: str = gfs_ast.DEFAULT_ENGINE,
+    ):
+        super().__init__(base_dir=base_dir, mode=mode, engine=engine)
+        self.cache = cache if cache is not None else {}
+        self.used: Dict[str, Any] = {}
+        self.hits = 0
+        self.misses = 0
+        self.macro_fingerprints: Dict[str, str] = {}
+        self.fmacro_fingerprints: Dict[str, str] = {}
+        self._fmacro_summaries: Dict[str, LineSummary] = {}
+        self._fmacro_closures: Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]] = {}
+        # functional macros that have been defined, but not parsed yet: name -> (lineno, text)
+        self._unparsed_fmacros: Dict[str, Tuple[int, str]] = {}
+
+    def compile_lines(
+        self,
+        lines: Iterable[Tuple[int, str, LineSummary, Optional[FeatureStatement]]],
+        parse_line: Callable[[int, str], FeatureStatement],
+    ) -> List[gfs_ast.Statement]:
+        """
+        Compiles a feature given as (line number, text, summary, parsed statement or None) for each statement line.
+        *parse_line* is called to parse the lines that were not parsed already, if they need to be compiled.
+        """
+        out = []
+        for lineno, text, summary, stmt in lines:
+            if summary.kind == LineSummary.IMPORT:
+                # libraries are precompiled already; the macros they define are fingerprinted by the library's sources
+                library = self.compile_import(stmt if stmt is not None else parse_line(lineno, text))
+                for identifier in library.macros:
+                    self.macro_fingerprints[identifier] = digest(library.fingerprint, identifier)
+                for identifier, fmacro_def in library.func_macros.items():
+                    self._fmacro_summaries[identifier] = LineSummary.from_statement(fmacro_def)
+                    self.fmacro_fingerprints[identifier] = digest(library.fingerprint, identifier)
+                    self._unparsed_fmacros.pop(identifier, None)
+                self._fmacro_closures.clear()
+                continue
+
+            if summary.kind == LineSummary.FUNCTIONAL_MACRO:
+                self._fmacro_summaries[summary.identifier] = summary
+                self._fmacro_closures.clear()
+                self.fmacro_fingerprints[summary.identifier] = digest(text)
+                if stmt is None:
+                    self._unparsed_fmacros[summary.identifier] = (lineno, text)
+                else:
+                    self._unparsed_fmacros.pop(summary.identifier, None)
+                    self.compile_fmacro_def(stmt)
+                continue
+
+            macros, func_macros = self.dependencies(summary)
+            fingerprint = digest(
+                self.engine,
+                text,
+                tuple((name, self.macro_fingerprints.get(name)) for name in sorted(macros)),
+                tuple((name, self.fmacro_fingerprints.get(name)) for name in sorted(func_macros)),
+            )
+            if fingerprint in self.cache:
+                self.hits += 1
+                compiled = self.cache[fingerprint]
+                if summary.kind == LineSummary.MACRO:
+                    self.define_macro(summary.identifier, compiled)
+            else:
+                self.misses += 1
+                if stmt is None:
+                    stmt = parse_line(lineno, text)
+                for name in func_macros:
+                    if name in self._unparsed_fmacros:
+                        self.compile_fmacro_def(parse_line(*self._unparsed_fmacros.pop(name)))
+                if summary.kind == LineSummary.MACRO:
+                    self.compile_macro_def(stmt)
+                    compiled = self.macros[summary.identifier]
+                else:
+                    compiled = self.compile_statement(stmt)
+            self.used[fingerprint] = compiled
+            if summary.kind == LineSummary.MACRO:
+                self.macro_fingerprints[summary.identifier] = fingerprint
+            else:
+                out.append(compiled)
+        return out
+
+    # ==== dependency tracking ====
+    def dependencies(self, summary: LineSummary) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """
+        Returns the names of the static macros and functional macros that a line transitively references, given the
+        macros defined so far.
+        """
+        macros = set(summary.macros)
+        func_macros = set()
+        for name in summary.func_macros:
+            fmacro_macros, fmacro_func_macros = self._fmacro_closure(name)
+            macros.update(fmacro_macros)
+            func_macros.update(fmacro_func_macros)
+        return frozenset(macros), frozenset(func_macros)
+
+    def _fmacro_closure(self, name: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        if name in self._fmacro_closures:
+            return self._fmacro_closures[name]
+        macros = set()
+        func_macros = {name}
+        stack = [name]
+        while stack:
+            summary = self._fmacro_summaries.get(stack.pop())
+            if summary is None:
+                continue
+            macros.update(summary.macros)
+            for called in summary.func_macros - func_macros:
+                func_macros.add(called)
+                stack.append(called)
+        closure = self._fmacro_closures[name] = (frozenset(macros), frozenset(func_macros))
+        return closure
+
+
+# ==== on-disk storage ====
+class CompileCache:
+    """
+    The persistent cache used by gfsc: rendered outputs keyed by source hash and directory, and the line summaries and
+    compiled statements of each source file from its last compile.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        if directory is None:
+            directory = os.path.join(CACHE_DIR, "compile", compiler_version())
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "outputs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "files"), exist_ok=True)
+
+    def _output_path(self, source: str, base_dir: Optional[str], options: Tuple[str, ...]) -> str:
+        # imports are relative to the directory of the source, so the same source elsewhere can import other libraries
+        directory = os.path.abspath(base_dir or os.curdir)
+        return os.path.join(self.directory, "outputs", digest(source, directory, options))
+
+    def _file_state_path(self, filename: str) -> str:
+        return os.path.join(self.directory, "files", f"{digest(os.path.abspath(filename))}.pickle")
+
+    def get_output(self, source: str, *options: str, base_dir: Optional[str] = None) -> Optional[bytes]:
+        """
+        Returns the cached output for this source in *base_dir* (its directory, which its imports are relative to)
+        compiled with these options (e.g. output format), if any (and if none of the libraries it imported changed).
+        """
+        try:
+            with open(self._output_path(source, base_dir, options), "rb") as f:
+                imported, output = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        if not sources_current(imported):
+            return None
+        instrumentation.count("cached_outputs")
+        return output
+
+    def put_output(
+        self,
+        source: str,
+        output: bytes,
+        *options: str,
+        base_dir: Optional[str] = None,
+        imported: Optional[Dict[str, str]] = None,
+    ):
+        """Caches an output. *imported* are the libraries the source imported (see Compiler.imported)."""
+        data = pickle.dumps((imported or {}, output), protocol=pickle.HIGHEST_PROTOCOL)
+        atomic_write(self._output_path(source, base_dir, options), data)
+
+    def load_file_state(self, filename: str) -> Tuple[Dict[str, LineSummary], Dict[str, Any]]:
+        """
+        Returns the line summaries (line text -> summary) and the fingerprinted compiled statements and macros from
+        the last compile of the given file.
+        """
+        try:
+            with open(self._file_state_path(filename), "rb") as f:
+                return pickle_loads(f.read())
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+            return {}, {}
+
+    def save_file_state(self, filename: str, summaries: Dict[str, LineSummary], compiled: Dict[str, Any]):
+        data = pickle_dumps((summaries, compiled))
+        atomic_write(self._file_state_path(filename), data)
+
+    def compile(
+        self,
+        filename: str,
+        source: str,
+        mode: str = DEFAULT_PARSER_MODE,
+        imported: Optional[Dict[str, str]] = None,
+        engine: str = gfs_ast.DEFAULT_ENGINE,
+    ) -> List[gfs_ast.Statement]:
+        """
+        Parses and compiles the source of the given file for the GFS *engine*, reusing every line and statement that
+        did not change since the last time this file was compiled. If *imported* is given, the libraries that the file
+        imported are added to it (see Compiler.imported).
+        """
+        base_dir = os.path.dirname(filename)
+        summaries, compiled = self.load_file_state(filename)
+
+        def parse_line(lineno: int, text: str) -> Optional[FeatureStatement]:
+            line_feature = parse(text, mode=mode)
+            if not line_feature.statements:
+                return None
+            stmt = line_feature.statements[0]
+            if lineno != 1:
+                set_line(stmt, lineno)
+            return stmt
+
+        lines = []
+        new_summaries = {}
+        for lineno, line in enumerate(source.split("\n"), start=1):
+            # leading whitespace is kept so that columns are still correct
+            text = line.rstrip()
+            if not text or text.lstrip().startswith("#"):
+                continue
+            stmt = None
+            summary = summaries.get(text)
+            if summary is None:
+                try:
+                    stmt = parse_line(lineno, text)
+                except (lark.exceptions.LarkError, errors.GFSLSyntaxError):
+                    # reparse the whole file so that the error is raised with the right position and context
+                    return Compiler(base_dir=base_dir, mode=mode, engine=engine).compile(parse(source, mode=mode))
+                if stmt is None:
+                    continue
+                summary = LineSummary.from_statement(stmt)
+            new_summaries[text] = summary
+            lines.append((lineno, text, summary, stmt))
+
+        compiler = CachingCompiler(compiled, base_dir=base_dir, mode=mode, engine=engine)
+        with instrumentation.stage("compile"):
+            out = compiler.compile_lines(lines, parse_line)
+        if imported is not None:
+            imported.update(compiler.imported)
+        instrumentation.count("cached_statements", compiler.hits)
+        self.save_file_state(filename, new_summaries, compiler.used)
+        return out
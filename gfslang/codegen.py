@@ -0,0 +1,243 @@
+"""
+Compiling features to Python: the statements of a feature are generated as the source of a Python module with one
+straight-line function that applies them, so that evaluating a feature runs native Python code instead of dispatching
+on each node's operator like the evaluator does. The generated function has the same semantics as the evaluator
+(gfslang.evaluator).
+
+The generated module can be written to disk (``gfsc.py --format py`` writes it next to the other outputs) and loaded
+with load(), which imports it like any other module, so that Python caches its bytecode in ``__pycache__``. Or the
+source can be compiled in memory with compile_feature():
+
+    >>> compiled = gfslang.codegen.compile_feature(feature)
+    >>> apply = compiled.bind({"statName": "strength"})
+    >>> apply({"attributes.strength.value": 14})
+    {'attributes.strength.value': 14, 'attributes.strength.mod': 2}
+
+In the generated function, each statement reads the targets it depends on from the state, computes its value in one
+expression, and stores it. Subexpressions that a statement uses more than once (expressions are hash-consed) are
+computed once into a local variable, as are subexpressions nested deeper than max_nesting, so that the generated
+source never nests deeper than the Python compiler allows.
+"""
+import functools
+import importlib.util
+import io
+import math
+import os
+from typing import Any, Callable, Dict, List, Mapping, Optional, TextIO, Tuple
+
+from . import gfs_ast, instrumentation
+from .evaluator import Evaluator, compile_program
+
+Ops = gfs_ast.ExpressionOperators
+
+# the version of the generated code; loading a module that was generated by a different version is an error
+VERSION = 1
+
+
+# the runtime functions that generated modules import; rounding leaves infinities and NaN as they are, like JavaScript
+def floor(value):
+    return math.floor(value) if math.isfinite(value) else value
+
+
+def ceil(value):
+    return math.ceil(value) if math.isfinite(value) else value
+
+
+def round_half_up(value):
+    """Rounds like JavaScript's Math.round: halves round up."""
+    return math.floor(value + 0.5) if math.isfinite(value) else value
+
+
+class CodeGenerator:
+    """Generates the source of a Python module that applies a feature's statements (see the module docstring)."""
+
+    # operator -> a template for its Python expression, given its operands' expressions
+    templates: Dict[gfs_ast.ExpressionOperators, Callable[[List[str]], str]] = {
+        Ops.ADD: lambda operands: f"({' + '.join(operands)})",
+        Ops.MULTIPLY: lambda operands: f"({' * '.join(operands)})",
+        Ops.MIN: lambda operands: f"min({', '.join(operands)})",
+        Ops.MAX: lambda operands: f"max({', '.join(operands)})",
+        Ops.FLOOR: lambda operands: f"floor({operands[0]})",
+        Ops.SUBTRACT: lambda operands: f"({operands[0]} - {operands[1]})",
+        Ops.DIVIDE: lambda operands: f"divide({operands[0]}, {operands[1]})",
+        Ops.CEIL: lambda operands: f"ceil({operands[0]})",
+        Ops.ROUND: lambda operands: f"round_half_up({operands[0]})",
+        Ops.ABS: lambda operands: f"abs({operands[0]})",
+    }
+    # comparisons evaluate to 1 or 0, but the conditions of IFs can use them as they are
+    comparisons = {
+        Ops.EQUAL: "==",
+        Ops.NOT_EQUAL: "!=",
+        Ops.LESS_THAN: "<",
+        Ops.LESS_THAN_OR_EQUAL: "<=",
+        Ops.GREATER_THAN: ">",
+        Ops.GREATER_THAN_OR_EQUAL: ">=",
+    }
+    # the operators that can take any number of operands (and are the identity with one)
+    variadic_operators = frozenset((Ops.ADD, Ops.MULTIPLY, Ops.MIN, Ops.MAX))
+    # for the comment before each statement
+    statement_operators = {
+        gfs_ast.StatementOperators.SET: "=",
+        gfs_ast.StatementOperators.PUSH: "++",
+    }
+
+    # the deepest an expression is nested in a statement before it is computed into a local variable instead (CPython
+    # only allows 200 nested parentheses)
+    max_nesting = 32
+    indent = " " * 4
+
+    def generate(self, feature: List[gfs_ast.Statement]) -> str:
+        out = io.StringIO()
+        self.write(feature, out)
+        return out.getvalue()
+
+    def write(self, feature: List[gfs_ast.Statement], out: TextIO):
+        # statements apply in precedence order, then in source order (sorted is stable), like in the evaluator
+        feature = sorted(feature, key=lambda stmt: stmt.precedence)
+        # target -> its index in TARGETS
+        targets: Dict[str, int] = {}
+        body = io.StringIO()
+        for stmt in feature:
+            self.write_statement(body, stmt, targets)
+
+        out.write("# Generated by gfslang from a compiled feature; do not edit.\n")
+        out.write("from math import inf, nan\n\n")
+        out.write("from gfslang.codegen import ceil, floor, round_half_up\n")
+        out.write("from gfslang.evaluator import divide\n\n")
+        out.write(f"VERSION = {VERSION}\n")
+        out.write("TARGETS = (\n")
+        for target in targets:
+            out.write(f"{self.indent}{target!r},\n")
+        out.write(")\n\n\n")
+        out.write("def evaluate(targets, default, state):\n")
+        out.write(f"{self.indent}state = dict(state)\n")
+        out.write(f"{self.indent}get = state.get\n")
+        if targets:
+            # unpacking the resolved targets into locals once is faster than indexing the tuple in every statement
+            names = ", ".join(f"t{i}" for i in targets.values())
+            out.write(f"{self.indent}{names}{',' if len(targets) == 1 else ''} = targets\n")
+        out.write(body.getvalue())
+        out.write(f"{self.indent}return state\n")
+
+    def write_statement(self, out: TextIO, stmt: gfs_ast.Statement, targets: Dict[str, int]):
+        out.write(f"{self.indent}# {stmt.precedence}: {stmt.target!r} {self.statement_operators[stmt.operator]}\n")
+        program = compile_program(stmt.operand)
+        uses = [0] * len(program)
+        for _, args in program:
+            if isinstance(args, tuple):
+                for i in args:
+                    uses[i] += 1
+
+        # instruction index -> (its Python expression, how deeply it is nested)
+        expressions: List[Tuple[str, int]] = []
+        # instruction index -> the boolean expression of a comparison that is only used once
+        conditions: Dict[int, str] = {}
+        local_count = 0
+        for i, (op, args) in enumerate(program):
+            if op is Ops.STATIC_VALUE:
+                expressions.append((self.literal(args), 0))
+                continue
+            if op is Ops.DYNAMIC_VALUE:
+                target = f"t{targets.setdefault(args, len(targets))}"
+                expression, depth = f"get({target}, default)", 0
+            elif op in self.comparisons:
+                (left, left_depth), (right, right_depth) = (expressions[arg] for arg in args)
+                condition = f"{left} {self.comparisons[op]} {right}"
+                expression, depth = f"(1 if {condition} else 0)", 1 + max(left_depth, right_depth)
+                if uses[i] == 1 and depth < self.max_nesting:
+                    conditions[i] = condition
+            elif op is Ops.IF:
+                condition, true, false = (expressions[arg] for arg in args)
+                text = conditions.get(args[0], condition[0])
+                expression = f"({true[0]} if {text} else {false[0]})"
+                depth = 1 + max(condition[1], true[1], false[1])
+            elif op in self.templates:
+                if not args:
+                    raise ValueError(f"Cannot generate code for {op.name} without operands")
+                operands = [expressions[arg] for arg in args]
+                if len(operands) == 1 and op in self.variadic_operators:
+                    expression, depth = operands[0]
+                else:
+                    expression = self.templates[op]([expression for expression, _ in operands])
+                    depth = 1 + max(depth for _, depth in operands)
+            else:
+                raise ValueError(f"Cannot generate code for the {op.name} operator")
+            if i < len(program) - 1 and (uses[i] > 1 or depth >= self.max_nesting):
+                # shared (or deeply nested) subexpressions are computed once, before the statement
+                name = f"v{local_count}"
+                local_count += 1
+                out.write(f"{self.indent}{name} = {expression}\n")
+                expression, depth = name, 0
+            expressions.append((expression, depth))
+
+        target = f"t{targets.setdefault(stmt.target, len(targets))}"
+        value = expressions[-1][0]
+        if stmt.operator is gfs_ast.StatementOperators.SET:
+            out.write(f"{self.indent}state[{target}] = {value}\n")
+        else:
+            out.write(f"{self.indent}state[{target}] = [*get({target}, ()), {value}]\n")
+
+    @staticmethod
+    def literal(value) -> str:
+        # the reprs of infinity and NaN are the names that generated modules import
+        text = repr(value)
+        return f"({text})" if text.startswith("-") else text
+
+
+class CompiledFeature:
+    """
+    A feature compiled to a Python function. *targets* are the targets of the feature's statements as written (with
+    ``${name}`` placeholders), and *function* is the generated ``evaluate(targets, default, state)``.
+    """
+
+    def __init__(self, targets: Tuple[str, ...], function: Callable[..., Dict[str, Any]]):
+        self.targets = targets
+        self.function = function
+
+    @classmethod
+    def from_namespace(cls, namespace: Mapping[str, Any]) -> "CompiledFeature":
+        version = namespace.get("VERSION")
+        if version != VERSION:
+            raise ValueError(f"The module was generated by version {version} of the code generator, expected {VERSION}")
+        return cls(namespace["TARGETS"], namespace["evaluate"])
+
+    def bind(self, variables: Optional[Mapping[str, Any]] = None, default: Any = 0) -> Callable[..., Dict[str, Any]]:
+        """
+        Returns a function that applies the feature to a character state, like Evaluator.evaluate, with the targets
+        resolved from *variables* ahead of time. Targets that have not been set evaluate to *default*.
+        """
+        targets = tuple(map(Evaluator(variables).resolve_target, self.targets))
+        return functools.partial(self.function, targets, default)
+
+    def evaluate(
+        self, state: Mapping[str, Any], variables: Optional[Mapping[str, Any]] = None, default: Any = 0
+    ) -> Dict[str, Any]:
+        """Applies the feature to the character state. Returns the new state; *state* is not modified."""
+        return self.bind(variables, default)(state)
+
+
+def generate(feature: List[gfs_ast.Statement]) -> str:
+    return CodeGenerator().generate(feature)
+
+
+def compile_feature(feature: List[gfs_ast.Statement], filename: str = "<gfsl>") -> CompiledFeature:
+    """Generates the Python code for the feature and compiles it in memory."""
+    with instrumentation.stage("codegen"):
+        source = generate(feature)
+        namespace = {}
+        exec(compile(source, filename, "exec"), namespace)
+    return CompiledFeature.from_namespace(namespace)
+
+
+def load(filename: str) -> CompiledFeature:
+    """
+    Loads a module that was generated for a feature (e.g. by ``gfsc.py --format py``). Like any imported module, its
+    bytecode is cached in ``__pycache__`` next to it, so it is only compiled again when it changes.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    spec = importlib.util.spec_from_file_location(name, filename)
+    if spec is None:
+        raise ImportError(f"Cannot load {filename!r} as a Python module", path=filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return CompiledFeature.from_namespace(vars(module))
@@ -1,11 +1,44 @@
-import contextlib
+import collections
+import itertools
 import math
 import operator
-from typing import Dict, List, TypeVar, Union
+import os
+import time
+import types
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-from . import errors, gfs_ast, imf_ast
+import lark
+
+from . import errors, gfs_ast, imf_ast, instrumentation
+from .parser import DEFAULT_PARSER_MODE
+
+if TYPE_CHECKING:
+    from .library import MacroLibrary
 
 _ExprT = TypeVar("_ExprT", bound=imf_ast.Expression)
+# a macro namespace: the global static macros, possibly with the arguments of the functional macros being expanded
+# chained in front of them
+Scope = Mapping[str, gfs_ast.Expression]
+# expression handlers either return a compiled expression, or are generators that yield (node, scope) pairs to compile
+# and are sent back the compiled result (see Compiler.compile_expression)
+CompileStep = Generator[
+    Tuple[Union[imf_ast.Ternary, imf_ast.Expression], Scope], gfs_ast.Expression, gfs_ast.Expression
+]
+# a memoized expansion: (macro name, compiled args, the caller's bindings of the names it reads from the caller's scope)
+ExpansionKey = Tuple[str, Tuple[gfs_ast.Expression, ...], Tuple[Tuple[str, gfs_ast.Expression], ...]]
 
 
 class Compiler:
@@ -13,6 +46,19 @@ class Compiler:
         "min": gfs_ast.ExpressionOperators.MIN,
         "max": gfs_ast.ExpressionOperators.MAX,
         "floor": gfs_ast.ExpressionOperators.FLOOR,
+        "ceil": gfs_ast.ExpressionOperators.CEIL,
+        "round": gfs_ast.ExpressionOperators.ROUND,
+        "abs": gfs_ast.ExpressionOperators.ABS,
+    }
+    # calls that take exactly one argument, and are lowered to base operators if the engine does not have their own
+    unary_calls = {"ceil", "round", "abs"}
+    comparison_operators = {
+        "==": gfs_ast.ExpressionOperators.EQUAL,
+        "!=": gfs_ast.ExpressionOperators.NOT_EQUAL,
+        "<": gfs_ast.ExpressionOperators.LESS_THAN,
+        "<=": gfs_ast.ExpressionOperators.LESS_THAN_OR_EQUAL,
+        ">": gfs_ast.ExpressionOperators.GREATER_THAN,
+        ">=": gfs_ast.ExpressionOperators.GREATER_THAN_OR_EQUAL,
     }
     # static arithmetic optimizations
     arithmetic_operators = {
@@ -21,18 +67,71 @@ class Compiler:
         "*": operator.mul,
         "/": operator.truediv,
         "//": operator.floordiv,
+        # comparisons evaluate to 1 or 0
+        "==": lambda left, right: int(left == right),
+        "!=": lambda left, right: int(left != right),
+        "<": lambda left, right: int(left < right),
+        "<=": lambda left, right: int(left <= right),
+        ">": lambda left, right: int(left > right),
+        ">=": lambda left, right: int(left >= right),
     }
     arithmetic_calls = {
         "min": min,
         "max": max,
         "floor": math.floor,
+        "ceil": math.ceil,
+        # like JavaScript's Math.round, halves round up
+        "round": lambda value: math.floor(value + 0.5),
+        "abs": abs,
     }
 
-    def __init__(self):
+    # budgets against runaway macro expansion (e.g. a recursive macro without a reachable base case), per top-level
+    # expression: the nesting of macro expansions, the nodes compiled while expanding macros, and the time spent
+    max_expansion_depth = 10_000
+    max_expanded_nodes = 1_000_000
+    max_expansion_seconds: Optional[float] = None
+    # whether compiled statements record where their nodes came from (see gfs_ast.Statement.origins), for source maps
+    track_origins = False
+    # bounds the memoized expansions while compiling a stream of statements (see compile_statements)
+    max_streamed_expansions = 4096
+
+    def __init__(
+        self,
+        base_dir: Optional[str] = None,
+        mode: str = DEFAULT_PARSER_MODE,
+        importing: Tuple[str, ...] = (),
+        engine: str = gfs_ast.DEFAULT_ENGINE,
+    ):
+        # imports are relative to *base_dir* (the directory of the compiled file), and parsed with the parser *mode*
+        # *importing* are the absolute paths of the libraries being imported while compiling this one
+        # the output only uses the operators that the GFS *engine* supports (see gfs_ast.ENGINES)
+        if engine not in gfs_ast.ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {list(gfs_ast.ENGINES)}")
+        self.base_dir = base_dir
+        self.mode = mode
+        self.importing = importing
+        self.engine = engine
+        self.operators = gfs_ast.ENGINES[engine]
+        # absolute path -> source digest of every imported library (see MacroLibrary.dependencies)
+        self.imported: Dict[str, str] = {}
         self.macros: Dict[str, gfs_ast.Expression] = {}
         self.func_macros: Dict[str, imf_ast.FunctionalMacroDef] = {}
+        # functional macro name -> the library that defines it (None if defined in the compiled file)
+        self.fmacro_sources: Dict[str, Optional[str]] = {}
+        # memoized functional macro expansions
+        # compiled expressions are interned, so this is keyed on the args' structure
+        self.expansion_cache: Dict[ExpansionKey, gfs_ast.Expression] = {}
+        self._expanding: Set[ExpansionKey] = set()
+        # functional macro name -> the names its expansion reads from its caller's scope (see free_macro_names)
+        self._free_names: Dict[str, Tuple[str, ...]] = {}
+        # the macro calls being expanded, outermost first
+        self._expansion_calls: List[imf_ast.MacroCall] = []
+        # the macros whose definitions failed to compile while recovering from errors (see compile)
+        self.failed_macros: Set[str] = set()
+        self.failed_func_macros: Set[str] = set()
 
         self.expr_handlers = {
+            imf_ast.Ternary: self.compile_ternary,
             imf_ast.BinOp: self.compile_binop,
             imf_ast.Call: self.compile_call,
             imf_ast.Literal: self.compile_literal,
@@ -41,35 +140,147 @@ class Compiler:
             imf_ast.MacroCall: self.compile_macro_call,
         }
 
-    def compile(self, feature: imf_ast.Feature) -> List[gfs_ast.Statement]:
+    def compile(
+        self, feature: imf_ast.Feature, diagnostics: Optional[List[errors.GFSLCompileError]] = None
+    ) -> List[gfs_ast.Statement]:
+        """
+        Compiles a feature. If a *diagnostics* list is given, compilation recovers from errors: a statement that fails
+        to compile is left out and its error appended to *diagnostics*, and the rest of the feature is compiled, so
+        that every error is reported at once. Errors that only follow from an earlier error (e.g. a use of a macro
+        whose definition failed to compile) are not reported again.
+        """
         out = []
-        for stmt in feature.statements:
-            if isinstance(stmt, imf_ast.FunctionalMacroDef):
-                self.compile_fmacro_def(stmt)
-            elif isinstance(stmt, imf_ast.MacroDef):
-                self.compile_macro_def(stmt)
-            else:
-                out.append(self.compile_statement(stmt))
+        with instrumentation.stage("compile"):
+            for stmt in feature.statements:
+                try:
+                    compiled = self.compile_feature_statement(stmt)
+                except errors.GFSLCompileError as e:
+                    if diagnostics is None:
+                        raise
+                    self.recover(stmt, e, diagnostics)
+                    continue
+                if compiled is not None:
+                    out.append(compiled)
         return out
 
+    def compile_statements(
+        self,
+        statements: Iterable[imf_ast.FeatureStatement],
+        diagnostics: Optional[List[errors.GFSLCompileError]] = None,
+    ) -> Iterator[gfs_ast.Statement]:
+        """
+        Compiles a stream of top-level statements (e.g. from parser.parse_lines), yielding each rule statement as soon
+        as it is compiled; imports and macro definitions update the macros in order. The memoized functional macro
+        expansions are dropped whenever there are more than max_streamed_expansions of them, so that memory does not
+        grow with the length of the feature. Errors are recovered from as in compile if a *diagnostics* list is given.
+        """
+        for stmt in statements:
+            with instrumentation.stage("compile"):
+                try:
+                    compiled = self.compile_feature_statement(stmt)
+                except errors.GFSLCompileError as e:
+                    if diagnostics is None:
+                        raise
+                    self.recover(stmt, e, diagnostics)
+                    compiled = None
+                if len(self.expansion_cache) > self.max_streamed_expansions:
+                    self.expansion_cache.clear()
+            if compiled is not None:
+                yield compiled
+
+    def recover(
+        self, stmt: imf_ast.FeatureStatement, error: errors.GFSLCompileError, diagnostics: List[errors.GFSLCompileError]
+    ):
+        """Records the error of a statement that failed to compile, and moves on to the next statement."""
+        if isinstance(stmt, imf_ast.FunctionalMacroDef):
+            self.failed_func_macros.add(stmt.identifier)
+        elif isinstance(stmt, imf_ast.MacroDef):
+            self.failed_macros.add(stmt.identifier)
+        if isinstance(error, _FailedMacroError):
+            return
+        # an error in a functional macro's body is raised at the body, once for every call that expands it
+        for reported in diagnostics:
+            if (reported.line, reported.column, str(reported)) == (error.line, error.column, str(error)):
+                return
+        diagnostics.append(error)
+
+    def compile_feature_statement(self, stmt: imf_ast.FeatureStatement) -> Optional[gfs_ast.Statement]:
+        """Compiles a top-level statement. Returns the compiled statement, or None for imports and macro definitions."""
+        if isinstance(stmt, imf_ast.Import):
+            self.compile_import(stmt)
+        elif isinstance(stmt, imf_ast.FunctionalMacroDef):
+            self.compile_fmacro_def(stmt)
+        elif isinstance(stmt, imf_ast.MacroDef):
+            self.compile_macro_def(stmt)
+        else:
+            return self.compile_statement(stmt)
+        return None
+
+    # ==== imports ====
+    def compile_import(self, import_stmt: imf_ast.Import) -> "MacroLibrary":
+        # the library module compiles libraries with this compiler
+        from .library import load_library
+
+        path = os.path.abspath(os.path.join(self.base_dir or "", import_stmt.path))
+        if path in self.importing:
+            raise errors.GFSLCompileError(f"Circular import of {import_stmt.path!r}", node=import_stmt)
+        try:
+            library = load_library(path, mode=self.mode, importing=self.importing, engine=self.engine)
+        except OSError as e:
+            raise errors.GFSLCompileError(f"Cannot import {import_stmt.path!r}: {e.strerror}", node=import_stmt)
+        except errors.GFSLCompileError as e:
+            raise errors.GFSLCompileError(f"In {import_stmt.path}:{e.line}:{e.column}: {e}", node=import_stmt) from e
+        except (lark.exceptions.UnexpectedInput, errors.GFSLSyntaxError) as e:
+            raise errors.GFSLCompileError(
+                f"In {import_stmt.path}:{e.line}:{e.column}: syntax error", node=import_stmt
+            ) from e
+        self.use_library(library)
+        return library
+
+    def use_library(self, library: "MacroLibrary"):
+        """Defines the macros of a precompiled library."""
+        for identifier, compiled in library.macros.items():
+            self.define_macro(identifier, compiled)
+        for fmacro_def in library.func_macros.values():
+            self.compile_fmacro_def(fmacro_def)
+            self.fmacro_sources[fmacro_def.identifier] = library.sources.get(fmacro_def.identifier)
+        self.imported.update(library.dependencies)
+
     # ==== macros ====
     def compile_fmacro_def(self, fmacro_def: imf_ast.FunctionalMacroDef):
         if not len(set(fmacro_def.args)) == len(fmacro_def.args):
             raise errors.GFSLCompileError(f"Functional macro argument names must be unique", node=fmacro_def)
+        if fmacro_def.identifier in self.func_macros:
+            self.expansion_cache.clear()
         self.func_macros[fmacro_def.identifier] = fmacro_def
+        self._free_names.clear()
+        self.fmacro_sources[fmacro_def.identifier] = None
+        self.failed_func_macros.discard(fmacro_def.identifier)
 
     def compile_macro_def(self, macro_def: imf_ast.MacroDef):
-        self.macros[macro_def.identifier] = self.compile_expression(macro_def.expression)
+        self.define_macro(macro_def.identifier, self.compile_expression(macro_def.expression))
+
+    def define_macro(self, identifier: str, compiled: gfs_ast.Expression):
+        # redefining a macro can change the result of any expansion that referenced it
+        if identifier in self.macros:
+            self.expansion_cache.clear()
+        self.macros[identifier] = compiled
+        self.failed_macros.discard(identifier)
 
-    def evaluate_maybe_ternary(self, expr: Union[imf_ast.Ternary, imf_ast.Expression]):
-        if isinstance(expr, imf_ast.Ternary):
-            condition = self.evaluate_maybe_ternary(expr.condition)
-            if not isinstance(condition, gfs_ast.StaticExpression):
-                raise errors.GFSLCompileError(f"Cannot use dynamic expressions in compiler macro ternaries", node=expr)
+    def compile_ternary(self, expr: imf_ast.Ternary, scope: Scope) -> CompileStep:
+        condition = yield expr.condition, scope
+        if isinstance(condition, gfs_ast.StaticExpression):
             if condition.operands:
-                return self.evaluate_maybe_ternary(expr.true)
-            return self.evaluate_maybe_ternary(expr.false)
-        return self.compile_expression(expr)
+                return (yield expr.true, scope)
+            return (yield expr.false, scope)
+        if gfs_ast.ExpressionOperators.IF not in self.operators:
+            raise errors.GFSLCompileError(f"Cannot use dynamic expressions in compiler macro ternaries", node=expr)
+        # the engine picks the branch, so both are compiled (a recursive macro needs a static base case)
+        true = yield expr.true, scope
+        false = yield expr.false, scope
+        if true is false:
+            return true
+        return gfs_ast.Expression(operator=gfs_ast.ExpressionOperators.IF, operands=[condition, true, false])
 
     # ==== GFS statements ====
     def compile_statement(self, stmt: imf_ast.Statement) -> gfs_ast.Statement:
@@ -79,27 +290,130 @@ class Compiler:
             op = gfs_ast.StatementOperators.PUSH
         else:
             raise errors.GFSLFatalCompileError(f"Unknown statement operator: {stmt.op!r}", node=stmt)
-        expr = self.compile_expression(stmt.expression)
-        return gfs_ast.Statement(precedence=stmt.precedence, target=stmt.target, operator=op, operand=expr)
-
-    def compile_expression(self, expr: _ExprT) -> gfs_ast.Expression:
-        handler = self.expr_handlers.get(type(expr))
-        if handler is None:
-            raise errors.GFSLFatalCompileError(
-                f"No compilation step defined for IMF node of type {type(expr)}", node=expr
-            )
-        # noinspection PyArgumentList
-        # pycharm does not like the type narrowing here
-        return handler(expr)
+        if not self.track_origins:
+            expr = self.compile_expression(stmt.expression)
+            return gfs_ast.Statement(precedence=stmt.precedence, target=stmt.target, operator=op, operand=expr)
+        origins = {}
+        expr = self.compile_expression(stmt.expression, origins=origins)
+        origin = gfs_ast.Origin(None, stmt.line, stmt.column, stmt.end_line, stmt.end_column)
+        return gfs_ast.Statement(
+            precedence=stmt.precedence, target=stmt.target, operator=op, operand=expr, origin=origin, origins=origins
+        )
+
+    def compile_expression(
+        self,
+        expr: _ExprT,
+        scope: Optional[Scope] = None,
+        origins: Optional[Dict[gfs_ast.Expression, gfs_ast.Origin]] = None,
+    ) -> gfs_ast.Expression:
+        """
+        Compiles an IMF expression in the given macro scope (the global static macros by default).
 
-    def compile_binop(self, binop: imf_ast.BinOp) -> gfs_ast.Expression:
-        left = self.compile_expression(binop.left)
-        right = self.compile_expression(binop.right)
+        Handlers that need their children compiled are generators that yield the children and are sent back the
+        results. Those generators are driven from an explicit stack here instead of recursing, so deeply recursive
+        macros are only limited by the expansion budgets (*max_expansion_depth*, *max_expanded_nodes*, and
+        *max_expansion_seconds*), not Python's recursion limit. If compiling fails (e.g. a budget is exceeded), the
+        expansions memoized while compiling it are forgotten.
+
+        If an *origins* dict is given, each compiled node is mapped to where it was compiled from in it. Since nodes are
+        compiled bottom-up, a node that several nested IMF nodes compile to (e.g. a macro call's expansion) comes from
+        the outermost one.
+        """
+        if scope is None:
+            scope = self.macros
+        stack: List[CompileStep] = []
+        # the IMF nodes of the pending handlers, if tracking origins
+        pending: List[imf_ast.Node] = []
+        result = None
+        node = expr
+        expanded_nodes = 0
+        deadline = None if self.max_expansion_seconds is None else time.monotonic() + self.max_expansion_seconds
+        memoized = len(self.expansion_cache)
+        try:
+            while True:
+                if node is not None:
+                    # start compiling a new node
+                    handler = self.expr_handlers.get(type(node))
+                    if handler is None:
+                        raise errors.GFSLFatalCompileError(
+                            f"No compilation step defined for IMF node of type {type(node)}", node=node
+                        )
+                    # noinspection PyArgumentList
+                    # pycharm does not like the type narrowing here
+                    step = handler(node, scope)
+                    if self._expansion_calls:
+                        expanded_nodes += 1
+                        if expanded_nodes > self.max_expanded_nodes:
+                            outermost = self._expansion_calls[0]
+                            raise errors.GFSLCompileError(
+                                f"Macro expansion budget exceeded: !{outermost.name}() expands to more than "
+                                f"{self.max_expanded_nodes} nodes",
+                                node=outermost,
+                            )
+                        if deadline is not None and not expanded_nodes % 1024 and time.monotonic() > deadline:
+                            outermost = self._expansion_calls[0]
+                            raise errors.GFSLCompileError(
+                                f"Macro expansion time limit exceeded: !{outermost.name}() took more than "
+                                f"{self.max_expansion_seconds} seconds to expand",
+                                node=outermost,
+                            )
+                    if isinstance(step, types.GeneratorType):
+                        stack.append(step)
+                        if origins is not None:
+                            pending.append(node)
+                        result = None
+                    else:
+                        result = step
+                        if origins is not None:
+                            origins[result] = self.origin(node)
+                if not stack:
+                    return result
+                # resume the innermost pending handler with the result of its last request
+                try:
+                    node, scope = stack[-1].send(result)
+                except StopIteration as e:
+                    stack.pop()
+                    result = e.value
+                    node = None
+                    if origins is not None:
+                        origins[result] = self.origin(pending.pop())
+        except errors.GFSLCompileError:
+            # expansions are memoized in order, and the cache is only cleared between top-level expressions
+            for key in list(itertools.islice(self.expansion_cache, memoized, None)):
+                del self.expansion_cache[key]
+            raise
+        finally:
+            # if compilation failed, unwind the pending handlers so their cleanup runs now
+            for step in reversed(stack):
+                step.close()
+
+    def origin(self, node: imf_ast.Node) -> gfs_ast.Origin:
+        """Where a node being compiled is: in the body of the innermost macro being expanded, if any."""
+        expansions = []
+        source = None
+        for call in self._expansion_calls:
+            expansions.append((call.name, call.line, call.column, source))
+            source = self.fmacro_sources.get(call.name)
+        return gfs_ast.Origin(source, node.line, node.column, node.end_line, node.end_column, tuple(expansions))
+
+    def compile_binop(self, binop: imf_ast.BinOp, scope: Scope) -> CompileStep:
+        left = yield binop.left, scope
+        right = yield binop.right, scope
         op = binop.op
         match left, op, right:
+            case (_, "/" | "//", gfs_ast.StaticExpression(0)):
+                raise errors.GFSLCompileError("Cannot divide by zero", node=binop)
             # --- simple math: both sides are static, we just evaluate it here ---
             case (gfs_ast.StaticExpression(left), op, gfs_ast.StaticExpression(right)):
+                instrumentation.count("constant_folds")
                 return gfs_ast.StaticExpression(self.arithmetic_operators[op](left, right))
+            case (left, op, right) if op in self.comparison_operators:
+                comparison = self.comparison_operators[op]
+                if comparison not in self.operators:
+                    raise errors.GFSLCompileError(
+                        f"Comparing dynamic expressions is not supported by the {self.engine} engine", node=binop
+                    )
+                return gfs_ast.Expression(operator=comparison, operands=[left, right])
             # --- special cases ---
             case (left, "-", gfs_ast.StaticExpression(right)):
                 # since subtraction is not implemented, compile "a - 1" to "a + (-1)" (literals only)
@@ -108,6 +422,11 @@ class Compiler:
                     operator=gfs_ast.ExpressionOperators.ADD,
                     operands=[left, right_unfurled],
                 )
+            case (left, "-", right) if gfs_ast.ExpressionOperators.SUBTRACT in self.operators:
+                return gfs_ast.Expression(
+                    operator=gfs_ast.ExpressionOperators.SUBTRACT,
+                    operands=[left, right],
+                )
             case (left, "-", right):
                 # since subtraction is not implemented, compile "a - b" to "a + (b * -1)"
                 negative_right = gfs_ast.Expression(
@@ -118,7 +437,9 @@ class Compiler:
                     operator=gfs_ast.ExpressionOperators.ADD,
                     operands=[left, negative_right],
                 )
-            case (left, "/", gfs_ast.StaticExpression(right)):
+            case (left, "/", gfs_ast.StaticExpression(right)) if (
+                gfs_ast.ExpressionOperators.DIVIDE not in self.operators
+            ):
                 # since division is not implemented, compile "a / 2" to "a * eval(1/2)" (literals only)
                 if right == 0:
                     raise errors.GFSLCompileError("Cannot divide by zero", node=binop)
@@ -127,7 +448,9 @@ class Compiler:
                     operator=gfs_ast.ExpressionOperators.MULTIPLY,
                     operands=[left, right_recip],
                 )
-            case (left, "//", gfs_ast.StaticExpression(right)):
+            case (left, "//", gfs_ast.StaticExpression(right)) if (
+                gfs_ast.ExpressionOperators.DIVIDE not in self.operators
+            ):
                 # since floor division is not implemented, compile "a // 2" to "floor(a * eval(1/2))" (literals only)
                 if right == 0:
                     raise errors.GFSLCompileError("Cannot divide by zero", node=binop)
@@ -140,6 +463,21 @@ class Compiler:
                     operator=gfs_ast.ExpressionOperators.FLOOR,
                     operands=[floor_arg],
                 )
+            case (left, "/" | "//", right) if gfs_ast.ExpressionOperators.DIVIDE in self.operators:
+                # a native division is exact where multiplying by the reciprocal is not (e.g. 49 * (1/49) < 1)
+                if isinstance(right, gfs_ast.StaticExpression) and right.operands == 1:
+                    quotient = left
+                else:
+                    quotient = gfs_ast.Expression(
+                        operator=gfs_ast.ExpressionOperators.DIVIDE,
+                        operands=[left, right],
+                    )
+                if op == "/":
+                    return quotient
+                return gfs_ast.Expression(
+                    operator=gfs_ast.ExpressionOperators.FLOOR,
+                    operands=[quotient],
+                )
             case (_, "/" | "//", _):
                 # cannot divide by dynamic expression
                 raise errors.GFSLCompileError("Dividing by a dynamic expression is not allowed in the GFS", node=binop)
@@ -168,55 +506,172 @@ class Compiler:
             f"Unhandled binary operator pattern: {type(left).__name__} {op!r} {type(right).__name__}", node=binop
         )
 
-    def compile_call(self, call: imf_ast.Call) -> gfs_ast.Expression:
+    def compile_call(self, call: imf_ast.Call, scope: Scope) -> CompileStep:
         if call.name not in self.valid_calls:
             raise errors.GFSLCompileError(f"Function !{call.name} is not defined", node=call)
-        args = [self.compile_expression(arg) for arg in call.args]
+        if call.name in self.unary_calls and len(call.args) != 1:
+            raise errors.GFSLCompileError(f"Function {call.name}() takes exactly one argument", node=call)
+        args = []
+        for arg in call.args:
+            args.append((yield arg, scope))
         # simple math: all args are static and we know how to evaluate the arithmetic function
         if all(isinstance(arg, gfs_ast.StaticExpression) for arg in args) and call.name in self.arithmetic_calls:
+            instrumentation.count("constant_folds")
             return gfs_ast.StaticExpression(self.arithmetic_calls[call.name](*(arg.operands for arg in args)))
-        return gfs_ast.Expression(operator=self.valid_calls[call.name], operands=args)
+        op = self.valid_calls[call.name]
+        if op not in self.operators:
+            return self.lower_call(op, args[0])
+        return gfs_ast.Expression(operator=op, operands=args)
+
+    @staticmethod
+    def lower_call(op: gfs_ast.ExpressionOperators, arg: gfs_ast.Expression) -> gfs_ast.Expression:
+        """Compiles ceil, round, and abs to base operators, for engines that do not have their operators."""
+        negated = gfs_ast.Expression(
+            operator=gfs_ast.ExpressionOperators.MULTIPLY, operands=[arg, gfs_ast.StaticExpression(-1)]
+        )
+        if op is gfs_ast.ExpressionOperators.CEIL:
+            # ceil(a) == floor(a * -1) * -1
+            floored = gfs_ast.Expression(operator=gfs_ast.ExpressionOperators.FLOOR, operands=[negated])
+            return gfs_ast.Expression(
+                operator=gfs_ast.ExpressionOperators.MULTIPLY, operands=[floored, gfs_ast.StaticExpression(-1)]
+            )
+        if op is gfs_ast.ExpressionOperators.ROUND:
+            # round(a) == floor(a + 0.5)
+            shifted = gfs_ast.Expression(
+                operator=gfs_ast.ExpressionOperators.ADD, operands=[arg, gfs_ast.StaticExpression(0.5)]
+            )
+            return gfs_ast.Expression(operator=gfs_ast.ExpressionOperators.FLOOR, operands=[shifted])
+        # abs(a) == max(a, a * -1)
+        return gfs_ast.Expression(operator=gfs_ast.ExpressionOperators.MAX, operands=[arg, negated])
 
     @staticmethod
-    def compile_literal(literal: imf_ast.Literal) -> gfs_ast.Expression:
+    def compile_literal(literal: imf_ast.Literal, _: Scope) -> gfs_ast.Expression:
         return gfs_ast.StaticExpression(literal.value)
 
     @staticmethod
-    def compile_target(target: imf_ast.Target) -> gfs_ast.Expression:
+    def compile_target(target: imf_ast.Target, _: Scope) -> gfs_ast.Expression:
         return gfs_ast.Expression(operator=gfs_ast.ExpressionOperators.DYNAMIC_VALUE, operands=target.target)
 
-    def compile_macro(self, macro: imf_ast.Macro) -> gfs_ast.Expression:
-        if macro.name in self.macros:
-            return self.macros[macro.name]
+    def compile_macro(self, macro: imf_ast.Macro, scope: Scope) -> gfs_ast.Expression:
+        if macro.name in scope:
+            return scope[macro.name]
+        if macro.name in self.failed_macros:
+            raise _FailedMacroError(f"Macro !{macro.name} failed to compile", node=macro)
         raise errors.GFSLCompileError(f"Macro !{macro.name} is not defined", node=macro)
 
-    @contextlib.contextmanager
     def _bind_fmacro_namespace(
-        self, fmacro: imf_ast.FunctionalMacroDef, args: List[gfs_ast.Expression], calling_node: imf_ast.MacroCall
-    ):
+        self,
+        fmacro: imf_ast.FunctionalMacroDef,
+        args: List[gfs_ast.Expression],
+        caller: Mapping[str, gfs_ast.Expression],
+        calling_node: imf_ast.MacroCall,
+    ) -> Scope:
         if len(args) != len(fmacro.args):
             raise errors.GFSLCompileError(
                 f"Incorrect number of arguments passed to !{fmacro.identifier}(): expected {len(fmacro.args)}, "
                 f"got {len(args)}",
                 node=calling_node,
             )
-        old_ns = self.macros.copy()
-        for arg_name, arg in zip(fmacro.args, args):
-            self.macros[arg_name] = arg
-        try:
-            yield
-        finally:
-            self.macros = old_ns
+        # the macro body sees its own arguments, then the arguments bound by its callers, then the global macros; the
+        # bound arguments are kept in one dict so that lookups do not slow down as expansions nest
+        return collections.ChainMap({**caller, **dict(zip(fmacro.args, args))}, self.macros)
+
+    def free_macro_names(self, identifier: str) -> Tuple[str, ...]:
+        """
+        The names that expanding a functional macro can read from its caller's scope: the macros used in its body, or
+        in the bodies of the macros it (transitively) calls, that are not bound by its own arguments.
+        """
+        if identifier in self._free_names:
+            return self._free_names[identifier]
+        # the macros used and called in the body of each functional macro reachable from this one
+        uses: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        queue = [identifier]
+        while queue:
+            name = queue.pop()
+            if name in uses or name not in self.func_macros:
+                continue
+            used, called = set(), set()
+            nodes: List[imf_ast.Node] = [self.func_macros[name].expression]
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, imf_ast.Macro):
+                    used.add(node.name)
+                elif isinstance(node, imf_ast.MacroCall):
+                    called.add(node.name)
+                for _, value in node.fields():
+                    if isinstance(value, imf_ast.Node):
+                        nodes.append(value)
+                    elif isinstance(value, list):
+                        nodes.extend(elem for elem in value if isinstance(elem, imf_ast.Node))
+            uses[name] = used, called
+            queue.extend(called)
+
+        # a callee's free names are looked up in its caller's scope, so they are free in the caller unless it binds them
+        free = {name: used - set(self.func_macros[name].args) for name, (used, _) in uses.items()}
+        changed = True
+        while changed:
+            changed = False
+            for name, (_, called) in uses.items():
+                bound = set(self.func_macros[name].args)
+                for callee in called:
+                    new = free.get(callee, set()) - bound - free[name]
+                    if new:
+                        free[name] |= new
+                        changed = True
+        for name, names in free.items():
+            self._free_names[name] = tuple(sorted(names))
+        return self._free_names[identifier]
 
-    def compile_macro_call(self, macro_call: imf_ast.MacroCall) -> gfs_ast.Expression:
+    def compile_macro_call(self, macro_call: imf_ast.MacroCall, scope: Scope) -> CompileStep:
         if macro_call.name not in self.func_macros:
+            if macro_call.name in self.failed_func_macros:
+                raise _FailedMacroError(f"Macro !{macro_call.name}() failed to compile", node=macro_call)
             raise errors.GFSLCompileError(f"Macro !{macro_call.name}() is not defined", node=macro_call)
         fmacro = self.func_macros[macro_call.name]
-        args = [self.compile_expression(arg) for arg in macro_call.args]
-        # now, we bind the args to the macro's args and compile the macro
-        with self._bind_fmacro_namespace(fmacro, args, calling_node=macro_call):
-            return self.evaluate_maybe_ternary(fmacro.expression)
+        args = []
+        for arg in macro_call.args:
+            args.append((yield arg, scope))
+        # the arguments bound by the calling macros, if this is called from inside a macro body
+        caller = scope.maps[0] if isinstance(scope, collections.ChainMap) else {}
+        # now, we bind the args to the macro's args and compile the macro (or reuse an identical expansion: one with the
+        # same args, called where the names the expansion reads from its caller's scope are bound to the same values)
+        macro_scope = self._bind_fmacro_namespace(fmacro, args, caller, calling_node=macro_call)
+        free = tuple((name, caller[name]) for name in self.free_macro_names(fmacro.identifier) if name in caller)
+        key = (fmacro.identifier, tuple(args), free)
+        if key in self.expansion_cache:
+            instrumentation.count("macro_expansion_cache_hits")
+            return self.expansion_cache[key]
+        if key in self._expanding:
+            raise errors.GFSLCompileError(
+                f"Infinite recursion: !{fmacro.identifier}() expands to a call to itself with the same arguments",
+                node=macro_call,
+            )
+        if len(self._expansion_calls) >= self.max_expansion_depth:
+            outermost = self._expansion_calls[0]
+            raise errors.GFSLCompileError(
+                f"Maximum macro expansion depth exceeded: !{outermost.name}() expands to more than "
+                f"{self.max_expansion_depth} nested macro calls (the innermost is !{macro_call.name}())",
+                node=outermost,
+            )
+        instrumentation.count("macro_expansions")
+        self._expanding.add(key)
+        self._expansion_calls.append(macro_call)
+        try:
+            result = yield fmacro.expression, macro_scope
+        finally:
+            self._expanding.discard(key)
+            self._expansion_calls.pop()
+        self.expansion_cache[key] = result
+        return result
+
+
+class _FailedMacroError(errors.GFSLCompileError):
+    """A use of a macro whose definition failed to compile, which was already reported."""
+
+    pass
 
 
-def compile(feature: imf_ast.Feature) -> List[gfs_ast.Statement]:
-    return Compiler().compile(feature)
+def compile(
+    feature: imf_ast.Feature, base_dir: Optional[str] = None, engine: str = gfs_ast.DEFAULT_ENGINE
+) -> List[gfs_ast.Statement]:
+    return Compiler(base_dir=base_dir, engine=engine).compile(feature)
@@ -0,0 +1,232 @@
+"""
+Dependency analysis of compiled features: which targets each statement reads and writes, and what that implies about
+the order statements have to be applied in.
+
+Statements are applied in precedence order (statements with equal precedence apply in source order), like the
+evaluator does. A statement depends on the earlier statements that write a target it reads, on the earlier statements
+that write its own target (their order decides the result), and on the earlier statements that read its target (they
+have to see the value from before it is written). Grouping statements by those dependencies gives the groups of
+independent statements that could be applied together, and lets a changed target only recompute the statements
+downstream of it.
+
+The analysis also finds targets that depend on each other in a cycle (e.g. ``a = b + 1`` and ``b = a + 1``), and
+precedence conflicts: two SETs of the same target at the same precedence, and statements that read a target before a
+later statement writes it.
+"""
+import warnings
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from . import gfs_ast
+from .errors import GFSLWarning
+
+
+def dynamic_targets(expr: gfs_ast.Expression, cache: Optional[Dict[gfs_ast.Expression, FrozenSet[str]]] = None):
+    """Returns the targets that an expression reads. Expressions are hash-consed, so *cache* can be shared."""
+    if cache is None:
+        cache = {}
+    # iterative post-order, since compiled expressions can be deeper than the recursion limit
+    stack = [expr]
+    while stack:
+        node = stack[-1]
+        if node in cache:
+            stack.pop()
+            continue
+        if node.operator is gfs_ast.ExpressionOperators.DYNAMIC_VALUE:
+            cache[node] = frozenset((node.operands,))
+            stack.pop()
+            continue
+        if not isinstance(node.operands, tuple):
+            cache[node] = frozenset()
+            stack.pop()
+            continue
+        pending = [operand for operand in node.operands if operand not in cache]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        cache[node] = frozenset().union(*(cache[operand] for operand in node.operands))
+    return cache[expr]
+
+
+class DependencyGraph:
+    """
+    The read/write dependencies of a compiled feature. Statements are indexed by their position in evaluation order
+    (*statements*).
+
+    *resolve_target* maps a statement's target string to the name it is stored under (e.g. substituting ``${name}``
+    placeholders, see Evaluator.resolve_target); by default targets are compared as written.
+    """
+
+    def __init__(self, feature: List[gfs_ast.Statement], resolve_target: Optional[Callable[[str], str]] = None):
+        if resolve_target is None:
+            resolve_target = str
+        self.statements = sorted(feature, key=lambda stmt: stmt.precedence)
+        self.reads: List[FrozenSet[str]] = []
+        self.writes: List[str] = []
+        # target -> the indices of the statements that read/write it, in evaluation order
+        self.readers: Dict[str, List[int]] = {}
+        self.writers: Dict[str, List[int]] = {}
+
+        reads_cache = {}
+        for i, stmt in enumerate(self.statements):
+            reads = frozenset(resolve_target(target) for target in dynamic_targets(stmt.operand, reads_cache))
+            write = resolve_target(stmt.target)
+            self.reads.append(reads)
+            self.writes.append(write)
+            for target in reads:
+                self.readers.setdefault(target, []).append(i)
+            self.writers.setdefault(write, []).append(i)
+
+    # ==== scheduling ====
+    def levels(self) -> List[int]:
+        """
+        Returns the level of each statement: one more than the highest level of the statements it depends on (or 0).
+        Statements of the same level do not depend on each other.
+        """
+        levels = []
+        # target -> level of its last writer, and the highest level that read it since then
+        write_levels: Dict[str, int] = {}
+        read_levels: Dict[str, int] = {}
+        for reads, write in zip(self.reads, self.writes):
+            level = max(
+                (
+                    write_levels.get(write, -1),
+                    read_levels.get(write, -1),
+                    *(write_levels.get(target, -1) for target in reads),
+                )
+            )
+            level += 1
+            for target in reads:
+                read_levels[target] = max(read_levels.get(target, -1), level)
+            write_levels[write] = level
+            read_levels.pop(write, None)
+            levels.append(level)
+        return levels
+
+    def groups(self) -> List[List[gfs_ast.Statement]]:
+        """
+        Returns the statements in groups of independent statements: applying the groups in order, and the statements
+        of each group in any order (or at the same time), gives the same result as applying the feature.
+        """
+        groups = []
+        for stmt, level in zip(self.statements, self.levels()):
+            if level == len(groups):
+                groups.append([])
+            groups[level].append(stmt)
+        return groups
+
+    def downstream(self, changed: Iterable[str]) -> Tuple[Set[str], List[int]]:
+        """
+        Returns the targets whose values may change if the given targets change in the input state, and the indices of
+        the statements that have to be applied again to recompute them (in evaluation order).
+
+        Every statement that writes one of those targets is included, so that the targets can be recomputed starting
+        from their value in the input state.
+        """
+        dirty_targets = set(changed)
+        dirty = set()
+        queue = list(dirty_targets)
+        while queue:
+            target = queue.pop()
+            for i in (*self.readers.get(target, ()), *self.writers.get(target, ())):
+                if i in dirty:
+                    continue
+                dirty.add(i)
+                # a statement that is applied again needs the value that its reads had at the time it was applied:
+                # a read target that is written later has to be recomputed from the start as well
+                affected = [self.writes[i]]
+                affected.extend(target for target in self.reads[i] if self.writers.get(target, (-1,))[-1] > i)
+                for affected_target in affected:
+                    if affected_target not in dirty_targets:
+                        dirty_targets.add(affected_target)
+                        queue.append(affected_target)
+        return dirty_targets, sorted(dirty)
+
+    # ==== diagnostics ====
+    def cycles(self) -> List[List[str]]:
+        """
+        Returns the groups of targets that depend on each other in a cycle, i.e. the strongly connected components of
+        the graph of target -> the targets read to compute it. A statement that reads its own target (e.g.
+        ``speed = speed + 5``) modifies the target in place, and is not a cycle on its own.
+        """
+        edges: Dict[str, Set[str]] = {}
+        for reads, write in zip(self.reads, self.writes):
+            edges.setdefault(write, set()).update(target for target in reads if target != write)
+
+        # iterative Tarjan's algorithm
+        index: Dict[str, int] = {}
+        lowlink: Dict[str, int] = {}
+        on_stack: Set[str] = set()
+        stack: List[str] = []
+        components = []
+        for root in edges:
+            if root in index:
+                continue
+            work = [(root, iter(sorted(edges.get(root, ()))))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(edges.get(child, ())))))
+                        break
+                    if child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1:
+                            components.append(sorted(component))
+        return components
+
+    def conflicts(self) -> List[str]:
+        """Returns a description of each precedence conflict in the feature."""
+        conflicts = []
+        for target, writers in self.writers.items():
+            sets = [i for i in writers if self.statements[i].operator is gfs_ast.StatementOperators.SET]
+            for first, second in zip(sets, sets[1:]):
+                precedence = self.statements[first].precedence
+                if precedence == self.statements[second].precedence:
+                    conflicts.append(
+                        f"{target!r} is set more than once at precedence {precedence}; the result depends on the "
+                        f"order of the statements in the source"
+                    )
+        for target, readers in self.readers.items():
+            last_write = self.writers.get(target, (-1,))[-1]
+            for i in readers:
+                if i < last_write and self.writes[i] != target:
+                    conflicts.append(
+                        f"{self.describe(i)} reads {target!r} before {self.describe(last_write)} writes it"
+                    )
+        return conflicts
+
+    def check(self):
+        """Issues a GFSLWarning for each dependency cycle and precedence conflict."""
+        for cycle in self.cycles():
+            warnings.warn(f"Targets depend on each other in a cycle: {', '.join(cycle)}", GFSLWarning, stacklevel=2)
+        for conflict in self.conflicts():
+            warnings.warn(conflict, GFSLWarning, stacklevel=2)
+
+    def describe(self, i: int) -> str:
+        stmt = self.statements[i]
+        op = "=" if stmt.operator is gfs_ast.StatementOperators.SET else "++"
+        return f"'{stmt.precedence}: {stmt.target} {op} ...'"
+
+
+def dependency_graph(feature: List[gfs_ast.Statement]) -> DependencyGraph:
+    return DependencyGraph(feature)
@@ -1,3 +1,6 @@
+from typing import Tuple
+
+
 class GFSLError(Exception):
     """Base error in GFSLang."""
 
@@ -7,21 +10,41 @@ class GFSLError(Exception):
 class GFSLSyntaxError(GFSLError):
     """Invalid syntax somewhere."""
 
-    pass
+    def __init__(self, msg, line, column):
+        super().__init__(msg)
+        self.line = line
+        self.column = column
 
 
 class GFSLCompileError(GFSLError):
-    """Something happened during compilation."""
+    """Something happened during compilation, at *node* (an IMF node or gfs_ast.Origin), or None if unknown."""
 
     def __init__(self, msg, node):
         super().__init__(msg)
-        self.line = node.line
-        self.column = node.column
-        self.end_line = node.end_line
-        self.end_column = node.end_column
+        self.line = node.line if node is not None else None
+        self.column = node.column if node is not None else None
+        self.end_line = node.end_line if node is not None else None
+        self.end_column = node.end_column if node is not None else None
 
 
 class GFSLFatalCompileError(GFSLCompileError):
     """Something went wrong during compilation, and it's the compiler's fault."""
 
     pass
+
+
+class GFSLEvaluationError(GFSLError):
+    """Something went wrong while evaluating a compiled feature."""
+
+    pass
+
+
+class GFSLWarning(UserWarning):
+    """Something in a feature is valid, but probably not what was intended."""
+
+    pass
+
+
+def source_order(error: GFSLError) -> Tuple[bool, int, int]:
+    """A sort key for errors with a line and column (which can be None): by position, with unknown positions last."""
+    return error.line is None, error.line or 0, error.column or 0
@@ -0,0 +1,282 @@
+"""
+The evaluator is a reference implementation of the GFS engine in Python: it applies a compiled feature's statements to
+a character state, so that rule sets can be tested and profiled without the production engine.
+
+A character state is a flat mapping of target names (e.g. ``"attributes.strength.value"``) to values. Statements are
+applied in precedence order (statements with equal precedence apply in source order); ``SET`` statements replace the
+value of their target, and ``PUSH`` statements append to the list at their target. Targets that have not been set
+evaluate to 0.
+
+``${name}`` placeholders in targets are substituted from the *variables* mapping, e.g. ``attributes.${statName}.value``
+with ``{"statName": "strength"}``.
+
+When only a few targets of a character's state change, ``Evaluator.update`` recomputes the previous result by applying
+only the statements downstream of the changed targets (see gfslang.dependencies).
+
+The batched evaluator evaluates one feature against many character states at once. Its states are columnar: a mapping
+of target names to NumPy arrays with one element per character. NumPy is only needed for the batched evaluator.
+"""
+import functools
+import math
+import operator
+import string
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+from . import gfs_ast
+from .dependencies import DependencyGraph
+from .errors import GFSLEvaluationError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Ops = gfs_ast.ExpressionOperators
+
+
+def divide(left, right):
+    """Divides like JavaScript (and so the GFS engine): dividing by zero is infinite (or NaN for 0 / 0)."""
+    if right == 0:
+        return math.copysign(math.inf, left) if left else math.nan
+    return left / right
+
+
+def rounding(function: Callable[[float], int]) -> Callable[[List[Any]], Any]:
+    """A rounding operation that leaves infinities and NaN as they are, like JavaScript."""
+    return lambda values: function(values[0]) if math.isfinite(values[0]) else values[0]
+
+
+def batch_divide(left, right):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.divide(left, right)
+
+
+# an instruction is (operator, args): args are the indices of earlier instructions' results, or the literal operand
+# for static and dynamic values
+Instruction = Tuple[gfs_ast.ExpressionOperators, Union[Tuple[int, ...], str, int, float]]
+
+
+def compile_program(expr: gfs_ast.Expression) -> List[Instruction]:
+    """
+    Flattens an expression into a list of instructions in dependency order, where each instruction's result is stored
+    at its index. Shared subtrees (expressions are hash-consed) become a single instruction that is evaluated once.
+    """
+    program: List[Instruction] = []
+    index: Dict[gfs_ast.Expression, int] = {}
+    # iterative post-order, since compiled expressions can be deeper than the recursion limit
+    stack = [expr]
+    while stack:
+        node = stack[-1]
+        if node in index:
+            stack.pop()
+            continue
+        if not isinstance(node.operands, tuple):
+            index[node] = len(program)
+            program.append((node.operator, node.operands))
+            stack.pop()
+            continue
+        pending = [operand for operand in node.operands if operand not in index]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        index[node] = len(program)
+        program.append((node.operator, tuple(index[operand] for operand in node.operands)))
+    return program
+
+
+class Evaluator:
+    """Evaluates compiled features against a single character state."""
+
+    operations: Dict[gfs_ast.ExpressionOperators, Callable[[List[Any]], Any]] = {
+        Ops.ADD: lambda values: functools.reduce(operator.add, values),
+        Ops.MULTIPLY: lambda values: functools.reduce(operator.mul, values),
+        Ops.MIN: min,
+        Ops.MAX: max,
+        Ops.FLOOR: rounding(math.floor),
+        Ops.SUBTRACT: lambda values: values[0] - values[1],
+        Ops.DIVIDE: lambda values: divide(values[0], values[1]),
+        Ops.CEIL: rounding(math.ceil),
+        # like JavaScript's Math.round, halves round up
+        Ops.ROUND: rounding(lambda value: math.floor(value + 0.5)),
+        Ops.ABS: lambda values: abs(values[0]),
+        Ops.EQUAL: lambda values: int(values[0] == values[1]),
+        Ops.NOT_EQUAL: lambda values: int(values[0] != values[1]),
+        Ops.LESS_THAN: lambda values: int(values[0] < values[1]),
+        Ops.LESS_THAN_OR_EQUAL: lambda values: int(values[0] <= values[1]),
+        Ops.GREATER_THAN: lambda values: int(values[0] > values[1]),
+        Ops.GREATER_THAN_OR_EQUAL: lambda values: int(values[0] >= values[1]),
+        Ops.IF: lambda values: values[1] if values[0] else values[2],
+    }
+
+    def __init__(self, variables: Optional[Mapping[str, Any]] = None, default: Any = 0):
+        self.variables = variables or {}
+        self.default = default
+        self._programs: Dict[gfs_ast.Expression, List[Instruction]] = {}
+        self._targets: Dict[str, str] = {}
+
+    def evaluate(self, feature: List[gfs_ast.Statement], state: Mapping[str, Any]) -> Dict[str, Any]:
+        """Applies the feature to the character state. Returns the new state; *state* is not modified."""
+        state = dict(state)
+        for stmt in sorted(feature, key=lambda stmt: stmt.precedence):
+            self.apply_statement(stmt, state)
+        return state
+
+    def dependency_graph(self, feature: List[gfs_ast.Statement]) -> DependencyGraph:
+        """Returns the dependency graph of the feature, with targets resolved from this evaluator's variables."""
+        return DependencyGraph(feature, resolve_target=self.resolve_target)
+
+    def update(
+        self, graph: DependencyGraph, state: Mapping[str, Any], previous: Mapping[str, Any], changed: Iterable[str]
+    ) -> Dict[str, Any]:
+        """
+        Returns the result of applying a feature to *state*, given *previous*, the result of applying it to an earlier
+        state that only differs from *state* in the *changed* targets. Only the statements downstream of the changed
+        targets are applied again. *graph* is the feature's dependency graph (see dependency_graph).
+        """
+        dirty_targets, dirty = graph.downstream(changed)
+        result = dict(previous)
+        # recompute every affected target starting from its value in the input state
+        for target in dirty_targets:
+            if target in state:
+                result[target] = state[target]
+            else:
+                result.pop(target, None)
+        for i in dirty:
+            self.apply_statement(graph.statements[i], result)
+        return result
+
+    def apply_statement(self, stmt: gfs_ast.Statement, state: Dict[str, Any]):
+        value = self.evaluate_expression(stmt.operand, state)
+        target = self.resolve_target(stmt.target)
+        if stmt.operator is gfs_ast.StatementOperators.SET:
+            state[target] = value
+        else:
+            state[target] = [*state.get(target, ()), value]
+
+    def evaluate_expression(self, expr: gfs_ast.Expression, state: Mapping[str, Any]) -> Any:
+        program = self._programs.get(expr)
+        if program is None:
+            program = self._programs[expr] = compile_program(expr)
+        results = []
+        for op, args in program:
+            if op is Ops.STATIC_VALUE:
+                results.append(args)
+            elif op is Ops.DYNAMIC_VALUE:
+                results.append(self.lookup(state, self.resolve_target(args)))
+            else:
+                results.append(self.operations[op]([results[i] for i in args]))
+        return results[-1]
+
+    def lookup(self, state: Mapping[str, Any], target: str) -> Any:
+        return state.get(target, self.default)
+
+    def resolve_target(self, target: str) -> str:
+        """Substitutes ``${name}`` placeholders in a target from the evaluator's variables."""
+        if target in self._targets:
+            return self._targets[target]
+        if "$" not in target:
+            resolved = target
+        else:
+            try:
+                resolved = string.Template(target).substitute(self.variables)
+            except KeyError as e:
+                raise GFSLEvaluationError(f"No value for variable {e.args[0]!r} in target {target!r}") from None
+            except ValueError as e:
+                raise GFSLEvaluationError(f"Invalid placeholder in target {target!r}: {e}") from None
+        self._targets[target] = resolved
+        return resolved
+
+
+class BatchEvaluator(Evaluator):
+    """
+    Evaluates compiled features against many character states at once. States are columnar: each target maps to an
+    array with one element per character, and every instruction is evaluated for all characters in one NumPy call.
+    PUSH targets map to a list of arrays, one for each pushed value. In the input state, a PUSH target can also be a
+    2-D array with a row of values for each character (like to_columns makes of lists), or an array with one value for
+    each character.
+    """
+
+    operations = {
+        Ops.ADD: lambda values: functools.reduce(np.add, values),
+        Ops.MULTIPLY: lambda values: functools.reduce(np.multiply, values),
+        Ops.MIN: lambda values: functools.reduce(np.minimum, values),
+        Ops.MAX: lambda values: functools.reduce(np.maximum, values),
+        Ops.FLOOR: lambda values: np.floor(values[0]),
+        Ops.SUBTRACT: lambda values: np.subtract(values[0], values[1]),
+        Ops.DIVIDE: lambda values: batch_divide(values[0], values[1]),
+        Ops.CEIL: lambda values: np.ceil(values[0]),
+        Ops.ROUND: lambda values: np.floor(np.add(values[0], 0.5)),
+        Ops.ABS: lambda values: np.abs(values[0]),
+        Ops.EQUAL: lambda values: np.equal(values[0], values[1]).astype(int),
+        Ops.NOT_EQUAL: lambda values: np.not_equal(values[0], values[1]).astype(int),
+        Ops.LESS_THAN: lambda values: np.less(values[0], values[1]).astype(int),
+        Ops.LESS_THAN_OR_EQUAL: lambda values: np.less_equal(values[0], values[1]).astype(int),
+        Ops.GREATER_THAN: lambda values: np.greater(values[0], values[1]).astype(int),
+        Ops.GREATER_THAN_OR_EQUAL: lambda values: np.greater_equal(values[0], values[1]).astype(int),
+        Ops.IF: lambda values: np.where(values[0], values[1], values[2]),
+    }
+
+    def __init__(self, size: int, variables: Optional[Mapping[str, Any]] = None, default: Any = 0):
+        if np is None:
+            raise ImportError("The batched evaluator requires NumPy (pip install numpy)")
+        super().__init__(variables, default)
+        self.size = size
+
+    def evaluate(self, feature: List[gfs_ast.Statement], state: Mapping[str, Any]) -> Dict[str, Any]:
+        columns = {}
+        for target, column in state.items():
+            column = np.asarray(column)
+            if column.shape[:1] != (self.size,) or column.ndim > 2:
+                raise ValueError(f"Column {target!r} has shape {column.shape}, expected ({self.size},)")
+            columns[target] = column
+        return super().evaluate(feature, columns)
+
+    def apply_statement(self, stmt: gfs_ast.Statement, state: Dict[str, Any]):
+        if stmt.operator is gfs_ast.StatementOperators.PUSH:
+            target = self.resolve_target(stmt.target)
+            column = state.get(target)
+            if isinstance(column, np.ndarray):
+                # an input column: pushing appends to the list of each character, not to the column itself
+                state[target] = list(column.T) if column.ndim == 2 else [column]
+        super().apply_statement(stmt, state)
+
+    def evaluate_expression(self, expr: gfs_ast.Expression, state: Mapping[str, Any]) -> Any:
+        # static values (and the default for missing targets) are scalars that NumPy broadcasts against the columns,
+        # so a result that only depends on them needs to be made into a column
+        return np.broadcast_to(super().evaluate_expression(expr, state), (self.size,))
+
+
+def to_columns(states: Sequence[Mapping[str, Any]], default: Any = 0) -> Dict[str, "np.ndarray"]:
+    """Converts a list of character states to the columnar form used by the batched evaluator."""
+    if np is None:
+        raise ImportError("The batched evaluator requires NumPy (pip install numpy)")
+    targets = dict.fromkeys(target for state in states for target in state)
+    return {target: np.array([state.get(target, default) for state in states]) for target in targets}
+
+
+def evaluate(
+    feature: List[gfs_ast.Statement],
+    state: Mapping[str, Any],
+    variables: Optional[Mapping[str, Any]] = None,
+    default: Any = 0,
+) -> Dict[str, Any]:
+    return Evaluator(variables, default).evaluate(feature, state)
+
+
+def evaluate_batch(
+    feature: List[gfs_ast.Statement],
+    columns: Mapping[str, Any],
+    size: Optional[int] = None,
+    variables: Optional[Mapping[str, Any]] = None,
+    default: Any = 0,
+) -> Dict[str, Any]:
+    """
+    Evaluates the feature against a batch of character states, given as a mapping of target names to arrays with one
+    element per character. *size* (the number of characters) is inferred from the columns if not given.
+    """
+    if size is None:
+        if not columns:
+            raise ValueError("Cannot infer the batch size from an empty state; pass size")
+        size = len(next(iter(columns.values())))
+    return BatchEvaluator(size, variables, default).evaluate(feature, columns)
@@ -0,0 +1,341 @@
+"""
+A hand-written recursive descent parser for GFSLang, used by the "fast" parser mode.
+
+It builds the IMF AST directly in one pass over the source, without building a parse tree first, and assigns every node
+the same positions as the Lark parsers (e.g. a node's span includes the parentheses around its children, but not its
+own). It accepts the same language as the Earley parser: where the Lark parsers' lexers disagree (e.g. ``10.5.x`` is a
+target to the Earley parser, but a syntax error to the LALR parser), it follows the Earley parser.
+
+Since newlines separate statements and cannot appear anywhere else, every statement is parsed from a single line.
+Syntax errors raise GFSLSyntaxError. Names and targets are interned, since the same few repeat throughout a feature.
+"""
+import re
+import sys
+from typing import List, Optional, Tuple
+
+from . import instrumentation
+from .errors import GFSLSyntaxError
+from .imf_ast import (
+    BinOp,
+    Call,
+    Expression,
+    Feature,
+    FeatureStatement,
+    FunctionalMacroDef,
+    FunctionalMacroSig,
+    Import,
+    Literal,
+    Macro,
+    MacroCall,
+    MacroDef,
+    Node,
+    Statement,
+    Target,
+    Ternary,
+)
+
+# the terminals of gfs.lark
+_WS = re.compile(r"[ \t]*")
+_NUMBER = re.compile(r"(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+_SIGNED_NUMBER = re.compile(r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+_IDENTIFIER = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*")
+_CALL_NAME = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*(?=[ \t]*\()")
+_TARGET = re.compile(r"[a-zA-Z0-9${}.]+")
+_ESCAPED_STRING = re.compile(r'".*?(?<!\\)(\\\\)*?"')
+_COMP_OPS = frozenset(("==", "!=", "<=", ">="))
+_TARGET_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789${}.")
+
+# a parsed node, and the span of the source it was parsed from (including any parentheses around it)
+Parsed = Tuple[Node, int, int]
+
+
+class FastParser:
+    def __init__(self):
+        self.line = ""
+        self.lineno = 0
+        self.pos = 0
+        self.nodes = 0
+
+    def parse(self, text: str, diagnostics: Optional[List[GFSLSyntaxError]] = None) -> Feature:
+        """
+        Parses a feature. If a *diagnostics* list is given, a line with a syntax error is skipped and its error appended
+        to *diagnostics*, instead of raising it.
+        """
+        statements = []
+        # the span of the feature, from its first token to the end of its last token (like the LALR parser, the end of
+        # a newline is the start of the next line)
+        start = end = None
+        lines = text.split("\n")
+        for lineno, line in enumerate(lines, start=1):
+            try:
+                stmt = self.parse_line(line, lineno)
+            except GFSLSyntaxError as e:
+                if diagnostics is None:
+                    raise
+                diagnostics.append(e)
+                stmt = None
+            if stmt is not None:
+                statements.append(stmt)
+                if start is None:
+                    start = (lineno, stmt.column)
+                end = (lineno, stmt.end_column)
+            if lineno < len(lines):
+                # the newline is a token too
+                if start is None:
+                    start = (lineno, len(line) + 1)
+                end = (lineno + 1, 1)
+
+        feature = Feature(statements)
+        feature.line, feature.column = start or (1, 1)
+        feature.end_line, feature.end_column = end or (1, 1)
+        instrumentation.count("imf_nodes", self.nodes + 1)
+        return feature
+
+    def parse_line(self, line: str, lineno: int) -> Optional[FeatureStatement]:
+        """Parses one line (without its newline) of a feature. Returns its statement, or None if it has none."""
+        self.line = line
+        self.lineno = lineno
+        pos = _WS.match(line).end()
+        if pos == len(line) or line[pos] == "#":
+            return None
+        self.pos = pos
+        stmt = self.statement()
+        self.expect_end()
+        return stmt
+
+    # ==== helpers ====
+    def node(self, node: Node, start: int, end: int) -> Node:
+        """Sets the position of a node parsed from the current line, between the given offsets."""
+        node.line = node.end_line = self.lineno
+        node.column = start + 1
+        node.end_column = end + 1
+        self.nodes += 1
+        return node
+
+    def skip(self) -> int:
+        """Skips whitespace, and returns the position of the next character."""
+        self.pos = _WS.match(self.line, self.pos).end()
+        return self.pos
+
+    def peek(self) -> str:
+        pos = self.skip()
+        return self.line[pos : pos + 1]
+
+    def error(self, expected: str, pos: int = None):
+        if pos is None:
+            pos = self.pos
+        found = repr(self.line[pos]) if pos < len(self.line) else "end of line"
+        raise GFSLSyntaxError(
+            f"Unexpected {found} at line {self.lineno}, column {pos + 1}: expected {expected}", self.lineno, pos + 1
+        )
+
+    def expect(self, token: str, expected: str = None) -> int:
+        """Consumes the given token, and returns its end."""
+        pos = self.skip()
+        if not self.line.startswith(token, pos):
+            self.error(expected or repr(token))
+        self.pos = pos + len(token)
+        return self.pos
+
+    def expect_end(self):
+        pos = self.skip()
+        if pos < len(self.line) and self.line[pos] != "#":
+            self.error("end of line")
+
+    def identifier(self) -> str:
+        match = _IDENTIFIER.match(self.line, self.skip())
+        if match is None:
+            self.error("an identifier")
+        self.pos = match.end()
+        return sys.intern(match.group())
+
+    # ==== statements ====
+    def statement(self) -> Node:
+        line = self.line
+        start = self.pos
+        if _IDENTIFIER.match(line, start):
+            identifier = self.identifier()
+            char = self.peek()
+            if identifier == "import" and char == '"':
+                return self.import_stmt(start)
+            elif char == "(":
+                return self.functional_macro_def(identifier, start)
+            self.expect(":=", "':=' or '('")
+            expression, _, end = self.expression()
+            return self.node(MacroDef(identifier, expression), start, end)
+        return self.rule_statement(start)
+
+    def import_stmt(self, start: int) -> Import:
+        match = _ESCAPED_STRING.match(self.line, self.pos)
+        if match is None:
+            self.error("a string")
+        self.pos = match.end()
+        # strip the quotes
+        return self.node(Import(match.group()[1:-1]), start, self.pos)
+
+    def functional_macro_def(self, identifier: str, start: int) -> FunctionalMacroDef:
+        self.expect("(")
+        arg_names = []
+        while self.peek() != ")":
+            self.expect("!", "'!' or ')'")
+            arg_names.append(self.identifier())
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        sig_end = self.expect(")", "',' or ')'")
+        signature = self.node(FunctionalMacroSig(identifier, *arg_names), start, sig_end)
+        self.expect(":=")
+        expression, _, end = self.fmacro_expression()
+        return self.node(FunctionalMacroDef(signature, expression), start, end)
+
+    def rule_statement(self, start: int) -> Statement:
+        match = _SIGNED_NUMBER.match(self.line, start)
+        if match is None:
+            self.error("a statement")
+        precedence = float(match.group())
+        self.pos = match.end()
+        self.expect(":")
+        match = _TARGET.match(self.line, self.skip())
+        if match is None:
+            self.error("a target")
+        target = sys.intern(match.group())
+        self.pos = match.end()
+        if self.peek() == "+":
+            self.expect("++", "'=' or '++'")
+            op = "++"
+        else:
+            self.expect("=", "'=' or '++'")
+            op = "="
+        expression, _, end = self.expression()
+        return self.node(Statement(precedence, target, op, expression), start, end)
+
+    # ==== expressions ====
+    def fmacro_expression(self) -> Parsed:
+        """An expression that may be (or contain parenthesized) ternaries: the right hand side of a functional macro."""
+        condition, start, end = self.expression(ternaries=True)
+        if self.peek() != "?":
+            return condition, start, end
+        self.pos += 1
+        true, _, _ = self.fmacro_expression()
+        self.expect(":", "':'")
+        false, _, end = self.fmacro_expression()
+        return self.node(Ternary(condition, true, false), start, end), start, end
+
+    def expression(self, ternaries: bool = False) -> Parsed:
+        """
+        Parses an arithmetic expression, or a comparison of two. If *ternaries* is set, an atom may be a parenthesized
+        ternary, which must be the entire expression.
+        """
+        left, start, end = self.sum(ternaries)
+        pos = self.skip()
+        op = self.line[pos : pos + 2]
+        if op not in _COMP_OPS:
+            op = op[:1]
+            if op != "<" and op != ">":
+                return left, start, end
+        self.pos = pos + len(op)
+        right, _, end = self.sum(ternaries)
+        if type(left) is Ternary or type(right) is Ternary:
+            self.error("'?'" if type(left) is Ternary else "an expression", pos)
+        return self.node(BinOp(left, op, right), start, end), start, end
+
+    def sum(self, ternaries: bool) -> Parsed:
+        left, start, end = self.term(ternaries)
+        while True:
+            op = self.peek()
+            if op != "+" and op != "-":
+                return left, start, end
+            op_pos = self.pos
+            self.pos += 1
+            right, _, end = self.term(ternaries)
+            if type(left) is Ternary or type(right) is Ternary:
+                self.error("'?'" if type(left) is Ternary else "an expression", op_pos)
+            left = self.node(BinOp(left, op, right), start, end)
+
+    def term(self, ternaries: bool) -> Parsed:
+        left, start, end = self.atom(ternaries)
+        while True:
+            pos = self.skip()
+            op = self.line[pos : pos + 2]
+            if op != "//":
+                op = op[:1]
+                if op != "*" and op != "/":
+                    return left, start, end
+            self.pos = pos + len(op)
+            right, _, end = self.atom(ternaries)
+            if type(left) is Ternary or type(right) is Ternary:
+                self.error("'?'" if type(left) is Ternary else "an expression", pos)
+            left = self.node(BinOp(left, op, right), start, end)
+
+    def atom(self, ternaries: bool) -> Parsed:
+        line = self.line
+        start = self.skip()
+        char = line[start : start + 1]
+
+        if char == "(":
+            self.pos += 1
+            if ternaries:
+                inner, _, _ = self.fmacro_expression()
+            else:
+                inner, _, _ = self.expression()
+            return inner, start, self.expect(")", "')'")
+
+        if char == "!":
+            self.pos += 1
+            name = self.identifier()
+            end = self.pos
+            if self.peek() == "(":
+                args, end = self.args()
+                return self.node(MacroCall(name, *args), start, end), start, end
+            return self.node(Macro(name), start, end), start, end
+
+        match = _CALL_NAME.match(line, start)
+        if match is not None:
+            self.pos = match.end()
+            self.skip()
+            args, end = self.args()
+            return self.node(Call(sys.intern(match.group()), *args), start, end), start, end
+
+        if char == "+" or char == "-":
+            match = _SIGNED_NUMBER.match(line, start)
+            if match is None:
+                self.error("an expression")
+            return self.literal(match.group(), start, match.end())
+
+        match = _TARGET.match(line, start)
+        if match is None:
+            self.error("an expression")
+        end = match.end()
+        # a run of target characters is a number if it is all number (the exponent's sign can extend a number beyond a
+        # run of target characters, e.g. 1e-5)
+        number = _NUMBER.match(line, start)
+        if number is not None:
+            number_end = number.end()
+            if number_end >= end and line[number_end : number_end + 1] not in _TARGET_CHARS:
+                return self.literal(number.group(), start, number_end)
+        self.pos = end
+        return self.node(Target(sys.intern(match.group())), start, end), start, end
+
+    def literal(self, number: str, start: int, end: int) -> Parsed:
+        self.pos = end
+        try:
+            value = int(number)
+        except ValueError:
+            value = float(number)
+        return self.node(Literal(value), start, end), start, end
+
+    def args(self) -> Tuple[List[Expression], int]:
+        """Parses a parenthesized argument list (which may have a trailing comma). Returns the args and their end."""
+        self.expect("(")
+        args = []
+        while self.peek() != ")":
+            arg, _, _ = self.expression()
+            args.append(arg)
+            if self.peek() != ",":
+                break
+            self.pos += 1
+        return args, self.expect(")", "',' or ')'")
+
+
+def parse(text: str, diagnostics: Optional[List[GFSLSyntaxError]] = None) -> Feature:
+    return FastParser().parse(text, diagnostics)
@@ -5,7 +5,10 @@ It is the final output of the compiler.
 See https://github.com/DnDBeyond/ddb-characters/blob/devgr/rpn-calc/packages/gfs/src/types.ts.
 """
 import enum
-from typing import List, Union
+import weakref
+from typing import Dict, FrozenSet, Optional, Sequence, Tuple, Union
+
+from . import instrumentation
 
 
 class ExpressionOperators(enum.Enum):
@@ -16,6 +19,19 @@ class ExpressionOperators(enum.Enum):
     MULTIPLY = "MULTIPLY"
     DYNAMIC_VALUE = "DYNAMIC_VALUE"
     STATIC_VALUE = "STATIC_VALUE"
+    # only supported by the extended engine (see ENGINES)
+    SUBTRACT = "SUBTRACT"
+    DIVIDE = "DIVIDE"
+    CEIL = "CEIL"
+    ROUND = "ROUND"
+    ABS = "ABS"
+    EQUAL = "EQUAL"
+    NOT_EQUAL = "NOT_EQUAL"
+    LESS_THAN = "LESS_THAN"
+    LESS_THAN_OR_EQUAL = "LESS_THAN_OR_EQUAL"
+    GREATER_THAN = "GREATER_THAN"
+    GREATER_THAN_OR_EQUAL = "GREATER_THAN_OR_EQUAL"
+    IF = "IF"
 
 
 class StatementOperators(enum.Enum):
@@ -23,24 +39,150 @@ class StatementOperators(enum.Enum):
     PUSH = "PUSH"
 
 
+# the expression operators that each GFS engine can evaluate. The base engine only has arithmetic, min/max, and floor:
+# the compiler lowers the other operations to them where it can (e.g. "a - b" to "a + (b * -1)"). The extended engine
+# also has native subtraction, division, ceil/round/abs, comparisons (which evaluate to 1 or 0), and IF(condition,
+# then, else) conditionals.
+ENGINES: Dict[str, FrozenSet[ExpressionOperators]] = {
+    "base": frozenset(
+        (
+            ExpressionOperators.ADD,
+            ExpressionOperators.MIN,
+            ExpressionOperators.MAX,
+            ExpressionOperators.FLOOR,
+            ExpressionOperators.MULTIPLY,
+            ExpressionOperators.DYNAMIC_VALUE,
+            ExpressionOperators.STATIC_VALUE,
+        )
+    ),
+    "extended": frozenset(ExpressionOperators),
+}
+DEFAULT_ENGINE = "base"
+
+
 class Expression:
-    def __init__(self, operator: ExpressionOperators, operands: Union[List["Expression"], str, int, float]):
-        self.operator = operator
-        self.operands = operands
+    """
+    An immutable, hash-consed GFS expression node.
+
+    Nodes are interned: constructing a node that is structurally equal to a live node returns that node instead, so
+    structurally equal subtrees are shared and a compiled feature is a DAG. This also means that equality (and hashing)
+    by identity is structural equality. Static operands only compare equal if they have the same type and repr
+    (e.g. 1 != 1.0), since they render differently.
+
+    Constructing an expression with the STATIC_VALUE operator always returns a StaticExpression.
+    """
+
+    __slots__ = ("operator", "operands", "__weakref__")
+    _interned: "weakref.WeakValueDictionary[tuple, Expression]" = weakref.WeakValueDictionary()
+
+    operator: ExpressionOperators
+    operands: Union[Tuple["Expression", ...], str, int, float]
+
+    def __new__(cls, operator: ExpressionOperators, operands: Union[Sequence["Expression"], str, int, float]):
+        if operator is ExpressionOperators.STATIC_VALUE:
+            cls = StaticExpression
+        if isinstance(operands, (list, tuple)):
+            # children are interned already, so the tuple hashes and compares them by identity
+            operands = tuple(operands)
+            key = (operator, operands)
+        else:
+            key = (operator, type(operands), repr(operands))
+        existing = Expression._interned.get(key)
+        if existing is not None:
+            if instrumentation.collectors:
+                instrumentation.count("gfs_nodes_shared")
+            return existing
+        if instrumentation.collectors:
+            instrumentation.count("gfs_nodes")
+        self = object.__new__(cls)
+        object.__setattr__(self, "operator", operator)
+        object.__setattr__(self, "operands", operands)
+        return Expression._interned.setdefault(key, self)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, item):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        # re-intern when unpickled/copied
+        return Expression, (self.operator, self.operands)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.operator.value} {self.operands!r}>"
 
 
 class StaticExpression(Expression):
     """Compiler optimization: this expression is always static"""
 
+    __slots__ = ()
     __match_args__ = ("operands",)
 
-    def __init__(self, operand: Union[int, float]):
-        super().__init__(ExpressionOperators.STATIC_VALUE, operand)
+    operands: Union[int, float]
+
+    def __new__(cls, operand: Union[int, float]):
+        return super().__new__(cls, ExpressionOperators.STATIC_VALUE, operand)
+
+
+class Origin:
+    """
+    Where a compiled node came from: the span of GFSL it was compiled from, in *source* (the path of the macro library
+    it is in, or None for the compiled file itself), and the functional macro calls whose expansions produced it,
+    outermost first, as a (macro name, line, column, source) tuple for each call.
+    """
+
+    __slots__ = ("source", "line", "column", "end_line", "end_column", "expansions")
+
+    def __init__(
+        self,
+        source: Optional[str],
+        line: int,
+        column: int,
+        end_line: int,
+        end_column: int,
+        expansions: Tuple[Tuple[str, int, int, Optional[str]], ...] = (),
+    ):
+        self.source = source
+        self.line = line
+        self.column = column
+        self.end_line = end_line
+        self.end_column = end_column
+        self.expansions = expansions
+
+    def __repr__(self):
+        via = "".join(f" via !{name}() at {line}:{column}" for name, line, column, _ in reversed(self.expansions))
+        return f"<{type(self).__name__} {self.source or ''}:{self.line}:{self.column}{via}>"
 
 
 class Statement:
-    def __init__(self, precedence: float, target: str, operator: StatementOperators, operand: Expression):
+    """
+    A compiled statement. If the compiler tracked origins (see Compiler.track_origins), *origin* is the span of the
+    statement, and *origins* maps the nodes of its operand to where they were compiled from. Expressions are shared
+    between statements, so their origins are kept per statement. Nodes created after compiling (e.g. by the optimizer)
+    may have no origin of their own: they come from the closest ancestor that has one.
+    """
+
+    __slots__ = ("precedence", "target", "operator", "operand", "origin", "origins")
+
+    def __init__(
+        self,
+        precedence: float,
+        target: str,
+        operator: StatementOperators,
+        operand: Expression,
+        origin: Optional[Origin] = None,
+        origins: Optional[Dict[Expression, Origin]] = None,
+    ):
         self.precedence = precedence
         self.target = target
         self.operator = operator
         self.operand = operand
+        self.origin = origin
+        self.origins = origins
+
+    def __repr__(self):
+        return (
+            f"<{type(self).__name__} precedence={self.precedence!r} target={self.target!r} "
+            f"operator={self.operator.value} operand={self.operand!r}>"
+        )
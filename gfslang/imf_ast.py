@@ -1,21 +1,46 @@
 """
 Intermediate Form AST: this AST is a representation of GFSLang including compiler directives like macros.
 The compiler turns this into the GFS AST.
+
+Nodes use __slots__ (large features parse to millions of nodes), so their attributes are listed by Node.fields rather
+than vars().
 """
 
 import abc
-from typing import List, Union
+import functools
+from typing import Iterator, List, Tuple, Union
 
 import lark.tree
 
+from . import instrumentation
+
+
+POSITION_FIELDS = ("line", "column", "end_line", "end_column")
+
 
 class Node(abc.ABC):
+    __slots__ = POSITION_FIELDS
     line: int
     column: int
     end_line: int
     end_column: int
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def field_names(cls) -> Tuple[str, ...]:
+        """The names of the attributes of this node type, other than its position."""
+        names = []
+        for klass in reversed(cls.__mro__):
+            names.extend(name for name in klass.__dict__.get("__slots__", ()) if name not in POSITION_FIELDS)
+        return tuple(names)
+
+    def fields(self) -> Iterator[Tuple[str, object]]:
+        """Yields the name and value of each attribute of the node, other than its position."""
+        for name in self.field_names():
+            yield name, getattr(self, name)
+
     def populate_posinfo(self, meta: lark.tree.Meta):
+        instrumentation.count("imf_nodes")
         self.line = meta.line
         self.column = meta.column
         self.end_line = meta.end_line
@@ -31,15 +56,29 @@ class Node(abc.ABC):
 
 
 class Feature(Node):
-    def __init__(self, statements: List[Union["MacroDef", "Statement"]]):
+    __slots__ = ("statements",)
+
+    def __init__(self, statements: List[Union["Import", "MacroDef", "Statement"]]):
         self.statements = statements
 
     def __repr__(self):
         return f"<{type(self).__name__} statements={self.statements!r}>"
 
 
+class Import(Node):
+    __slots__ = ("path",)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.path!r}>"
+
+
 # ==== macros ====
 class MacroDef(Node):
+    __slots__ = ("identifier", "expression")
+
     def __init__(self, identifier: str, expression: "Expression"):
         self.identifier = identifier
         self.expression = expression
@@ -49,18 +88,24 @@ class MacroDef(Node):
 
 
 class FunctionalMacroDef(MacroDef):
+    __slots__ = ("args",)
+
     def __init__(self, signature: "FunctionalMacroSig", expression: "Expression"):
         super().__init__(signature.identifier, expression)
         self.args = signature.args
 
 
 class FunctionalMacroSig(Node):
+    __slots__ = ("identifier", "args")
+
     def __init__(self, identifier: str, *arg_names: str):
         self.identifier = identifier
         self.args = arg_names
 
 
 class Ternary(Node):
+    __slots__ = ("condition", "true", "false")
+
     def __init__(
         self,
         condition: Union["Ternary", "Expression"],
@@ -74,6 +119,8 @@ class Ternary(Node):
 
 # ==== GFS statements ====
 class Statement(Node):
+    __slots__ = ("precedence", "target", "op", "expression")
+
     def __init__(self, precedence: float, target: str, op: str, expression: "Expression"):
         self.precedence = precedence
         self.target = target
@@ -88,10 +135,12 @@ class Statement(Node):
 
 
 class Expression(Node, abc.ABC):
-    pass
+    __slots__ = ()
 
 
 class BinOp(Expression):
+    __slots__ = ("op", "left", "right")
+
     def __init__(self, left: Expression, op: str, right: Expression):
         self.op = op
         self.left = left
@@ -102,6 +151,8 @@ class BinOp(Expression):
 
 
 class Call(Expression):
+    __slots__ = ("name", "args")
+
     def __init__(self, name: str, *args: Expression):
         self.name = name
         self.args = args
@@ -111,6 +162,8 @@ class Call(Expression):
 
 
 class Literal(Expression):
+    __slots__ = ("value",)
+
     def __init__(self, value: Union[int, float]):
         self.value = value
 
@@ -119,6 +172,8 @@ class Literal(Expression):
 
 
 class Target(Expression):
+    __slots__ = ("target",)
+
     def __init__(self, target: str):
         self.target = target
 
@@ -127,6 +182,8 @@ class Target(Expression):
 
 
 class Macro(Expression):
+    __slots__ = ("name",)
+
     def __init__(self, name: str):
         self.name = name
 
@@ -135,6 +192,8 @@ class Macro(Expression):
 
 
 class MacroCall(Expression):
+    __slots__ = ("name", "args")
+
     def __init__(self, name: str, *args: Expression):
         self.name = name
         self.args = args
@@ -142,3 +201,19 @@ class MacroCall(Expression):
     def __repr__(self):
         arg_str = ", ".join(repr(arg) for arg in self.args)
         return f"<{type(self).__name__} !{self.name}({arg_str})>"
+
+
+# the top-level statements of a feature
+FeatureStatement = Union[Import, MacroDef, Statement]
+
+
+def set_line(node: Node, line: int):
+    """Moves a single-line IMF subtree to the given line."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Node):
+            node.line = node.end_line = line
+            stack.extend(value for _, value in node.fields())
+        elif isinstance(node, (list, tuple)):
+            stack.extend(node)
@@ -0,0 +1,131 @@
+"""
+Instrumentation of the GFSLang pipeline: stage timings and event counters.
+
+Each pipeline stage (parse, compile, optimize, render, and building the parser: parser_init) is timed, and the pipeline
+counts events like macro expansions, constant folds, and allocated nodes. These are reported to every active collector;
+with no active collectors, instrumentation costs next to nothing.
+
+    >>> with gfslang.profile() as stats:
+    ...     gfslang.render_ts(gfslang.compile(gfslang.parse(source)))
+    >>> print(stats.format())
+
+Stage timings are inclusive: a stage that runs another stage (e.g. the incremental compiler parsing changed lines) also
+includes the time of the inner stage.
+
+Counters:
+
+- imf_nodes: IMF nodes created by the parser
+- gfs_nodes: new GFS expression nodes allocated (i.e. not shared with a structurally equal live node)
+- gfs_nodes_shared: GFS expression nodes that were constructed but shared with a live node instead
+- macro_expansions: functional macro calls that were expanded
+- macro_expansion_cache_hits: functional macro calls that reused an earlier identical expansion
+- constant_folds: operations evaluated at compile time by the compiler or optimizer
+- output_bytes: bytes (or characters, for text formats) output by the renderers
+- cached_statements: statements and static macros reused from the compile cache instead of being compiled
+- cached_outputs: outputs reused from the compile cache, without compiling the file at all
+"""
+import collections
+import contextlib
+import time
+from typing import Any, Dict, List
+
+# the active collectors; instrumented code checks this before doing any work
+collectors: List["Collector"] = []
+
+
+class Collector:
+    """Receives instrumentation events while active (see collect). Subclass this to implement custom hooks."""
+
+    def on_stage(self, stage: str, seconds: float):
+        """Called when a pipeline stage finishes."""
+        pass
+
+    def on_count(self, counter: str, n: int):
+        """Called when an event is counted."""
+        pass
+
+
+class Stats(Collector):
+    """Collects the total time and number of runs of each stage, and the total of each counter."""
+
+    def __init__(self):
+        self.stage_seconds: Dict[str, float] = collections.defaultdict(float)
+        self.stage_calls: Dict[str, int] = collections.defaultdict(int)
+        self.counters: Dict[str, int] = collections.Counter()
+
+    def on_stage(self, stage: str, seconds: float):
+        self.stage_seconds[stage] += seconds
+        self.stage_calls[stage] += 1
+
+    def on_count(self, counter: str, n: int):
+        self.counters[counter] += n
+
+    def merge(self, other: "Stats"):
+        for stage, seconds in other.stage_seconds.items():
+            self.stage_seconds[stage] += seconds
+        for stage, calls in other.stage_calls.items():
+            self.stage_calls[stage] += calls
+        self.counters.update(other.counters)
+
+    def report(self) -> Dict[str, Any]:
+        """Returns the stats as a JSON-serializable dict."""
+        return {
+            "stages": {
+                stage: {"seconds": seconds, "calls": self.stage_calls[stage]}
+                for stage, seconds in self.stage_seconds.items()
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    @classmethod
+    def from_report(cls, report: Dict[str, Any]) -> "Stats":
+        stats = cls()
+        for stage, result in report["stages"].items():
+            stats.stage_seconds[stage] = result["seconds"]
+            stats.stage_calls[stage] = result["calls"]
+        stats.counters.update(report["counters"])
+        return stats
+
+    def format(self) -> str:
+        """Returns the stats as a human-readable table."""
+        lines = []
+        for stage, seconds in self.stage_seconds.items():
+            lines.append(f"{stage:<28} {seconds * 1000:>12.3f} ms  ({self.stage_calls[stage]} calls)")
+        for counter, n in sorted(self.counters.items()):
+            lines.append(f"{counter:<28} {n:>12}")
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def collect(collector: Collector):
+    """Reports instrumentation events to the collector while the context is active."""
+    collectors.append(collector)
+    try:
+        yield collector
+    finally:
+        collectors.remove(collector)
+
+
+def profile():
+    """Collects Stats while the context is active: ``with profile() as stats: ...``"""
+    return collect(Stats())
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Times the enclosed pipeline stage."""
+    if not collectors:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for collector in collectors:
+            collector.on_stage(name, seconds)
+
+
+def count(counter: str, n: int = 1):
+    for collector in collectors:
+        collector.on_count(counter, n)
@@ -0,0 +1,132 @@
+"""
+Macro libraries: ``.gfs`` files of shared macro definitions that features import with ``import "path/to/library.gfs"``.
+
+A library is compiled on its own (it only sees its own macros, and the macros of the libraries it imports), so it can
+be compiled once and reused by every feature that imports it. Its precompiled form is a MacroLibrary: the compiled
+static macros and the parsed functional macros. Precompiled libraries are kept in memory, and serialized to the cache
+directory (keyed by the compiler version), so hundreds of features importing the same library do not parse and
+compile it again, even across runs. A precompiled library is reused as long as its source and the sources of every
+library it imports did not change.
+
+Importing a library defines its macros as if they had been defined at the import.
+"""
+import functools
+import os
+import pickle
+from typing import Dict, Optional, Tuple
+
+from . import errors, gfs_ast, imf_ast
+from .cache import atomic_write, compiler_version, digest, pickle_dumps, pickle_loads, sources_current
+from .compiler import Compiler
+from .parser import CACHE_DIR, DEFAULT_PARSER_MODE, parse
+
+
+class MacroLibrary:
+    """The precompiled form of a macro library."""
+
+    def __init__(
+        self,
+        macros: Dict[str, gfs_ast.Expression],
+        func_macros: Dict[str, imf_ast.FunctionalMacroDef],
+        dependencies: Dict[str, str],
+        sources: Optional[Dict[str, str]] = None,
+    ):
+        self.macros = macros
+        self.func_macros = func_macros
+        # absolute path -> digest of the source, of the library itself and of every library it (transitively) imports
+        self.dependencies = dependencies
+        # functional macro name -> the absolute path of the library that defines it, if known (see gfs_ast.Origin)
+        self.sources = sources or {}
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """A digest of the sources this library was compiled from."""
+        return digest(sorted(self.dependencies.items()))
+
+    def is_current(self) -> bool:
+        """Whether none of the sources this library was compiled from changed."""
+        return sources_current(self.dependencies)
+
+    def __getstate__(self):
+        # don't pickle the cached fingerprint
+        return self.macros, self.func_macros, self.dependencies, self.sources
+
+    def __setstate__(self, state):
+        self.macros, self.func_macros, self.dependencies, self.sources = state
+
+
+def compile_library(
+    source: str,
+    filename: Optional[str] = None,
+    mode: str = DEFAULT_PARSER_MODE,
+    importing: Tuple[str, ...] = (),
+    engine: str = gfs_ast.DEFAULT_ENGINE,
+) -> MacroLibrary:
+    """
+    Compiles the source of a macro library. Imports are relative to the directory of *filename* (or the working
+    directory); *importing* are the libraries that are being imported while compiling this one, to detect cycles.
+    Its static macros are compiled for the GFS *engine*, like the features that import it.
+    """
+    feature = parse(source, mode=mode)
+    for stmt in feature.statements:
+        if isinstance(stmt, imf_ast.Statement):
+            raise errors.GFSLCompileError("Macro libraries can only contain imports and macro definitions", node=stmt)
+    dependencies = {}
+    if filename is not None:
+        filename = os.path.abspath(filename)
+        dependencies[filename] = digest(source)
+        importing = (*importing, filename)
+    compiler = Compiler(
+        base_dir=os.path.dirname(filename) if filename else None, mode=mode, importing=importing, engine=engine
+    )
+    compiler.compile(feature)
+    dependencies.update(compiler.imported)
+    sources = {}
+    for identifier in compiler.func_macros:
+        source = compiler.fmacro_sources.get(identifier) or filename
+        if source is not None:
+            sources[identifier] = source
+    return MacroLibrary(compiler.macros, compiler.func_macros, dependencies, sources)
+
+
+# (absolute path, engine) -> the last precompiled library loaded from that file
+_loaded: Dict[Tuple[str, str], MacroLibrary] = {}
+
+
+def library_cache_path(filename: str, engine: str = gfs_ast.DEFAULT_ENGINE) -> str:
+    return os.path.join(CACHE_DIR, "libraries", compiler_version(), f"{digest(filename, engine)}.pickle")
+
+
+def load_library(
+    filename: str,
+    mode: str = DEFAULT_PARSER_MODE,
+    importing: Tuple[str, ...] = (),
+    engine: str = gfs_ast.DEFAULT_ENGINE,
+) -> MacroLibrary:
+    """
+    Returns the precompiled library in the given file (for the GFS *engine*), compiling it (and saving its precompiled
+    form) only if it or a library it imports changed since it was last compiled.
+    """
+    filename = os.path.abspath(filename)
+    library = _loaded.get((filename, engine))
+    if library is not None and library.is_current():
+        return library
+
+    cache_path = library_cache_path(filename, engine)
+    try:
+        with open(cache_path, "rb") as f:
+            library = pickle_loads(f.read())
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+        library = None
+    if library is None or not library.is_current():
+        with open(filename) as f:
+            source = f.read()
+        library = compile_library(source, filename, mode=mode, importing=importing, engine=engine)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            atomic_write(cache_path, pickle_dumps(library))
+        except OSError:
+            # the cache is only an optimization
+            pass
+    _loaded[filename, engine] = library
+    return library
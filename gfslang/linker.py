@@ -0,0 +1,103 @@
+"""
+Linking compiled features into one bundle.
+
+Each feature compiles to its own list of statements, but the engine loads the statements of every feature a character
+has, and many features repeat the same rules (e.g. the ability modifiers). Linking merges the features into one list
+in evaluation order, leaving out the SETs that repeat a statement already in the bundle, and finds the SETs of the
+same target at the same precedence with different values (whose result depends on the order the features are linked
+in).
+
+Statements are applied in precedence order, like the evaluator does; statements with equal precedence apply in the
+order their features were linked in, then in source order. A repeated SET is only left out if applying it again could
+not change anything: it does not read its own target (applying ``speed = speed + 5`` twice is not the same as once),
+and no statement between the two copies writes its target or a target it reads. PUSHes are always kept, since two
+features that push the same value push it twice.
+"""
+import warnings
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import gfs_ast, instrumentation
+from .dependencies import dynamic_targets
+from .errors import GFSLWarning
+
+
+class Bundle:
+    """
+    The linked statements of many features (*statements*, in evaluation order), given as (name, statements) pairs.
+    *sources* lists the names of the features that each statement of the bundle came from, and *duplicates* is the
+    number of statements that were left out.
+
+    *resolve_target* maps a statement's target string to the name it is stored under, like for a DependencyGraph; by
+    default targets are compared as written.
+    """
+
+    def __init__(
+        self,
+        features: Iterable[Tuple[str, List[gfs_ast.Statement]]],
+        resolve_target: Optional[Callable[[str], str]] = None,
+    ):
+        if resolve_target is None:
+            resolve_target = str
+        entries = [(stmt, name) for name, feature in features for stmt in feature]
+        entries.sort(key=lambda entry: entry[0].precedence)
+
+        self.statements: List[gfs_ast.Statement] = []
+        self.sources: List[List[str]] = []
+        self.duplicates = 0
+
+        reads_cache = {}
+        # target -> the index of the last statement in the bundle that writes it
+        last_write: Dict[str, int] = {}
+        # (precedence, target, operand) -> the index of the SET in the bundle
+        sets: Dict[Tuple[float, str, gfs_ast.Expression], int] = {}
+        for stmt, name in entries:
+            target = resolve_target(stmt.target)
+            if stmt.operator is gfs_ast.StatementOperators.SET:
+                reads = {resolve_target(read) for read in dynamic_targets(stmt.operand, reads_cache)}
+                key = (stmt.precedence, target, stmt.operand)
+                i = sets.get(key)
+                if (
+                    i is not None
+                    and target not in reads
+                    and last_write[target] == i
+                    and all(last_write.get(read, -1) < i for read in reads)
+                ):
+                    if name not in self.sources[i]:
+                        self.sources[i].append(name)
+                    self.duplicates += 1
+                    continue
+                sets[key] = len(self.statements)
+            last_write[target] = len(self.statements)
+            self.statements.append(stmt)
+            self.sources.append([name])
+
+        instrumentation.count("linked_duplicates", self.duplicates)
+
+    def conflicts(self) -> List[str]:
+        """Returns a description of each target that is set to different values at the same precedence."""
+        # (target, precedence) -> operand -> the features that set it
+        values: Dict[Tuple[str, float], Dict[gfs_ast.Expression, List[str]]] = {}
+        for stmt, sources in zip(self.statements, self.sources):
+            if stmt.operator is gfs_ast.StatementOperators.SET:
+                features = values.setdefault((stmt.target, stmt.precedence), {}).setdefault(stmt.operand, [])
+                features.extend(name for name in sources if name not in features)
+
+        conflicts = []
+        for (target, precedence), operands in values.items():
+            if len(operands) < 2:
+                continue
+            features = list(dict.fromkeys(name for names in operands.values() for name in names))
+            conflicts.append(
+                f"{target!r} is set to {len(operands)} different values at precedence {precedence} (by "
+                f"{', '.join(features)}); the result depends on the order the features are linked in"
+            )
+        return conflicts
+
+    def check(self):
+        """Issues a GFSLWarning for each conflict."""
+        for conflict in self.conflicts():
+            warnings.warn(conflict, GFSLWarning, stacklevel=2)
+
+
+def link(features: Iterable[Tuple[str, List[gfs_ast.Statement]]]) -> Bundle:
+    return Bundle(features)
@@ -0,0 +1,275 @@
+"""
+The optimizer is an optional pass over the GFS AST that the compiler outputs, making expressions smaller so that the
+GFS engine has less to evaluate.
+
+Optimization levels:
+
+- 0: no optimization; the compiler's output is used as-is.
+- 1: flattens nested associative operators (e.g. ``ADD(ADD(a, 1), 2)`` -> ``ADD(a, 1, 2)``), folds all the static
+  operands of ADD/MULTIPLY/MIN/MAX together (-> ``ADD(a, 3)``), drops identities, and dedupes MIN/MAX operands.
+  Multiplying out static factors cancels double negations.
+- 2: also combines like terms in sums (e.g. ``a - a`` -> ``0``) and distributes static factors (e.g. negations) over
+  sums when that makes the expression smaller.
+
+At level 1 and up, the extended engine's operators (see gfs_ast.ENGINES) are folded when their operands are static,
+and conditionals with a static condition (or the same value in both branches) are replaced by their value.
+
+Folding static operands changes the order in which they are evaluated, so floating point results may differ in the
+last place.
+"""
+import functools
+import math
+import operator
+from typing import Dict, Iterable, Iterator, List
+
+from . import gfs_ast, instrumentation
+
+Ops = gfs_ast.ExpressionOperators
+
+DEFAULT_LEVEL = 1
+LEVELS = (0, 1, 2)
+
+
+class Optimizer:
+    associative_operators = {
+        Ops.ADD: operator.add,
+        Ops.MULTIPLY: operator.mul,
+        Ops.MIN: min,
+        Ops.MAX: max,
+    }
+    identities = {
+        Ops.ADD: 0,
+        Ops.MULTIPLY: 1,
+    }
+    # the other operators that can be folded if all their operands are static (division by zero is left to the engine)
+    static_operators = {
+        Ops.SUBTRACT: lambda left, right: left - right,
+        Ops.DIVIDE: lambda left, right: left / right if right != 0 else None,
+        Ops.CEIL: math.ceil,
+        Ops.ROUND: lambda value: math.floor(value + 0.5),
+        Ops.ABS: abs,
+        Ops.EQUAL: lambda left, right: int(left == right),
+        Ops.NOT_EQUAL: lambda left, right: int(left != right),
+        Ops.LESS_THAN: lambda left, right: int(left < right),
+        Ops.LESS_THAN_OR_EQUAL: lambda left, right: int(left <= right),
+        Ops.GREATER_THAN: lambda left, right: int(left > right),
+        Ops.GREATER_THAN_OR_EQUAL: lambda left, right: int(left >= right),
+    }
+    # bounds the memoized subtrees while optimizing a stream of statements (see optimize_statements)
+    max_streamed_subtrees = 16384
+
+    def __init__(self, level: int = DEFAULT_LEVEL):
+        self.level = level
+        # expressions are hash-consed, so shared subtrees are only optimized once
+        self._optimized: Dict[gfs_ast.Expression, gfs_ast.Expression] = {}
+        self._sizes: Dict[gfs_ast.Expression, int] = {}
+
+    def optimize(self, feature: List[gfs_ast.Statement]) -> List[gfs_ast.Statement]:
+        if not self.level:
+            return feature
+        with instrumentation.stage("optimize"):
+            return [self.optimize_statement(stmt) for stmt in feature]
+
+    def optimize_statements(self, statements: Iterable[gfs_ast.Statement]) -> Iterator[gfs_ast.Statement]:
+        """
+        Optimizes a stream of statements (e.g. from Compiler.compile_statements) one at a time. The memoized subtrees
+        are dropped whenever there are more than max_streamed_subtrees of them, so that memory does not grow with the
+        length of the feature.
+        """
+        for stmt in statements:
+            if not self.level:
+                yield stmt
+                continue
+            with instrumentation.stage("optimize"):
+                optimized = self.optimize_statement(stmt)
+                if len(self._optimized) + len(self._sizes) > self.max_streamed_subtrees:
+                    self._optimized.clear()
+                    self._sizes.clear()
+            yield optimized
+
+    def optimize_statement(self, stmt: gfs_ast.Statement) -> gfs_ast.Statement:
+        operand = self.optimize_expression(stmt.operand)
+        origins = stmt.origins
+        if origins:
+            # a new node comes from the last node (in compile order, so the outermost) that was optimized to it
+            origins = dict(origins)
+            for node, origin in stmt.origins.items():
+                optimized = self._optimized.get(node)
+                if optimized is not None and optimized not in stmt.origins:
+                    origins[optimized] = origin
+        return gfs_ast.Statement(
+            precedence=stmt.precedence,
+            target=stmt.target,
+            operator=stmt.operator,
+            operand=operand,
+            origin=stmt.origin,
+            origins=origins,
+        )
+
+    def optimize_expression(self, expr: gfs_ast.Expression) -> gfs_ast.Expression:
+        # iterative post-order, since compiled expressions can be deeper than the recursion limit
+        stack = [expr]
+        while stack:
+            node = stack[-1]
+            if node in self._optimized:
+                stack.pop()
+                continue
+            if not isinstance(node.operands, tuple):
+                self._optimized[node] = node
+                stack.pop()
+                continue
+            pending = [operand for operand in node.operands if operand not in self._optimized]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            operands = [self._optimized[operand] for operand in node.operands]
+            optimized = self._optimized[node] = self.rewrite(node.operator, operands)
+            if self.level >= 2:
+                # size the optimized nodes bottom-up, so that sizing them later never recurses deeply
+                self.size(optimized)
+        return self._optimized[expr]
+
+    # ==== rewrites ====
+    # each rewrite assumes that its operands are already optimized
+    def rewrite(self, op: gfs_ast.ExpressionOperators, operands: List[gfs_ast.Expression]) -> gfs_ast.Expression:
+        if op in self.associative_operators and operands:
+            return self.rewrite_associative(op, operands)
+        if op is Ops.FLOOR and len(operands) == 1:
+            return self.rewrite_floor(operands[0])
+        if op is Ops.IF and len(operands) == 3:
+            return self.rewrite_if(*operands)
+        if op in self.static_operators and all(isinstance(operand, gfs_ast.StaticExpression) for operand in operands):
+            folded = self.static_operators[op](*(operand.operands for operand in operands))
+            if folded is not None:
+                instrumentation.count("constant_folds")
+                return gfs_ast.StaticExpression(folded)
+        return gfs_ast.Expression(op, operands)
+
+    def rewrite_associative(
+        self, op: gfs_ast.ExpressionOperators, operands: List[gfs_ast.Expression]
+    ) -> gfs_ast.Expression:
+        # flatten: operands are already optimized, so nested operations of the same kind are already flat
+        # (this can only be empty if the input had an empty nested operation, e.g. ADD(ADD()))
+        flat = []
+        for operand in operands:
+            if operand.operator is op:
+                flat.extend(operand.operands)
+            else:
+                flat.append(operand)
+
+        statics = [operand.operands for operand in flat if isinstance(operand, gfs_ast.StaticExpression)]
+        dynamics = [operand for operand in flat if not isinstance(operand, gfs_ast.StaticExpression)]
+        # a single static operand is not folded with anything, so it is left where it was (as the number of dynamic
+        # operands before it), e.g. MAX(1, a) stays as written
+        static_position = None
+        if len(statics) == 1:
+            static_position = next(i for i, operand in enumerate(flat) if isinstance(operand, gfs_ast.StaticExpression))
+        if op in (Ops.MIN, Ops.MAX):
+            # min/max are idempotent (and interned nodes are equal by identity)
+            dynamics = list(dict.fromkeys(dynamics))
+        elif op is Ops.ADD and self.level >= 2:
+            dynamics = self.combine_like_terms(dynamics)
+
+        if not statics and not dynamics:
+            # every term cancelled out
+            return gfs_ast.StaticExpression(0)
+        if statics:
+            if len(statics) > 1:
+                instrumentation.count("constant_folds", len(statics) - 1)
+            folded = functools.reduce(self.associative_operators[op], statics)
+            if not dynamics:
+                return gfs_ast.StaticExpression(folded)
+            if op is Ops.MULTIPLY and folded == 0:
+                return gfs_ast.StaticExpression(0)
+            if op in self.identities and folded == self.identities[op]:
+                statics = []
+            else:
+                statics = [folded]
+
+        if not statics and len(dynamics) == 1:
+            return dynamics[0]
+        if self.level >= 2 and op is Ops.MULTIPLY and statics and len(dynamics) == 1:
+            if dynamics[0].operator is Ops.ADD:
+                return self.distribute(statics[0], dynamics[0])
+        if static_position is not None and statics:
+            position = min(static_position, len(dynamics))
+            return gfs_ast.Expression(
+                op, dynamics[:position] + [gfs_ast.StaticExpression(statics[0])] + dynamics[position:]
+            )
+        return gfs_ast.Expression(op, dynamics + [gfs_ast.StaticExpression(value) for value in statics])
+
+    def rewrite_floor(self, operand: gfs_ast.Expression) -> gfs_ast.Expression:
+        if isinstance(operand, gfs_ast.StaticExpression):
+            instrumentation.count("constant_folds")
+            return gfs_ast.StaticExpression(math.floor(operand.operands))
+        if operand.operator in (Ops.FLOOR, Ops.CEIL, Ops.ROUND):
+            # floor is idempotent, and the others are integers already
+            return operand
+        return gfs_ast.Expression(Ops.FLOOR, [operand])
+
+    @staticmethod
+    def rewrite_if(
+        condition: gfs_ast.Expression, true: gfs_ast.Expression, false: gfs_ast.Expression
+    ) -> gfs_ast.Expression:
+        if isinstance(condition, gfs_ast.StaticExpression):
+            instrumentation.count("constant_folds")
+            return true if condition.operands else false
+        if true is false:
+            return true
+        return gfs_ast.Expression(Ops.IF, [condition, true, false])
+
+    # ==== level 2 ====
+    @staticmethod
+    def split_coefficient(term: gfs_ast.Expression):
+        """Splits a term into (base, static coefficient), e.g. MULTIPLY(a, -1) -> (a, -1)."""
+        if term.operator is Ops.MULTIPLY:
+            # an optimized multiplication has at most one static factor
+            for i, factor in enumerate(term.operands):
+                if isinstance(factor, gfs_ast.StaticExpression):
+                    factors = term.operands[:i] + term.operands[i + 1 :]
+                    base = factors[0] if len(factors) == 1 else gfs_ast.Expression(Ops.MULTIPLY, factors)
+                    return base, factor.operands
+        return term, 1
+
+    def combine_like_terms(self, terms: List[gfs_ast.Expression]) -> List[gfs_ast.Expression]:
+        coefficients = {}
+        for term in terms:
+            base, coefficient = self.split_coefficient(term)
+            coefficients[base] = coefficients.get(base, 0) + coefficient
+        if len(coefficients) == len(terms):
+            return terms
+        combined = [
+            self.rewrite(Ops.MULTIPLY, [base, gfs_ast.StaticExpression(coefficient)])
+            for base, coefficient in coefficients.items()
+            if coefficient != 0
+        ]
+        # e.g. a + a -> a * 2 does not make the sum any smaller
+        if sum(map(self.size, combined)) < sum(map(self.size, terms)):
+            return combined
+        return terms
+
+    def distribute(self, factor, addition: gfs_ast.Expression) -> gfs_ast.Expression:
+        """Returns whichever of MULTIPLY(ADD(a, b...), k) and ADD(a * k, b * k...) is smaller."""
+        undistributed = gfs_ast.Expression(Ops.MULTIPLY, [addition, gfs_ast.StaticExpression(factor)])
+        distributed = self.rewrite(
+            Ops.ADD,
+            [self.rewrite(Ops.MULTIPLY, [term, gfs_ast.StaticExpression(factor)]) for term in addition.operands],
+        )
+        if self.size(distributed) < self.size(undistributed):
+            return distributed
+        return undistributed
+
+    def size(self, expr: gfs_ast.Expression) -> int:
+        """The number of nodes in the expression, as a tree (i.e. how many nodes the engine evaluates)."""
+        if expr in self._sizes:
+            return self._sizes[expr]
+        size = 1
+        if isinstance(expr.operands, tuple):
+            size += sum(self.size(operand) for operand in expr.operands)
+        self._sizes[expr] = size
+        return size
+
+
+def optimize(feature: List[gfs_ast.Statement], level: int = DEFAULT_LEVEL) -> List[gfs_ast.Statement]:
+    return Optimizer(level).optimize(feature)
@@ -1,14 +1,21 @@
+import functools
+import hashlib
 import os
+import sys
+from typing import Iterable, Iterator, List, Optional
 
 import lark
 from lark import Lark, Transformer, v_args
 
+from . import errors, fast_parser, instrumentation
 from .imf_ast import (
     BinOp,
     Call,
     Feature,
+    FeatureStatement,
     FunctionalMacroDef,
     FunctionalMacroSig,
+    Import,
     Literal,
     Macro,
     MacroCall,
@@ -16,6 +23,7 @@ from .imf_ast import (
     Statement,
     Target,
     Ternary,
+    set_line,
 )
 
 
@@ -27,25 +35,34 @@ class GFSTransformer(Transformer):
     def feature(self, meta: lark.tree.Meta, children):
         return Feature(children).populate_posinfo(meta)
 
+    def import_stmt(self, meta: lark.tree.Meta, path: lark.Token):
+        # strip the quotes
+        return Import(path.value[1:-1]).populate_posinfo(meta)
+
     # ==== macros ====
     def static_macro_def(self, meta: lark.tree.Meta, identifier, expression):
-        return MacroDef(str(identifier), expression).populate_posinfo(meta)
+        return MacroDef(sys.intern(str(identifier)), expression).populate_posinfo(meta)
 
     def functional_macro_def(self, meta: lark.tree.Meta, signature, expression):
         return FunctionalMacroDef(signature, expression).populate_posinfo(meta)
 
     def fmacro_sig(self, meta: lark.tree.Meta, identifier, *arg_names: str):
-        return FunctionalMacroSig(str(identifier), *arg_names).populate_posinfo(meta)
+        return FunctionalMacroSig(sys.intern(str(identifier)), *arg_names).populate_posinfo(meta)
 
     def fmacro_arg(self, _, identifier):
-        return str(identifier)
+        return sys.intern(str(identifier))
 
     def ternary(self, meta: lark.tree.Meta, condition, true, false):
         return Ternary(condition, true, false).populate_posinfo(meta)
 
     # ==== GFS statements ====
     def rule_statement(self, meta: lark.tree.Meta, precedence, target, statement_op, expression):
-        return Statement(float(precedence), str(target), str(statement_op), expression).populate_posinfo(meta)
+        return Statement(
+            float(precedence), sys.intern(str(target)), str(statement_op), expression
+        ).populate_posinfo(meta)
+
+    def comparison(self, meta: lark.tree.Meta, left, op, right):
+        return BinOp(left, str(op), right).populate_posinfo(meta)
 
     def a_num(self, meta: lark.tree.Meta, left, op, right):
         return BinOp(left, str(op), right).populate_posinfo(meta)
@@ -54,7 +71,7 @@ class GFSTransformer(Transformer):
         return BinOp(left, str(op), right).populate_posinfo(meta)
 
     def call(self, meta: lark.tree.Meta, identifier, *args):
-        return Call(str(identifier), *args).populate_posinfo(meta)
+        return Call(sys.intern(str(identifier)), *args).populate_posinfo(meta)
 
     def literal(self, meta: lark.tree.Meta, number: lark.Token):
         try:
@@ -63,27 +80,142 @@ class GFSTransformer(Transformer):
             return Literal(float(number)).populate_posinfo(meta)
 
     def target(self, meta: lark.tree.Meta, target: lark.Token):
-        return Target(target.value).populate_posinfo(meta)
+        return Target(sys.intern(target.value)).populate_posinfo(meta)
 
     def macro(self, meta: lark.tree.Meta, identifier: lark.Token):
-        return Macro(identifier.value).populate_posinfo(meta)
+        return Macro(sys.intern(identifier.value)).populate_posinfo(meta)
 
     def macro_call(self, meta: lark.tree.Meta, identifier: lark.Token, *args):
-        return MacroCall(identifier.value, *args).populate_posinfo(meta)
+        return MacroCall(sys.intern(identifier.value), *args).populate_posinfo(meta)
 
 
 with open(os.path.join(os.path.dirname(__file__), "gfs.lark")) as f:
     grammar = f.read()
-parser = Lark(grammar, start="feature", propagate_positions=True)
+grammar_hash = hashlib.sha256(grammar.encode()).hexdigest()[:16]
 transformer = GFSTransformer()
 
+# ===== parser construction =====
+# "earley" is the original parser; "lalr" is much faster, and its parse tables are cached on disk; "fast" is a
+# hand-written parser (see gfslang.fast_parser) that is faster still, and raises GFSLSyntaxError instead of Lark errors
+PARSER_MODES = ("earley", "lalr", "fast")
+DEFAULT_PARSER_MODE = os.environ.get("GFSL_PARSER", "earley")
+CACHE_DIR = os.environ.get("GFSL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "gfslang"))
+
+
+def parser_cache_path() -> str:
+    """The path of the serialized LALR parser, keyed by grammar hash and Lark version."""
+    return os.path.join(CACHE_DIR, f"gfs-lalr-{grammar_hash}-lark{lark.__version__}.pickle")
+
+
+@functools.lru_cache(maxsize=None)
+def get_parser(mode: str = DEFAULT_PARSER_MODE) -> Lark:
+    """
+    Returns the Lark parser for the given mode, building it on first use.
+    The LALR parser is loaded from the on-disk cache if possible, skipping grammar analysis.
+    """
+    if mode == "earley":
+        with instrumentation.stage("parser_init"):
+            return Lark(grammar, start="feature", propagate_positions=True)
+    elif mode == "lalr":
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            cache = parser_cache_path()
+        except OSError:
+            cache = False
+        with instrumentation.stage("parser_init"):
+            return Lark(grammar, start="feature", parser="lalr", propagate_positions=True, cache=cache)
+    raise ValueError(f"Unknown parser mode {mode!r}, expected one of {PARSER_MODES}")
+
+
+def prepare(mode: str = DEFAULT_PARSER_MODE):
+    """Builds the parser for the given mode ahead of time, so that the first parse does not pay for it."""
+    if mode != "fast":
+        get_parser(mode)
+
+
+def parse(
+    feature: str, mode: str = DEFAULT_PARSER_MODE, diagnostics: Optional[List[errors.GFSLSyntaxError]] = None
+) -> Feature:
+    """
+    Parses a feature into the IMF AST. If a *diagnostics* list is given, parsing recovers from syntax errors: each line
+    with a syntax error is skipped (statements cannot span lines, so parsing resynchronizes at the next line) and its
+    error is appended to *diagnostics* as a GFSLSyntaxError, and the feature of the remaining lines is returned.
+    """
+    with instrumentation.stage("parse"):
+        if mode == "fast":
+            return fast_parser.parse(feature, diagnostics)
+        try:
+            parsed = get_parser(mode).parse(feature)
+        except lark.exceptions.UnexpectedInput:
+            if diagnostics is None:
+                raise
+            return _parse_recovering(feature, mode, diagnostics)
+        return transformer.transform(parsed)
+
 
-def parse(feature: str) -> Feature:
-    parsed = parser.parse(feature)
-    return transformer.transform(parsed)
+def _parse_recovering(feature: str, mode: str, diagnostics: List[errors.GFSLSyntaxError]) -> Feature:
+    statements = []
+    for lineno, line in enumerate(feature.split("\n"), start=1):
+        try:
+            stmt = _parse_line_lark(line, lineno, mode)
+        except errors.GFSLSyntaxError as e:
+            diagnostics.append(e)
+            continue
+        if stmt is not None:
+            statements.append(stmt)
+    result = Feature(statements)
+    if statements:
+        result.line, result.column = statements[0].line, statements[0].column
+        result.end_line, result.end_column = statements[-1].end_line, statements[-1].end_column
+    else:
+        result.line = result.column = result.end_line = result.end_column = 1
+    return result
+
+
+def parse_lines(lines: Iterable[str], mode: str = DEFAULT_PARSER_MODE) -> Iterator[FeatureStatement]:
+    """
+    Parses a feature one line at a time (e.g. straight from a file), yielding each statement as soon as it is parsed,
+    so that the whole feature never needs to be in memory. Since every statement is on a single line, this parses the
+    same statements (at the same positions) as parse. Syntax errors raise GFSLSyntaxError in every mode.
+    """
+    if mode == "fast":
+        parser = fast_parser.FastParser()
+    for lineno, line in enumerate(lines, start=1):
+        if line.endswith("\n"):
+            line = line[:-1]
+        with instrumentation.stage("parse"):
+            if mode == "fast":
+                stmt = parser.parse_line(line, lineno)
+                instrumentation.count("imf_nodes", parser.nodes)
+                parser.nodes = 0
+            else:
+                stmt = _parse_line_lark(line, lineno, mode)
+        if stmt is not None:
+            yield stmt
+
+
+def _parse_line_lark(line: str, lineno: int, mode: str) -> Optional[FeatureStatement]:
+    stripped = line.strip(" \t")
+    if not stripped or stripped.startswith("#"):
+        # Lark cannot build a feature without any tokens
+        return None
+    try:
+        statements = transformer.transform(get_parser(mode).parse(line)).statements
+    except lark.exceptions.UnexpectedInput as e:
+        # the error is relative to the line, not the feature; the Earley parser has no column for an unexpected end
+        column = e.column if e.column > 0 else len(line) + 1
+        raise errors.GFSLSyntaxError(
+            f"Invalid syntax at line {lineno}, column {column}:\n{e.get_context(line)}", lineno, column
+        ) from e
+    if not statements:
+        return None
+    if lineno != 1:
+        set_line(statements[0], lineno)
+    return statements[0]
 
 
 if __name__ == "__main__":
+    parser = get_parser()
     while True:
         result = parser.parse(input())
         print(result.pretty())
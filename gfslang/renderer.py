@@ -1,68 +1,462 @@
 """
-The renderer is responsible for taking a GFS AST and outputting a TypeScript program or JSON.
+The renderer is responsible for taking a GFS AST and outputting a TypeScript program, JSON, MessagePack, or a Python
+module (see gfslang.codegen).
 """
 import abc
-import numbers
-import textwrap
-from typing import List
+import contextlib
+import io
+import json
+import struct
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, TypeVar
 
-from . import gfs_ast
+from . import gfs_ast, instrumentation
+from .codegen import CodeGenerator
+from .sourcemap import SourceMap, TrackingWriter
+
+_T = TypeVar("_T")
 
 
 class Renderer(abc.ABC):
-    def render(self, feature: List[gfs_ast.Statement]) -> str:
+    file_extension = ".txt"
+    binary = False
+    # whether the output can be mapped back to the source (see gfslang.sourcemap)
+    source_maps = True
+
+    # while rendering with a source map: the map, the origins of the current statement, and the origin of the closest
+    # mapped ancestor of the current node
+    _source_map: Optional[SourceMap] = None
+    _origins: Optional[Dict[gfs_ast.Expression, gfs_ast.Origin]] = None
+    _origin: Optional[gfs_ast.Origin] = None
+
+    def render(self, feature: List[gfs_ast.Statement], source_map: Optional[SourceMap] = None) -> str:
+        out = io.StringIO()
+        with instrumentation.stage("render"):
+            self.write(feature, out, source_map)
+        instrumentation.count("output_bytes", out.tell())
+        return out.getvalue()
+
+    def write(self, feature: List[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None):
+        """
+        Renders the feature directly to a text stream. If a *source_map* is given, the position of each statement and
+        expression in the output is mapped to its origin (see gfslang.sourcemap).
+        """
         raise NotImplementedError
 
+    def write_stream(
+        self, statements: Iterable[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None
+    ):
+        """
+        Renders statements to a stream as they are produced (e.g. by Optimizer.optimize_statements), without holding
+        the whole feature in memory.
+        """
+        raise NotImplementedError
+
+    # ==== source maps ====
+    @contextlib.contextmanager
+    def mapping(self, out: TextIO, source_map: Optional[SourceMap]) -> Iterator[TextIO]:
+        """Returns the stream to write to, which keeps track of the output position if there is a source map."""
+        if source_map is None:
+            yield out
+            return
+        self._source_map = source_map
+        try:
+            yield TrackingWriter(out)
+        finally:
+            self._source_map = self._origins = self._origin = None
+
+    def map_statement(self, out: TrackingWriter, stmt: gfs_ast.Statement):
+        self._source_map.add_statement(stmt.origin)
+        self._origins = stmt.origins
+        self._origin = stmt.origin
+        if stmt.origin is not None:
+            self._source_map.add(out.line, out.column, stmt.origin)
+
+    def map_expression(self, out: TrackingWriter, expr: gfs_ast.Expression) -> Optional[gfs_ast.Origin]:
+        """Maps the expression about to be written. Returns the previous origin, to restore after writing it."""
+        parent = self._origin
+        origin = self._origins.get(expr, parent) if self._origins else parent
+        if origin is not None:
+            self._source_map.add(out.line, out.column, origin)
+        self._origin = origin
+        return parent
+
 
 class TSRenderer(Renderer):
-    """Outputs the GFSL program as a TypeScript object."""
+    """
+    Outputs the GFSL program as a TypeScript object.
 
-    def render(self, feature: List[gfs_ast.Statement]) -> str:
-        statements = []
-        for stmt in feature:
-            stmt_inner = self.render_statement(stmt)
-            statements.append(stmt_inner)
-        return self.render_list(statements)
+    Everything is written straight to the output stream and the indentation is tracked as we go, so rendering is
+    linear in the size of the output no matter how deeply expressions are nested.
+    """
 
-    @staticmethod
-    def render_list(elems: List[str]) -> str:
-        inner = textwrap.indent(",\n".join(elems), " " * 4)
-        return f"[\n{inner}\n]"
+    file_extension = ".ts"
+    indent = " " * 4
+
+    def write(self, feature: List[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None):
+        with self.mapping(out, source_map) as out:
+            self.write_list(out, feature, self.write_statement, 0)
+
+    def write_stream(
+        self, statements: Iterable[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None
+    ):
+        def write_statement(out_: TextIO, stmt: gfs_ast.Statement, depth: int):
+            with instrumentation.stage("render"):
+                self.write_statement(out_, stmt, depth)
+
+        with self.mapping(out, source_map) as out:
+            self.write_list(out, statements, write_statement, 0)
 
     def render_statement(self, stmt: gfs_ast.Statement) -> str:
-        operand_inner = textwrap.indent(self.render_expression(stmt.operand), " " * 4).strip()
-        return (
-            textwrap.dedent(
-                """
-                {{
-                    precedence: {precedence},
-                    target: `{target}`,
-                    operator: StatementOperators.{operator},
-                    operand: {operand}
-                }}
-                """
-            )
-            .strip()
-            .format(precedence=stmt.precedence, target=stmt.target, operator=stmt.operator.value, operand=operand_inner)
-        )
+        out = io.StringIO()
+        self.write_statement(out, stmt, 0)
+        return out.getvalue()
 
     def render_expression(self, expr: gfs_ast.Expression) -> str:
-        if isinstance(expr.operands, (int, float)):
-            operands_inner = str(expr.operands)
-        elif isinstance(expr.operands, str):
-            operands_inner = f"`{expr.operands}`"
+        out = io.StringIO()
+        self.write_expression(out, expr, 0)
+        return out.getvalue()
+
+    # ==== stream writers ====
+    # each writer assumes that the current line has already been indented to *depth*, and leaves the cursor at the
+    # end of its last line
+    def write_list(
+        self, out: TextIO, elems: Iterable[_T], write_elem: Callable[[TextIO, _T, int], None], depth: int
+    ):
+        inner_indent = self.indent * (depth + 1)
+        out.write("[\n")
+        for i, elem in enumerate(elems):
+            if i:
+                out.write(",\n")
+            out.write(inner_indent)
+            write_elem(out, elem, depth + 1)
+        out.write("\n")
+        out.write(self.indent * depth)
+        out.write("]")
+
+    def write_statement(self, out: TextIO, stmt: gfs_ast.Statement, depth: int):
+        if self._source_map is not None:
+            self.map_statement(out, stmt)
+        inner_indent = self.indent * (depth + 1)
+        out.write("{\n")
+        out.write(f"{inner_indent}precedence: {stmt.precedence},\n")
+        out.write(f"{inner_indent}target: `{stmt.target}`,\n")
+        out.write(f"{inner_indent}operator: StatementOperators.{stmt.operator.value},\n")
+        out.write(f"{inner_indent}operand: ")
+        self.write_expression(out, stmt.operand, depth + 1)
+        out.write("\n")
+        out.write(self.indent * depth)
+        out.write("}")
+
+    def write_expression(self, out: TextIO, expr: gfs_ast.Expression, depth: int):
+        # iterative, since compiled expressions can be deeper than the recursion limit: each entry on the stack is text
+        # to write followed by an expression to write at a depth, or None for the text that closes an expression
+        mapped = self._source_map is not None
+        parents: List[Optional[gfs_ast.Origin]] = []
+        stack: List[Tuple[str, Optional[gfs_ast.Expression], int]] = [("", expr, depth)]
+        while stack:
+            text, node, depth = stack.pop()
+            out.write(text)
+            if node is None:
+                if mapped:
+                    self._origin = parents.pop()
+                continue
+            if mapped:
+                parents.append(self.map_expression(out, node))
+            inner_indent = self.indent * (depth + 1)
+            out.write("{\n")
+            out.write(f"{inner_indent}operator: ExpressionOperators.{node.operator.value},\n")
+            out.write(f"{inner_indent}operands: ")
+            closing = f"\n{self.indent * depth}}}"
+            if isinstance(node.operands, (int, float)):
+                out.write(str(node.operands))
+            elif isinstance(node.operands, str):
+                out.write(f"`{node.operands}`")
+            else:
+                # the same as write_list
+                operand_indent = self.indent * (depth + 2)
+                out.write("[\n")
+                closing = f"\n{inner_indent}]{closing}"
+                stack.append((closing, None, depth))
+                for i in reversed(range(len(node.operands))):
+                    stack.append((f",\n{operand_indent}" if i else operand_indent, node.operands[i], depth + 2))
+                continue
+            stack.append((closing, None, depth))
+
+
+class WireRenderer(Renderer, abc.ABC):
+    """
+    Base class for renderers that output the GFS engine's wire shape directly, so that a feature can be loaded without
+    evaluating any JS. Operators are rendered as their enum names (e.g. ``"ADD"``).
+    """
+
+    def __init__(self):
+        # gfs_ast expressions are hash-consed, so each shared subtree only needs to be converted once per render
+        self._wire_cache: Dict[gfs_ast.Expression, Dict[str, Any]] = {}
+
+    def feature_to_wire(self, feature: List[gfs_ast.Statement]) -> List[Dict[str, Any]]:
+        try:
+            return [self.statement_to_wire(stmt) for stmt in feature]
+        finally:
+            self._wire_cache.clear()
+
+    def statement_to_wire(self, stmt: gfs_ast.Statement) -> Dict[str, Any]:
+        return {
+            "precedence": stmt.precedence,
+            "target": stmt.target,
+            "operator": stmt.operator.value,
+            "operand": self.expression_to_wire(stmt.operand),
+        }
+
+    def expression_to_wire(self, expr: gfs_ast.Expression) -> Dict[str, Any]:
+        # iterative post-order, since compiled expressions can be deeper than the recursion limit
+        stack = [expr]
+        while stack:
+            node = stack[-1]
+            if node in self._wire_cache:
+                stack.pop()
+                continue
+            if isinstance(node.operands, (int, float, str)):
+                operands = node.operands
+            else:
+                pending = [operand for operand in node.operands if operand not in self._wire_cache]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                operands = [self._wire_cache[operand] for operand in node.operands]
+            stack.pop()
+            self._wire_cache[node] = {"operator": node.operator.value, "operands": operands}
+        return self._wire_cache[expr]
+
+
+class JSONRenderer(WireRenderer):
+    """
+    Outputs the GFSL program as JSON.
+
+    The JSON is written directly rather than with json.dump, which recurses into nested objects, so that expressions
+    can be nested deeper than the recursion limit.
+    """
+
+    file_extension = ".json"
+
+    def __init__(self, indent: Optional[int] = None):
+        super().__init__()
+        self.indent = indent
+
+    def write(self, feature: List[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None):
+        with self.mapping(out, source_map) as out:
+            self.write_statements(out, feature)
+
+    def write_stream(
+        self, statements: Iterable[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None
+    ):
+        with self.mapping(out, source_map) as out:
+            self.write_statements(out, statements, stream=True)
+
+    # ==== writers ====
+    # the writers write the same JSON as json.dump of the wire shape, keeping track of where each node starts if there
+    # is a source map
+    def newline(self, level: int) -> str:
+        if self.indent is None:
+            return ""
+        return "\n" + (" " * self.indent if isinstance(self.indent, int) else self.indent) * level
+
+    def write_statements(self, out: TextIO, statements: Iterable[gfs_ast.Statement], stream: bool = False):
+        separator = ", " if self.indent is None else ","
+        out.write("[")
+        empty = True
+        for stmt in statements:
+            with instrumentation.stage("render") if stream else contextlib.nullcontext():
+                if not empty:
+                    out.write(separator)
+                out.write(self.newline(1))
+                self.write_statement(out, stmt, 1)
+            empty = False
+        if not empty:
+            out.write(self.newline(0))
+        out.write("]")
+
+    def write_statement(self, out: TextIO, stmt: gfs_ast.Statement, level: int):
+        if self._source_map is not None:
+            self.map_statement(out, stmt)
+        separator = ", " if self.indent is None else ","
+        newline = self.newline(level + 1)
+        out.write("{")
+        out.write(f'{newline}"precedence": {json.dumps(stmt.precedence)}{separator}')
+        out.write(f'{newline}"target": {json.dumps(stmt.target)}{separator}')
+        out.write(f'{newline}"operator": {json.dumps(stmt.operator.value)}{separator}')
+        out.write(f'{newline}"operand": ')
+        self.write_expression(out, stmt.operand, level + 1)
+        out.write(self.newline(level))
+        out.write("}")
+
+    def write_expression(self, out: TextIO, expr: gfs_ast.Expression, level: int):
+        # iterative, like TSRenderer.write_expression: each entry on the stack is text to write followed by an
+        # expression to write at a level, or None for the text that closes an expression
+        mapped = self._source_map is not None
+        separator = ", " if self.indent is None else ","
+        parents: List[Optional[gfs_ast.Origin]] = []
+        stack: List[Tuple[str, Optional[gfs_ast.Expression], int]] = [("", expr, level)]
+        while stack:
+            text, node, level = stack.pop()
+            out.write(text)
+            if node is None:
+                if mapped:
+                    self._origin = parents.pop()
+                continue
+            if mapped:
+                parents.append(self.map_expression(out, node))
+            newline = self.newline(level + 1)
+            out.write(f'{{{newline}"operator": {json.dumps(node.operator.value)}{separator}{newline}"operands": ')
+            closing = f"{self.newline(level)}}}"
+            if not isinstance(node.operands, tuple):
+                out.write(json.dumps(node.operands))
+            elif not node.operands:
+                out.write("[]")
+            else:
+                operand_newline = self.newline(level + 2)
+                out.write("[")
+                stack.append((f"{newline}]{closing}", None, level))
+                for i in reversed(range(len(node.operands))):
+                    prefix = f"{separator}{operand_newline}" if i else operand_newline
+                    stack.append((prefix, node.operands[i], level + 2))
+                continue
+            stack.append((closing, None, level))
+
+
+class MsgPackRenderer(WireRenderer):
+    """
+    Outputs the GFSL program as MessagePack: the same document as the JSONRenderer, in a compact binary encoding.
+    Only the subset of MessagePack needed by the GFS AST is implemented, so this does not need the msgpack package.
+    """
+
+    file_extension = ".msgpack"
+    binary = True
+    source_maps = False
+
+    def render(self, feature: List[gfs_ast.Statement], source_map: Optional[SourceMap] = None) -> bytes:
+        out = io.BytesIO()
+        with instrumentation.stage("render"):
+            self.write(feature, out, source_map)
+        instrumentation.count("output_bytes", out.tell())
+        return out.getvalue()
+
+    def write(self, feature: List[gfs_ast.Statement], out: BinaryIO, source_map: Optional[SourceMap] = None):
+        if source_map is not None:
+            raise ValueError("Source maps map lines and columns, so they are only supported for text formats")
+        self.pack(self.feature_to_wire(feature), out)
+
+    def write_stream(
+        self, statements: Iterable[gfs_ast.Statement], out: BinaryIO, source_map: Optional[SourceMap] = None
+    ):
+        """
+        Since the number of statements is not known until the end, streams start with a 32-bit array header that is
+        patched with the length afterwards, so *out* must be seekable.
+        """
+        if source_map is not None:
+            raise ValueError("Source maps map lines and columns, so they are only supported for text formats")
+        start = out.tell()
+        out.write(b"\xdd\x00\x00\x00\x00")
+        length = 0
+        for stmt in statements:
+            with instrumentation.stage("render"):
+                self.pack(self.statement_to_wire(stmt), out)
+                self._wire_cache.clear()
+            length += 1
+        end = out.tell()
+        out.seek(start + 1)
+        out.write(struct.pack(">I", length))
+        out.seek(end)
+
+    def pack(self, obj, out: BinaryIO):
+        # iterative, since the wire shape of a compiled expression can be nested deeper than the recursion limit: the
+        # stack holds the objects still to be packed, in reverse order
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if obj is None:
+                out.write(b"\xc0")
+            elif isinstance(obj, bool):
+                out.write(b"\xc3" if obj else b"\xc2")
+            elif isinstance(obj, int) and -(1 << 63) <= obj < (1 << 64):
+                self.pack_int(obj, out)
+            elif isinstance(obj, (int, float)):
+                # ints that do not fit in 64 bits are sent as doubles, which is what the JS engine would see anyway
+                out.write(struct.pack(">Bd", 0xCB, obj))
+            elif isinstance(obj, str):
+                data = obj.encode("utf-8")
+                self.pack_header(len(data), out, fix=(0xA0, 32), headers=(0xD9, 0xDA, 0xDB))
+                out.write(data)
+            elif isinstance(obj, (list, tuple)):
+                self.pack_header(len(obj), out, fix=(0x90, 16), headers=(None, 0xDC, 0xDD))
+                stack.extend(reversed(obj))
+            elif isinstance(obj, dict):
+                self.pack_header(len(obj), out, fix=(0x80, 16), headers=(None, 0xDE, 0xDF))
+                for key, value in reversed(obj.items()):
+                    stack.append(value)
+                    stack.append(key)
+            else:
+                raise TypeError(f"Cannot pack object of type {type(obj).__name__}")
+
+    @staticmethod
+    def pack_int(value: int, out: BinaryIO):
+        if 0 <= value < 0x80:
+            out.write(struct.pack(">B", value))
+        elif -0x20 <= value < 0:
+            out.write(struct.pack(">b", value))
+        elif value >= 0:
+            for code, fmt, limit in ((0xCC, ">BB", 1 << 8), (0xCD, ">BH", 1 << 16), (0xCE, ">BI", 1 << 32)):
+                if value < limit:
+                    out.write(struct.pack(fmt, code, value))
+                    return
+            out.write(struct.pack(">BQ", 0xCF, value))
         else:
-            operand_inners = [self.render_expression(operand) for operand in expr.operands]
-            operands_inner = textwrap.indent(self.render_list(operand_inners), " " * 4).strip()
-        return (
-            textwrap.dedent(
-                """
-                {{
-                    operator: ExpressionOperators.{operator},
-                    operands: {operands}
-                }}
-                """
-            )
-            .strip()
-            .format(operator=expr.operator.value, operands=operands_inner)
-        )
+            for code, fmt, limit in ((0xD0, ">Bb", 1 << 7), (0xD1, ">Bh", 1 << 15), (0xD2, ">Bi", 1 << 31)):
+                if value >= -limit:
+                    out.write(struct.pack(fmt, code, value))
+                    return
+            out.write(struct.pack(">Bq", 0xD3, value))
+
+    @staticmethod
+    def pack_header(length: int, out: BinaryIO, fix, headers):
+        """Writes the type/length header of a str, array, or map."""
+        fix_code, fix_limit = fix
+        code8, code16, code32 = headers
+        if length < fix_limit:
+            out.write(struct.pack(">B", fix_code | length))
+        elif code8 is not None and length < (1 << 8):
+            out.write(struct.pack(">BB", code8, length))
+        elif length < (1 << 16):
+            out.write(struct.pack(">BH", code16, length))
+        else:
+            out.write(struct.pack(">BI", code32, length))
+
+
+class PythonRenderer(Renderer):
+    """
+    Outputs the GFSL program as a Python module with a function that applies its statements, which can be loaded with
+    gfslang.codegen.load.
+    """
+
+    file_extension = ".py"
+    source_maps = False
+
+    def write(self, feature: List[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None):
+        if source_map is not None:
+            raise ValueError("Source maps are not supported for Python output")
+        CodeGenerator().write(feature, out)
+
+    def write_stream(
+        self, statements: Iterable[gfs_ast.Statement], out: TextIO, source_map: Optional[SourceMap] = None
+    ):
+        """Statements are applied in precedence order, so the whole feature is collected before it is rendered."""
+        feature = list(statements)
+        with instrumentation.stage("render"):
+            self.write(feature, out, source_map)
+
+
+formats = {
+    "ts": TSRenderer,
+    "json": JSONRenderer,
+    "msgpack": MsgPackRenderer,
+    "py": PythonRenderer,
+}
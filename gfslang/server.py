@@ -0,0 +1,396 @@
+"""
+A long-running compile server, so that editor tooling and content builds do not pay for Python startup, importing Lark,
+and building the parser on every compile.
+
+The server speaks JSON-RPC 2.0, one JSON message per line, either over stdin/stdout or over a Unix socket:
+
+    $ python -m gfslang.server                           # stdin/stdout
+    $ python -m gfslang.server --socket /tmp/gfslang.sock
+
+Methods:
+
+- ``compile``: compiles a feature. Params:
+    - ``source`` (the GFSL source) or ``filename`` (a file to read it from)
+    - ``output`` (optional): a file to write the output to; if not given, the output is returned
+    - ``format`` (default ``"ts"``), ``parser``, ``engine`` and ``optimize``: like gfsc.py's ``--format``,
+      ``--parser``, ``--engine`` and ``-O``
+    - ``bindings`` (optional): an object mapping template variables to lists of values, to expand templated targets
+      at compile time (see gfslang.templates)
+    - ``libraries`` (optional): shared macro libraries to compile the feature with. Each is a filename, or an object
+      with the library's ``source``. A library may only contain imports and macro definitions; its macros are visible
+      to the feature, which may redefine them (like ``import`` in the feature itself, see gfslang.library). Compiled
+      libraries are cached between requests.
+    - ``source_map`` (optional): if true, also returns a source map from the output back to the source (see
+      gfslang.sourcemap) in ``"source_map"``. Not supported for the msgpack and py formats.
+
+  Returns ``{"output": ...}`` (base64-encoded for binary formats, with ``"encoding": "base64"``), or
+  ``{"output_filename": ...}`` if ``output`` was given.
+- ``diagnose``: reports every syntax and compile error in a feature at once (e.g. for an editor), recovering from
+  errors statement by statement instead of stopping at the first one. Takes the ``source`` or ``filename``,
+  ``parser``, ``engine`` and ``libraries`` params of ``compile``. Returns ``{"diagnostics": [...]}``, each with its
+  ``severity`` (``"error"``), ``message``, ``line`` and ``column`` (and ``end_line`` and ``end_column`` for compile
+  errors).
+- ``ping``: returns ``"pong"``.
+- ``stats``: returns the instrumentation stats (see gfslang.instrumentation) of every request so far.
+- ``shutdown``: stops the server.
+
+Compile errors are returned as JSON-RPC errors with the error's position in ``data``. So that a runaway recursive macro
+cannot stall the server, expanding the macros of one statement may take at most ``--max-expansion-seconds`` (and is
+limited by the compiler's other expansion budgets, see Compiler.max_expansion_depth).
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import inspect
+import json
+import os
+import socket
+import sys
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import lark
+
+from . import errors, gfs_ast, instrumentation, optimizer, renderer
+from .cache import atomic_write, digest
+from .compiler import Compiler
+from .library import MacroLibrary, compile_library, load_library
+from .parser import DEFAULT_PARSER_MODE, PARSER_MODES, parse, prepare
+from .sourcemap import SourceMap
+from .templates import TemplateExpander
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+COMPILE_ERROR = -32000
+SYNTAX_ERROR = -32001
+
+Library = Union[str, Dict[str, str]]
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str, data: Any = None):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+class CompileServer:
+    """Answers compile requests in-process, keeping the parsers and compiled macro libraries warm."""
+
+    def __init__(
+        self,
+        parser_mode: str = DEFAULT_PARSER_MODE,
+        max_libraries: int = 64,
+        max_expansion_seconds: Optional[float] = 10.0,
+        engine: str = gfs_ast.DEFAULT_ENGINE,
+    ):
+        self.parser_mode = parser_mode
+        self.engine = engine
+        self.max_libraries = max_libraries
+        self.max_expansion_seconds = max_expansion_seconds
+        # digest of library source -> the precompiled library, least recently used first
+        # (libraries given as files are cached by gfslang.library)
+        self.libraries: "collections.OrderedDict[str, MacroLibrary]" = collections.OrderedDict()
+        self.stats = instrumentation.Stats()
+        self.running = True
+        self.methods = {
+            "compile": self.compile,
+            "diagnose": self.diagnose,
+            "ping": self.ping,
+            "stats": self.get_stats,
+            "shutdown": self.shutdown,
+        }
+        # build the parser now, so that the first request does not pay for it
+        prepare(parser_mode)
+
+    def compiler(self, base_dir: Optional[str], parser_mode: str, engine: str) -> Compiler:
+        """A compiler with the server's expansion time limit."""
+        compiler = Compiler(base_dir=base_dir, mode=parser_mode, engine=engine)
+        compiler.max_expansion_seconds = self.max_expansion_seconds
+        return compiler
+
+    # ==== methods ====
+    def compile(
+        self,
+        source: Optional[str] = None,
+        filename: Optional[str] = None,
+        output: Optional[str] = None,
+        format: str = "ts",
+        parser: Optional[str] = None,
+        optimize: int = optimizer.DEFAULT_LEVEL,
+        libraries: Sequence[Library] = (),
+        bindings: Optional[Dict[str, List[str]]] = None,
+        source_map: bool = False,
+        engine: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if (source is None) == (filename is None):
+            raise RPCError(INVALID_PARAMS, "Exactly one of source or filename is required")
+        if format not in renderer.formats:
+            raise RPCError(INVALID_PARAMS, f"Unknown format {format!r}, expected one of {list(renderer.formats)}")
+        out_renderer = renderer.formats[format]()
+        if source_map and not out_renderer.source_maps:
+            raise RPCError(INVALID_PARAMS, f"Source maps are not supported for the {format} format")
+        if optimize not in optimizer.LEVELS:
+            raise RPCError(INVALID_PARAMS, f"Unknown optimization level {optimize!r}")
+        parser_mode = parser or self.parser_mode
+        if parser_mode not in PARSER_MODES:
+            raise RPCError(INVALID_PARAMS, f"Unknown parser mode {parser_mode!r}")
+        engine = engine or self.engine
+        if engine not in gfs_ast.ENGINES:
+            raise RPCError(INVALID_PARAMS, f"Unknown engine {engine!r}, expected one of {list(gfs_ast.ENGINES)}")
+        expander = None
+        if bindings:
+            if not isinstance(bindings, dict):
+                raise RPCError(INVALID_PARAMS, "bindings must be an object")
+            try:
+                expander = TemplateExpander(bindings)
+            except ValueError as e:
+                raise RPCError(INVALID_PARAMS, str(e))
+        base_dir = None
+        if filename is not None:
+            with open(filename) as f:
+                source = f.read()
+            base_dir = os.path.dirname(filename)
+
+        sourcemap = None
+        if source_map:
+            map_dir = os.path.dirname(os.path.abspath(output)) if output is not None else None
+            sourcemap = SourceMap(
+                os.path.basename(output) if output is not None else "",
+                "<source>" if filename is None else filename if map_dir is None else os.path.relpath(filename, map_dir),
+                base_dir=map_dir,
+            )
+
+        compiler = self.compiler(base_dir, parser_mode, engine)
+        compiler.track_origins = sourcemap is not None
+        for library in libraries:
+            compiler.use_library(self.library(library, parser_mode, engine))
+        feature = compiler.compile(parse(source, mode=parser_mode))
+        if expander is not None:
+            feature = expander.expand(feature)
+        rendered = out_renderer.render(optimizer.optimize(feature, optimize), sourcemap)
+        result = {}
+        if sourcemap is not None:
+            result["source_map"] = sourcemap.to_dict()
+        if output is not None:
+            atomic_write(output, rendered)
+            result["output_filename"] = output
+        elif out_renderer.binary:
+            result.update(output=base64.b64encode(rendered).decode(), encoding="base64")
+        else:
+            result["output"] = rendered
+        return result
+
+    def diagnose(
+        self,
+        source: Optional[str] = None,
+        filename: Optional[str] = None,
+        parser: Optional[str] = None,
+        libraries: Sequence[Library] = (),
+        engine: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if (source is None) == (filename is None):
+            raise RPCError(INVALID_PARAMS, "Exactly one of source or filename is required")
+        parser_mode = parser or self.parser_mode
+        if parser_mode not in PARSER_MODES:
+            raise RPCError(INVALID_PARAMS, f"Unknown parser mode {parser_mode!r}")
+        engine = engine or self.engine
+        if engine not in gfs_ast.ENGINES:
+            raise RPCError(INVALID_PARAMS, f"Unknown engine {engine!r}, expected one of {list(gfs_ast.ENGINES)}")
+        base_dir = None
+        if filename is not None:
+            with open(filename) as f:
+                source = f.read()
+            base_dir = os.path.dirname(filename)
+
+        compiler = self.compiler(base_dir, parser_mode, engine)
+        for library in libraries:
+            compiler.use_library(self.library(library, parser_mode, engine))
+        diagnostics = []
+        compiler.compile(parse(source, mode=parser_mode, diagnostics=diagnostics), diagnostics)
+        diagnostics.sort(key=errors.source_order)
+        result = []
+        for e in diagnostics:
+            if isinstance(e, errors.GFSLCompileError):
+                result.append({"severity": "error", "message": str(e), **self.position(e)})
+            else:
+                result.append({"severity": "error", "message": str(e), "line": e.line, "column": e.column})
+        return {"diagnostics": result}
+
+    def ping(self) -> str:
+        return "pong"
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.stats.report()
+
+    def shutdown(self) -> None:
+        self.running = False
+
+    # ==== libraries ====
+    def library(self, library: Library, parser_mode: str, engine: str) -> MacroLibrary:
+        """Returns the precompiled library, compiling it if it is not cached."""
+        if isinstance(library, str):
+            return load_library(library, mode=parser_mode, engine=engine)
+        if not isinstance(library, dict) or not isinstance(library.get("source"), str):
+            raise RPCError(INVALID_PARAMS, "A library must be a filename or an object with its source")
+        key = digest(library["source"], parser_mode, engine)
+        if key in self.libraries:
+            self.libraries.move_to_end(key)
+            instrumentation.count("cached_libraries")
+            return self.libraries[key]
+        compiled = self.libraries[key] = compile_library(library["source"], mode=parser_mode, engine=engine)
+        if len(self.libraries) > self.max_libraries:
+            self.libraries.popitem(last=False)
+        return compiled
+
+    # ==== JSON-RPC ====
+    def handle(self, message: str) -> Optional[Dict[str, Any]]:
+        """Handles one JSON-RPC message. Returns the response, or None if the message was a notification."""
+        request_id = None
+        try:
+            try:
+                request = json.loads(message)
+            except json.JSONDecodeError as e:
+                raise RPCError(PARSE_ERROR, f"Invalid JSON: {e}")
+            if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+                raise RPCError(INVALID_REQUEST, "Invalid JSON-RPC request")
+            request_id = request.get("id")
+            method = self.methods.get(request["method"])
+            if method is None:
+                raise RPCError(METHOD_NOT_FOUND, f"Unknown method {request['method']!r}")
+            params = request.get("params", {})
+            try:
+                if isinstance(params, dict):
+                    bound = inspect.signature(method).bind(**params)
+                elif isinstance(params, list):
+                    bound = inspect.signature(method).bind(*params)
+                else:
+                    raise RPCError(INVALID_REQUEST, "params must be an object or an array")
+            except TypeError as e:
+                raise RPCError(INVALID_PARAMS, str(e))
+            with instrumentation.collect(self.stats), instrumentation.stage(request["method"]):
+                result = method(*bound.args, **bound.kwargs)
+            if "id" not in request:
+                return None
+            return {"jsonrpc": "2.0", "id": request_id, "result": result}
+        except RPCError as e:
+            return self.error(request_id, e.code, str(e), e.data)
+        except errors.GFSLCompileError as e:
+            return self.error(request_id, COMPILE_ERROR, str(e), self.position(e))
+        except (lark.exceptions.UnexpectedInput, errors.GFSLSyntaxError) as e:
+            return self.error(request_id, SYNTAX_ERROR, str(e), {"line": e.line, "column": e.column})
+        except Exception as e:
+            return self.error(request_id, INTERNAL_ERROR, f"{type(e).__name__}: {e}")
+
+    @staticmethod
+    def error(request_id, code: int, message: str, data: Any = None) -> Dict[str, Any]:
+        error = {"code": code, "message": message}
+        if data is not None:
+            error["data"] = data
+        return {"jsonrpc": "2.0", "id": request_id, "error": error}
+
+    @staticmethod
+    def position(e: errors.GFSLCompileError) -> Dict[str, int]:
+        return {"line": e.line, "column": e.column, "end_line": e.end_line, "end_column": e.end_column}
+
+    # ==== transports ====
+    async def serve_stream(self, reader: asyncio.StreamReader, write):
+        """Answers the requests read from *reader* (one per line) until it is closed or the server is shut down."""
+        while self.running:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            response = self.handle(line.decode())
+            if response is not None:
+                await write(json.dumps(response).encode() + b"\n")
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        stdout = sys.stdout.buffer
+
+        async def write(data: bytes):
+            stdout.write(data)
+            stdout.flush()
+
+        await self.serve_stream(reader, write)
+
+    async def serve_unix(self, path: str):
+        stopped = asyncio.Event()
+
+        async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            async def write(data: bytes):
+                writer.write(data)
+                await writer.drain()
+
+            try:
+                await self.serve_stream(reader, write)
+            finally:
+                writer.close()
+                if not self.running:
+                    stopped.set()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(on_connect, path=path)
+        try:
+            async with server:
+                await stopped.wait()
+        finally:
+            os.unlink(path)
+
+
+def call(path: str, method: str, **params) -> Any:
+    """Makes one request to a compile server listening on a Unix socket, and returns its result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline())
+    if "error" in response:
+        raise RPCError(response["error"]["code"], response["error"]["message"], response["error"].get("data"))
+    return response["result"]
+
+
+def main(argv: Optional[List[str]] = None):
+    argparser = argparse.ArgumentParser(description="Run a GFSLang compile server.")
+    argparser.add_argument("--socket", help="Listen on this Unix socket instead of stdin/stdout.", metavar="path")
+    argparser.add_argument(
+        "--parser",
+        help="The default parsing algorithm (default %(default)s).",
+        choices=PARSER_MODES,
+        default=DEFAULT_PARSER_MODE,
+    )
+    argparser.add_argument(
+        "--engine",
+        help="The default GFS engine to compile for (default %(default)s).",
+        choices=gfs_ast.ENGINES,
+        default=gfs_ast.DEFAULT_ENGINE,
+    )
+    argparser.add_argument(
+        "--max-expansion-seconds",
+        help="The time limit for expanding the macros of one statement (default %(default)s).",
+        type=float,
+        default=10.0,
+        metavar="seconds",
+    )
+    args = argparser.parse_args(argv)
+    server = CompileServer(
+        parser_mode=args.parser, max_expansion_seconds=args.max_expansion_seconds, engine=args.engine
+    )
+    if args.socket:
+        asyncio.run(server.serve_unix(args.socket))
+    else:
+        asyncio.run(server.serve_stdio())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Source maps from rendered output back to GFSL source, in the source map v3 format (the format JS tooling uses, with
+VLQ-encoded mappings).
+
+The renderers map the start of each statement and expression they write to where it was compiled from (see
+gfs_ast.Origin), when the compiler tracked origins (see Compiler.track_origins). A node produced by expanding a
+functional macro maps to the macro's body (which may be in a library), and is named after the macro. The map also has
+an ``x_gfsl_statements`` extension: the [source index, line, column] of each rendered statement, in order, so that
+anything that knows a statement's index in the output (e.g. the GFS engine's profiling data) can find its source line.
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+from . import gfs_ast
+
+_BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def vlq_encode(value: int) -> str:
+    """Encodes an integer as a base64 VLQ: 5 bits per digit, least significant first, sign in the lowest bit."""
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    digits = []
+    while True:
+        digit = value & 0b11111
+        value >>= 5
+        if value:
+            digit |= 0b100000
+        digits.append(_BASE64[digit])
+        if not value:
+            return "".join(digits)
+
+
+class SourceMap:
+    """
+    A source map of one rendered output (*file*) compiled from *source*. Macro libraries are added to its sources as
+    they are referenced, relative to *base_dir* (the directory of the map) if given.
+    """
+
+    def __init__(self, file: str, source: str, base_dir: Optional[str] = None):
+        self.file = file
+        self.base_dir = base_dir
+        self.sources: List[str] = [source]
+        self.names: List[str] = []
+        self.statements: List[List[int]] = []
+        # source path (None for the compiled file) -> index in sources; name -> index in names
+        self._source_indices: Dict[Optional[str], int] = {None: 0}
+        self._name_indices: Dict[str, int] = {}
+        # the segments of each generated line: (generated column, source index, line, column, name index or -1)
+        self._lines: List[List[Tuple[int, int, int, int, int]]] = []
+
+    def source_index(self, source: Optional[str]) -> int:
+        index = self._source_indices.get(source)
+        if index is None:
+            path = os.path.relpath(source, self.base_dir) if self.base_dir is not None else source
+            index = self._source_indices[source] = len(self.sources)
+            self.sources.append(path.replace(os.sep, "/"))
+        return index
+
+    def name_index(self, name: str) -> int:
+        index = self._name_indices.get(name)
+        if index is None:
+            index = self._name_indices[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def add(self, line: int, column: int, origin: gfs_ast.Origin):
+        """Maps a (0-based) position in the output to an origin."""
+        while len(self._lines) <= line:
+            self._lines.append([])
+        # named after the macro whose expansion produced the node
+        name = self.name_index(origin.expansions[-1][0]) if origin.expansions else -1
+        self._lines[line].append((column, self.source_index(origin.source), origin.line - 1, origin.column - 1, name))
+
+    def add_statement(self, origin: Optional[gfs_ast.Origin]):
+        """Records the origin of the next rendered statement."""
+        if origin is None:
+            self.statements.append([])
+        else:
+            self.statements.append([self.source_index(origin.source), origin.line, origin.column])
+
+    def mappings(self) -> str:
+        lines = []
+        previous = [0, 0, 0, 0]
+        for segments in self._lines:
+            encoded = []
+            previous_column = 0
+            for column, source, line, source_column, name in segments:
+                fields = [column - previous_column]
+                previous_column = column
+                for i, value in enumerate((source, line, source_column)):
+                    fields.append(value - previous[i])
+                    previous[i] = value
+                if name >= 0:
+                    fields.append(name - previous[3])
+                    previous[3] = name
+                encoded.append("".join(map(vlq_encode, fields)))
+            lines.append(",".join(encoded))
+        return ";".join(lines)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": 3,
+            "file": self.file,
+            "sources": self.sources,
+            "names": self.names,
+            "mappings": self.mappings(),
+            "x_gfsl_statements": self.statements,
+        }
+
+    def dumps(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+
+class TrackingWriter:
+    """Wraps a text stream, keeping track of the (0-based) line and column that the next write starts at."""
+
+    def __init__(self, out: TextIO):
+        self.out = out
+        self.line = 0
+        self.column = 0
+
+    def write(self, text: str) -> int:
+        newlines = text.count("\n")
+        if newlines:
+            self.line += newlines
+            self.column = len(text) - text.rfind("\n") - 1
+        else:
+            self.column += len(text)
+        return self.out.write(text)
+
+    def tell(self) -> int:
+        return self.out.tell()
@@ -0,0 +1,148 @@
+"""
+Compile-time expansion of target templates.
+
+A target like ``attributes.${statName}.modifier`` is normally passed through to the engine as-is, and the engine
+substitutes ``${statName}`` on every evaluation, so that one statement covers every stat. Given a binding set (e.g.
+``statName`` in ``strength, dexterity, ...``), the template expander instead emits one fully resolved statement for each
+binding of the variables in a statement's target, substituting them in the targets it reads too. Since the resolved
+statements are optimized separately, statics are folded per binding (e.g. ``attributes.${statName}.value -
+attributes.strength.value`` is 0 for ``strength`` at -O2). A statement that reads a bound variable its target does not
+use is a compile error: every resolved copy would set the same target to a different value.
+
+Placeholders are substituted like the evaluator does (see string.Template); variables that are not bound are left in
+place for the engine.
+"""
+import itertools
+import re
+import string
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from . import errors, gfs_ast
+from .dependencies import dynamic_targets
+
+# a binding value is substituted into targets, so it must be a valid part of one
+_VALUE = re.compile(r"[a-zA-Z0-9_.]+")
+
+
+def template_variables(target: str) -> FrozenSet[str]:
+    """The names of the ``$name`` and ``${name}`` placeholders in a target."""
+    if "$" not in target:
+        return frozenset()
+    names = set()
+    for match in string.Template.pattern.finditer(target):
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            names.add(name)
+    return frozenset(names)
+
+
+class TemplateExpander:
+    """Expands the templated statements of compiled features for every binding in a binding set."""
+
+    def __init__(self, bindings: Mapping[str, Sequence[str]]):
+        for name, values in bindings.items():
+            if not values:
+                raise ValueError(f"No values to bind {name!r} to")
+            for value in values:
+                if not isinstance(value, str) or not _VALUE.fullmatch(value):
+                    raise ValueError(f"Invalid value {value!r} for {name!r}: values can only contain [a-zA-Z0-9_.]")
+        self.bindings = {name: tuple(values) for name, values in bindings.items()}
+
+    def expand(self, feature: List[gfs_ast.Statement]) -> List[gfs_ast.Statement]:
+        return list(self.expand_statements(feature))
+
+    def expand_statements(self, statements: Iterable[gfs_ast.Statement]) -> Iterator[gfs_ast.Statement]:
+        """Expands a stream of statements (e.g. from Compiler.compile_statements) one at a time."""
+        for stmt in statements:
+            yield from self.expand_statement(stmt)
+
+    def expand_statement(self, stmt: gfs_ast.Statement) -> List[gfs_ast.Statement]:
+        """
+        Returns the statement resolved for each binding of the bound variables in its target, in binding set order.
+        Raises a GFSLCompileError if the statement reads a bound variable that its target does not use.
+        """
+        in_target = template_variables(stmt.target)
+        read = set().union(*map(template_variables, dynamic_targets(stmt.operand)))
+        for name in self.bindings:
+            if name in read and name not in in_target:
+                raise errors.GFSLCompileError(
+                    f"Templated value in a non-templated target: {stmt.target!r} (at precedence {stmt.precedence}) "
+                    f"reads ${{{name}}}, which is bound, but its target does not use it",
+                    node=stmt.origin,
+                )
+        names = [name for name in self.bindings if name in in_target]
+        if not names:
+            return [stmt]
+        expanded = []
+        for values in itertools.product(*(self.bindings[name] for name in names)):
+            binding = dict(zip(names, values))
+            done = {}
+            operand = self.substitute(stmt.operand, binding, done)
+            origins = None
+            if stmt.origins is not None:
+                origins = {}
+                for node, origin in stmt.origins.items():
+                    if node in done:
+                        origins[done[node]] = origin
+            expanded.append(
+                gfs_ast.Statement(
+                    precedence=stmt.precedence,
+                    target=string.Template(stmt.target).safe_substitute(binding),
+                    operator=stmt.operator,
+                    operand=operand,
+                    origin=stmt.origin,
+                    origins=origins,
+                )
+            )
+        return expanded
+
+    @staticmethod
+    def substitute(
+        expr: gfs_ast.Expression,
+        binding: Dict[str, str],
+        done: Optional[Dict[gfs_ast.Expression, gfs_ast.Expression]] = None,
+    ) -> gfs_ast.Expression:
+        """
+        Returns the expression with the placeholders in its targets substituted from the binding. If a *done* dict is
+        given, it is filled with the substituted version of each node of the expression.
+        """
+        if done is None:
+            done = {}
+        # iterative post-order, since compiled expressions can be deeper than the recursion limit
+        stack = [expr]
+        while stack:
+            node = stack[-1]
+            if node in done:
+                stack.pop()
+                continue
+            if node.operator is gfs_ast.ExpressionOperators.DYNAMIC_VALUE:
+                target = string.Template(node.operands).safe_substitute(binding)
+                done[node] = gfs_ast.Expression(node.operator, target)
+                stack.pop()
+                continue
+            if not isinstance(node.operands, tuple):
+                done[node] = node
+                stack.pop()
+                continue
+            pending = [operand for operand in node.operands if operand not in done]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            done[node] = gfs_ast.Expression(node.operator, [done[operand] for operand in node.operands])
+        return done[expr]
+
+
+def expand_templates(
+    feature: List[gfs_ast.Statement], bindings: Mapping[str, Sequence[str]]
+) -> List[gfs_ast.Statement]:
+    return TemplateExpander(bindings).expand(feature)
+
+
+def parse_binding(binding: str) -> Tuple[str, Tuple[str, ...]]:
+    """Parses a binding given as ``name=value1,value2,...`` (e.g. on the command line)."""
+    name, sep, values = binding.partition("=")
+    name = name.strip()
+    if not sep or not name.isidentifier():
+        raise ValueError(f"Invalid binding {binding!r}, expected name=value1,value2,...")
+    return name, tuple(value.strip() for value in values.split(",") if value.strip())
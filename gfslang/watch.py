@@ -0,0 +1,273 @@
+"""
+Watches trees of source files for changes, for gfsc.py's ``--watch`` mode.
+
+On Linux, changes are reported by inotify (through libc, so there are no dependencies), as soon as a file is written
+and closed or moved into place. Elsewhere, or if inotify is not available (e.g. the watch limit is reached), the
+watched trees are polled for changed modification times instead.
+
+A save is often several events (e.g. editors that write a temporary file and rename it over the original), so
+Watcher.changes debounces them: it reports a batch of changed files once no more events arrive for a short while.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from .errors import GFSLSyntaxError
+from .fast_parser import FastParser
+from .imf_ast import Import
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+    """
+    Reports the files (with the given suffix) that are created, changed, or deleted in the watched directories. Each
+    directory is watched along with its subdirectories if *recursive* is set; like glob, hidden subdirectories are
+    skipped.
+    """
+
+    def __init__(self, suffix: str = ".gfs"):
+        self.suffix = suffix
+        # absolute path -> whether its subdirectories are watched too
+        self.roots: Dict[str, bool] = {}
+
+    def add(self, directory: str, recursive: bool = True):
+        directory = os.path.abspath(directory)
+        if self.roots.get(directory) is True or not os.path.isdir(directory):
+            return
+        self.roots[directory] = recursive or self.roots.get(directory, False)
+        self._add(directory, recursive)
+
+    def _add(self, directory: str, recursive: bool):
+        raise NotImplementedError
+
+    def poll(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Waits up to *timeout* seconds (or forever) for changes. Returns the absolute paths of the changed files, or an
+        empty set if there were none.
+        """
+        raise NotImplementedError
+
+    def changes(self, debounce: float = 0.01) -> Iterator[Set[str]]:
+        """Yields the files changed in each burst of changes, once there were no changes for *debounce* seconds."""
+        while True:
+            changed = self.poll()
+            while True:
+                more = self.poll(debounce)
+                if not more:
+                    break
+                changed |= more
+            if changed:
+                yield changed
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _walk(self, directory: str, recursive: bool) -> Iterator[Tuple[str, List[str]]]:
+        """Yields each watched directory under *directory*, and the names of the files in it."""
+        if not recursive:
+            try:
+                with os.scandir(directory) as entries:
+                    yield directory, [entry.name for entry in entries if not entry.is_dir()]
+            except OSError:
+                pass
+            return
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            yield dirpath, filenames
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, suffix: str = ".gfs"):
+        super().__init__(suffix)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+        # watch descriptor -> (directory, whether its subdirectories are watched too)
+        self.watches: Dict[int, Tuple[str, bool]] = {}
+
+    def _raise_errno(self, filename: str = None):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), filename)
+
+    def _add(self, directory: str, recursive: bool) -> Set[str]:
+        """Watches the directory (and its subdirectories); returns the files in them."""
+        found = set()
+        for dirpath, filenames in self._walk(directory, recursive):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), _WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                self._raise_errno(dirpath)
+            _, was_recursive = self.watches.get(wd, (None, False))
+            self.watches[wd] = (dirpath, recursive or was_recursive)
+            found.update(os.path.join(dirpath, name) for name in filenames if name.endswith(self.suffix))
+        return found
+
+    def poll(self, timeout: Optional[float] = None) -> Set[str]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                changed |= self._handle(wd, mask, name)
+        return changed
+
+    def _handle(self, wd: int, mask: int, name: str) -> Set[str]:
+        if mask & IN_Q_OVERFLOW:
+            # events were lost: report everything
+            return {path for root, recursive in self.roots.items() for path in self._files(root, recursive)}
+        if mask & IN_IGNORED:
+            # the directory was deleted (or unmounted)
+            self.watches.pop(wd, None)
+            return set()
+        if wd not in self.watches or not name:
+            return set()
+        directory, recursive = self.watches[wd]
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if recursive and mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith("."):
+                # files can be created in a new directory before it is watched
+                return self._add(path, recursive)
+            return set()
+        if name.endswith(self.suffix) and mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+            return {path}
+        return set()
+
+    def _files(self, directory: str, recursive: bool) -> Iterator[str]:
+        for dirpath, filenames in self._walk(directory, recursive):
+            yield from (os.path.join(dirpath, name) for name in filenames if name.endswith(self.suffix))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, suffix: str = ".gfs", interval: float = 0.1):
+        super().__init__(suffix)
+        self.interval = interval
+        # path -> (modification time, size)
+        self.files: Dict[str, Tuple[int, int]] = {}
+
+    def _add(self, directory: str, recursive: bool):
+        self.files.update(self._scan(directory, recursive))
+
+    def _scan(self, directory: str, recursive: bool) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for dirpath, filenames in self._walk(directory, recursive):
+            for name in filenames:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def poll(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = {}
+            for root, recursive in self.roots.items():
+                files.update(self._scan(root, recursive))
+            changed = {path for path in files.keys() | self.files.keys() if files.get(path) != self.files.get(path)}
+            self.files = files
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.interval, remaining))
+
+
+def watcher(suffix: str = ".gfs", polling_interval: float = 0.1) -> Watcher:
+    """Returns an inotify watcher on Linux if possible, or a polling watcher otherwise."""
+    if sys.platform.startswith("linux"):
+        try:
+            return _FallbackWatcher(InotifyWatcher(suffix), polling_interval)
+        except (OSError, AttributeError):
+            # AttributeError: libc has no inotify
+            pass
+    return PollingWatcher(suffix, polling_interval)
+
+
+class _FallbackWatcher(Watcher):
+    """An inotify watcher that switches to polling if it cannot watch a directory (e.g. over the watch limit)."""
+
+    def __init__(self, inotify: InotifyWatcher, polling_interval: float):
+        super().__init__(inotify.suffix)
+        self.watcher: Watcher = inotify
+        self.polling_interval = polling_interval
+
+    def _add(self, directory: str, recursive: bool):
+        try:
+            self.watcher.add(directory, recursive)
+        except OSError:
+            self.watcher.close()
+            self.watcher = PollingWatcher(self.suffix, self.polling_interval)
+            for root, root_recursive in self.roots.items():
+                self.watcher.add(root, root_recursive)
+
+    def poll(self, timeout: Optional[float] = None) -> Set[str]:
+        return self.watcher.poll(timeout)
+
+    def close(self):
+        self.watcher.close()
+
+
+def imported_files(filename: str) -> Set[str]:
+    """The absolute paths of the libraries a file imports directly, found without compiling it."""
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    parser = FastParser()
+    paths = set()
+    with open(filename) as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.lstrip(" \t").startswith("import"):
+                continue
+            try:
+                stmt = parser.parse_line(line.rstrip("\n"), lineno)
+            except GFSLSyntaxError:
+                continue
+            if isinstance(stmt, Import):
+                paths.add(os.path.normpath(os.path.join(base_dir, stmt.path)))
+    return paths
@@ -0,0 +1,16 @@
+import sys
+
+from gfslang.cache import CompileCache
+
+
+def test_deep_expressions(tmp_path):
+    depth = sys.getrecursionlimit()
+    # the expansions of a recursive macro are not cached as macros of their own, so the statement is pickled whole
+    source = f"h(!n) := !n <= 0 ? x : floor(!h(!n - 1) + y)\n0: a = !h({depth})\n"
+    cache = CompileCache(str(tmp_path / "cache"))
+    filename = str(tmp_path / "deep.gfs")
+    first = cache.compile(filename, source)
+    # the unchanged statement is unpickled from the file's saved state, and re-interned
+    second = cache.compile(filename, source + "0: b = y\n")
+    assert len(second) == 2
+    assert second[0].operand is first[0].operand
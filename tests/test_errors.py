@@ -0,0 +1,8 @@
+from gfslang import errors, gfs_ast
+
+
+def test_source_order():
+    unknown = errors.GFSLCompileError("unknown position", node=None)
+    second = errors.GFSLCompileError("second", node=gfs_ast.Origin(None, 2, 1, 2, 5))
+    first = errors.GFSLSyntaxError("first", 1, 5)
+    assert sorted([unknown, second, first], key=errors.source_order) == [first, second, unknown]
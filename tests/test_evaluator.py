@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+import gfslang
+from gfslang.evaluator import to_columns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SOURCE = """\
+0: attributes.mod = (attributes.value - 10) // 2
+0: attributes.half = round(attributes.value / 4) + ceil(attributes.value / 3)
+cap(!value) := !value > 12 ? min(!value, 15) : abs(!value - 20)
+0: attributes.capped = !cap(attributes.value)
+0: bonuses ++ attributes.value * 2
+1: bonuses ++ attributes.mod
+1: new ++ attributes.value == 10
+"""
+
+
+@pytest.mark.skipif(np is None, reason="the batched evaluator requires NumPy")
+def test_batch_matches_scalar():
+    feature = gfslang.compile(gfslang.parse(SOURCE), engine="extended")
+    rng = random.Random(0)
+    states = [{"attributes.value": rng.randint(1, 20), "bonuses": [rng.randint(-5, 5)]} for _ in range(50)]
+    expected = [gfslang.evaluate(feature, state) for state in states]
+    columns = gfslang.evaluate_batch(feature, to_columns(states))
+    for i, result in enumerate(expected):
+        row = {
+            target: [value[i] for value in column] if isinstance(column, list) else column[i]
+            for target, column in columns.items()
+        }
+        assert row == result
+
+    # a PUSH target given as an array with one value per character appends to a list of that value
+    columns = gfslang.evaluate_batch(feature, {"attributes.value": np.array([12]), "bonuses": np.array([3])})
+    assert [column.tolist() for column in columns["bonuses"]] == [[3], [24], [1]]
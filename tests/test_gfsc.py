@@ -0,0 +1,55 @@
+import json
+import os
+
+import gfsc
+from gfslang.cache import CompileCache
+from gfslang.renderer import JSONRenderer
+
+
+def test_find_inputs_skips_imported_libraries(tmp_path):
+    (tmp_path / "libs").mkdir()
+    (tmp_path / "libs" / "base.gfs").write_text("k := 1\n")
+    (tmp_path / "libs" / "lib.gfs").write_text('import "base.gfs"\nj := !k + 1\n')
+    (tmp_path / "main.gfs").write_text('import "libs/lib.gfs"\n0: x = !j + y\n')
+    (tmp_path / "other.gfs").write_text("0: z = 1\n")
+    directory = str(tmp_path)
+    assert gfsc.find_inputs([directory]) == [
+        os.path.join(directory, "main.gfs"),
+        os.path.join(directory, "other.gfs"),
+    ]
+    # a library is still compiled when it is named
+    library = os.path.join(directory, "libs", "lib.gfs")
+    assert gfsc.find_inputs([directory, library]) == [
+        library,
+        os.path.join(directory, "main.gfs"),
+        os.path.join(directory, "other.gfs"),
+    ]
+    assert gfsc.find_inputs([os.path.join(directory, "libs", "*.gfs")]) == [
+        os.path.join(directory, "libs", "lib.gfs"),
+    ]
+
+
+def test_cached_outputs_are_per_directory(tmp_path):
+    # the same source imports a different library in each directory
+    cache = CompileCache(str(tmp_path / "cache"))
+    for name, value in (("a", 1), ("b", 2)):
+        directory = tmp_path / name
+        directory.mkdir()
+        (directory / "lib.gfs").write_text(f"k := {value}\n")
+        (directory / "f.gfs").write_text('import "lib.gfs"\n0: x = !k + y\n')
+        gfsc.compile_file(str(directory / "f.gfs"), str(directory / "f.json"), JSONRenderer(), cache=cache)
+        [stmt] = json.loads((directory / "f.json").read_text())
+        assert stmt["operand"]["operands"][0] == {"operator": "STATIC_VALUE", "operands": value}
+
+
+def test_worker_reports_error_when_diagnosing_fails(tmp_path, monkeypatch):
+    def diagnose(*args, **kwargs):
+        raise RecursionError("maximum recursion depth exceeded")
+
+    monkeypatch.setattr(gfsc.gfslang, "diagnose", diagnose)
+    filename = str(tmp_path / "f.gfs")
+    (tmp_path / "f.gfs").write_text("0: x = !missing\n")
+    error, _ = gfsc._compile_worker(filename, "json", "earley", 1, False, False)
+    assert error == f"{filename}:1:8: Macro !missing is not defined"
+    _, error = gfsc._link_worker(filename, "earley", 1)
+    assert error == f"{filename}:1:8: Macro !missing is not defined"
@@ -0,0 +1,109 @@
+import io
+import json
+import struct
+import sys
+
+from gfslang import gfs_ast
+from gfslang.renderer import JSONRenderer, MsgPackRenderer, TSRenderer
+from gfslang.sourcemap import SourceMap
+
+Ops = gfs_ast.ExpressionOperators
+
+
+def statement(operand: gfs_ast.Expression) -> gfs_ast.Statement:
+    return gfs_ast.Statement(0, "a", gfs_ast.StatementOperators.SET, operand)
+
+
+def deep_expression(depth: int) -> gfs_ast.Expression:
+    """FLOOR(ADD(FLOOR(ADD(... x ..., 1)), 1)), nested *depth* times."""
+    expr = gfs_ast.Expression(Ops.DYNAMIC_VALUE, "x")
+    for _ in range(depth):
+        expr = gfs_ast.Expression(Ops.FLOOR, [gfs_ast.Expression(Ops.ADD, [expr, gfs_ast.StaticExpression(1)])])
+    return expr
+
+
+def test_ts():
+    feature = [statement(deep_expression(1))]
+    assert TSRenderer().render(feature) == (
+        "[\n"
+        "    {\n"
+        "        precedence: 0,\n"
+        "        target: `a`,\n"
+        "        operator: StatementOperators.SET,\n"
+        "        operand: {\n"
+        "            operator: ExpressionOperators.FLOOR,\n"
+        "            operands: [\n"
+        "                {\n"
+        "                    operator: ExpressionOperators.ADD,\n"
+        "                    operands: [\n"
+        "                        {\n"
+        "                            operator: ExpressionOperators.DYNAMIC_VALUE,\n"
+        "                            operands: `x`\n"
+        "                        },\n"
+        "                        {\n"
+        "                            operator: ExpressionOperators.STATIC_VALUE,\n"
+        "                            operands: 1\n"
+        "                        }\n"
+        "                    ]\n"
+        "                }\n"
+        "            ]\n"
+        "        }\n"
+        "    }\n"
+        "]"
+    )
+
+
+def test_ts_deep_expression():
+    depth = sys.getrecursionlimit()
+    feature = [statement(deep_expression(depth))]
+    rendered = TSRenderer().render(feature)
+    assert rendered.count("ExpressionOperators.FLOOR") == depth
+    assert rendered.endswith("\n        }\n    }\n]")
+    # and with a source map, which restores the origin of each node's parent after writing it
+    origin = gfs_ast.Origin(None, 1, 1, 1, 10)
+    feature = [gfs_ast.Statement(0, "a", gfs_ast.StatementOperators.SET, deep_expression(depth), origin, {})]
+    source_map = SourceMap("a.ts", "a.gfs")
+    assert TSRenderer().render(feature, source_map) == rendered
+
+
+def test_json():
+    feature = [statement(deep_expression(2))]
+    for indent in (None, 2, "\t"):
+        renderer = JSONRenderer(indent)
+        expected = json.dumps(renderer.feature_to_wire(feature), indent=indent)
+        assert renderer.render(feature) == expected
+        out = io.StringIO()
+        renderer.write_stream(iter(feature), out)
+        assert out.getvalue() == expected
+
+
+def test_json_deep_expression():
+    depth = sys.getrecursionlimit()
+    feature = [statement(deep_expression(depth))]
+    rendered = JSONRenderer().render(feature)
+    assert rendered.count('"FLOOR"') == depth
+    assert rendered.endswith("}]}]}}]")
+    origin = gfs_ast.Origin(None, 1, 1, 1, 10)
+    feature = [gfs_ast.Statement(0, "a", gfs_ast.StatementOperators.SET, deep_expression(depth), origin, {})]
+    assert JSONRenderer().render(feature, SourceMap("a.json", "a.gfs")) == rendered
+
+
+def test_msgpack():
+    feature = [statement(gfs_ast.StaticExpression(1 << 64))]
+    assert MsgPackRenderer().render(feature) == (
+        b"\x91\x84"
+        b"\xaaprecedence\x00"
+        b"\xa6target\xa1a"
+        b"\xa8operator\xa3SET"
+        b"\xa7operand\x82\xa8operator\xacSTATIC_VALUE\xa8operands" + struct.pack(">Bd", 0xCB, 1 << 64)
+    )
+
+
+def test_msgpack_deep_expression():
+    depth = sys.getrecursionlimit()
+    rendered = MsgPackRenderer().render([statement(deep_expression(depth))])
+    assert rendered.count(b"\xa5FLOOR") == depth
+    out = io.BytesIO()
+    MsgPackRenderer().write_stream(iter([statement(deep_expression(depth))]), out)
+    # streams start with a 32-bit array header instead
+    assert out.getvalue() == b"\xdd\x00\x00\x00\x01" + rendered[1:]